@@ -21,15 +21,36 @@ import sqlite3                     # للتعامل مع قاعدة بيانات
 import os                          # للتعامل مع نظام التشغيل والمسارات
 import json                        # لتحويل البيانات من وإلى JSON
 import re                          # للتحقق من النصوص باستخدام Regular Expressions
-from datetime import datetime      # للتعامل مع التاريخ والوقت الحالي
-from contextlib import closing     #  (جديد) استيراد مكتبة لإغلاق الاتصال تلقائياً
-
-from flask import Flask, jsonify, request, send_from_directory, session
+import queue                       # طابور الاتصالات الجاهزة داخل مجمع الاتصالات
+import threading                   # أقفال لحماية البيانات المشتركة بين الـ threads
+import time                        # لحساب مدة صلاحية عناصر الكاش
+import base64                      # لترميز مؤشرات الصفحات (cursor)
+import hashlib                     # لحساب بصمة قائمة الفنادق
+import uuid                        # لتوليد معرفات المحادثات
+import gzip                        # لضغط الملفات الثابتة مسبقاً
+import mimetypes                   # لتحديد نوع محتوى الملفات الثابتة
+import math                        # لحساب المسافات الجغرافية
+import csv                         # لقراءة ملفات استيراد الفنادق
+import io                          # لقراءة الملفات المرفوعة كنص أثناء الاستيراد
+import importlib                   # لتحميل المكتبات الثقيلة عند أول استخدام
+import bisect                      # لتحديد خانة القياس في المدرج التكراري (histogram)
+import functools                   # لتغليف الدوال بقياس الزمن
+import multiprocessing             # طريقة بدء عمليات تشفير كلمات المرور (بدون fork)
+from collections import OrderedDict  # لبناء كاش LRU
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future  # لتشغيل المهام الثقيلة في الخلفية
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, date, timedelta  # للتعامل مع التاريخ والوقت الحالي
+from contextlib import contextmanager  # لإعادة الاتصال إلى المجمع تلقائياً عند انتهاء with
+
+import click                       # أوامر سطر الأوامر (flask --app app import-hotels)
+from flask import Flask, jsonify, request, send_from_directory, session, Response, stream_with_context, g
 # Flask: لإنشاء السيرفر
 # jsonify: لإرجاع البيانات بصيغة JSON
 # request: لاستقبال البيانات من المستخدم
 # send_from_directory: لإرسال الملفات الثابتة
 # session: لتخزين بيانات الجلسة
+# Response / stream_with_context: لإرسال الردود على دفعات (Streaming)
 
 from flask_cors import CORS        # للسماح بالاتصال بين الفرونت والباك
 from flask_login import LoginManager, UserMixin, login_user, logout_user, current_user, login_required   # نظام تسجيل الدخول
@@ -39,7 +60,15 @@ from werkzeug.security import generate_password_hash, check_password_hash
 
 from dotenv import load_dotenv     # لقراءة متغيرات البيئة من ملف .env
 
-import google.generativeai as genai  # لاستخدام الذكاء الاصطناعي (Gemini)
+try:
+    import brotli                  # (اختياري) ضغط Brotli للملفات الثابتة
+except ImportError:
+    brotli = None
+
+try:
+    import orjson                  # (اختياري) تحويل سريع إلى JSON
+except ImportError:
+    orjson = None
 
 
 # ----------------------------------------------------
@@ -54,21 +83,203 @@ GOOGLE_API_KEY = os.environ.get("GEMINI_API_KEY")
 # التحقق من وجود مفتاح API
 if not GOOGLE_API_KEY:
     print("⚠️ تحذير: لم يتم العثور على GEMINI_API_KEY")
-else:
-    genai.configure(api_key=GOOGLE_API_KEY)
 
-# اسم قاعدة البيانات
-DATABASE_FILE = "my_app_data.db"
+# مكتبة تُستورد عند أول وصول لأي خاصية فيها (setup يُنفذ مرة واحدة بعد الاستيراد)
+class LazyModule:
+    def __init__(self, name, setup=None):
+        self._name = name
+        self._setup = setup
+        self._module = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._module is None:
+                module = importlib.import_module(self._name)
+                if self._setup:
+                    self._setup(module)
+                self._module = module
+        return self._module
+
+    def __getattr__(self, attr):
+        if attr.startswith('__'):
+            raise AttributeError(attr)
+        return getattr(self._load(), attr)
+
+# مكتبة Gemini ثقيلة الاستيراد (~1 ثانية): تُحمّل عند أول استدعاء للذكاء الاصطناعي فقط
+genai = LazyModule(
+    'google.generativeai',
+    setup=lambda module: module.configure(api_key=GOOGLE_API_KEY) if GOOGLE_API_KEY else None
+)
+
+# اسم قاعدة البيانات (DATABASE_FILE يوجّه الاختبارات وسكربتات القياس لقاعدة مؤقتة بدلاً من قاعدة التطبيق)
+DATABASE_FILE = os.environ.get("DATABASE_FILE", "my_app_data.db")
+
+# إعدادات مجمع اتصالات قاعدة البيانات
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 8))            # أقصى عدد للاتصالات المفتوحة
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 5))    # مدة انتظار اتصال متاح (بالثواني)
+DB_CACHE_SIZE_KB = int(os.environ.get("DB_CACHE_SIZE_KB", 20000))  # حجم كاش الصفحات لكل اتصال
+DB_MMAP_SIZE = int(os.environ.get("DB_MMAP_SIZE", 256 * 1024 * 1024))  # حجم الـ memory-map
+DB_STATEMENT_CACHE = 256                                         # عدد الاستعلامات المجهزة المحفوظة لكل اتصال
+
+# طابور الكتابة (خيط كتابة واحد مع group commit)
+WRITE_QUEUE_MAX = int(os.environ.get("WRITE_QUEUE_MAX", 1000))      # أقصى عدد عمليات كتابة منتظرة
+WRITE_QUEUE_TIMEOUT = float(os.environ.get("WRITE_QUEUE_TIMEOUT", 2))  # ثوانٍ انتظار مكان في الطابور قبل الرفض
+WRITE_RESULT_TIMEOUT = float(os.environ.get("WRITE_RESULT_TIMEOUT", 30))  # أقصى انتظار لنتيجة عملية كتابة
+WRITE_BATCH_SIZE = 64                                               # أقصى عدد عمليات في transaction واحدة
+
+# سجل الاستعلامات البطيئة (اختياري): يُفعّل بتحديد الحد بالملي ثانية، مثلاً SLOW_QUERY_MS=50
+SLOW_QUERY_MS = float(os.environ["SLOW_QUERY_MS"]) if os.environ.get("SLOW_QUERY_MS") else None
+SLOW_QUERY_MAX_STATEMENTS = 500   # أقصى عدد استعلامات مختلفة محفوظة في السجل
+
+# إعدادات البحث عن الفنادق
+SEARCH_DEFAULT_LIMIT = 50      # عدد النتائج الافتراضي في الصفحة الواحدة
+SEARCH_MAX_LIMIT = 200         # أقصى عدد نتائج مسموح به في الصفحة
+SEARCH_CACHE_SIZE = int(os.environ.get("SEARCH_CACHE_SIZE", 1024))  # عدد نتائج البحث المحفوظة في الذاكرة
+
+# أقصى انتظار لنتيجة عمل متطابق جارٍ (single-flight) قبل التنفيذ المستقل أو الخطأ (بالثواني)
+DB_FLIGHT_TIMEOUT = float(os.environ.get("DB_FLIGHT_TIMEOUT", 10))
+CHAT_FLIGHT_TIMEOUT = float(os.environ.get("CHAT_FLIGHT_TIMEOUT", 60))
+
+# إعدادات كاش إجابات الذكاء الاصطناعي
+CHAT_CACHE_SIZE = int(os.environ.get("CHAT_CACHE_SIZE", 512))     # عدد الإجابات المحفوظة
+CHAT_CACHE_TTL = float(os.environ.get("CHAT_CACHE_TTL", 3600))    # مدة صلاحية الإجابة (بالثواني)
+
+# إعدادات سجل المحادثات المحفوظ في السيرفر
+CHAT_MAX_MESSAGES = int(os.environ.get("CHAT_MAX_MESSAGES", 12))   # أقصى عدد رسائل تُرسل كما هي
+CHAT_MAX_CHARS = int(os.environ.get("CHAT_MAX_CHARS", 8000))        # ميزانية الرسائل بالحروف (~4 حروف لكل token)
+CHAT_SUMMARY_MAX_CHARS = 1500                                      # أقصى طول لملخص الرسائل القديمة
+CHAT_TTL = float(os.environ.get("CHAT_TTL", 24 * 3600))            # مدة صلاحية المحادثة بدون نشاط (بالثواني)
+
+# اختيار الفنادق المرسلة للذكاء الاصطناعي حسب السؤال (بدلاً من إرسال الكتالوج كاملاً)
+CHAT_CONTEXT_HOTELS = int(os.environ.get("CHAT_CONTEXT_HOTELS", 30))   # أقصى عدد فنادق في التعليمات
+CHAT_CONTEXT_NAME_MATCHES = 10                                      # أقصى عدد فنادق مذكورة بالاسم
+CHAT_CONTEXT_CITIES = 40                                            # أقصى عدد مدن في قائمة المدن المتاحة
+CHAT_CONTEXT_CACHE_SIZE = int(os.environ.get("CHAT_CONTEXT_CACHE_SIZE", 1024))
+
+# أسماء المدن بالعربية (بعد التوحيد) -> اسم المدينة في جدول الفنادق
+CITY_ALIASES = {
+    "دبي": "Dubai", "القاهره": "Cairo", "الرياض": "Riyadh", "لندن": "London",
+    "جده": "Jeddah", "مكه": "Mecca", "المدينه": "Medina", "الاسكندريه": "Alexandria",
+    "ابوظبي": "Abu Dhabi", "الدوحه": "Doha", "باريس": "Paris", "اسطنبول": "Istanbul",
+}
+
+# كلمات نية المستخدم (بعد التوحيد): الأرخص أو الأفخم (الافتراضي: الأعلى تقييماً)
+CHAT_CHEAP_WORDS = {"رخيص", "رخيصه", "ارخص", "اقتصادي", "اقتصاديه", "cheap", "cheapest", "budget", "affordable"}
+CHAT_LUXURY_WORDS = {"فاخر", "فاخره", "فخم", "فخمه", "غالي", "اغلي", "luxury", "expensive", "premium"}
+# كلمات شائعة لا تُستخدم في البحث عن أسماء الفنادق
+CHAT_STOP_WORDS = {
+    "فندق", "فنادق", "في", "من", "الي", "علي", "عن", "ما", "هو", "هي", "هل", "اريد", "ابحث", "عندكم",
+    "لي", "مع", "او", "و", "كم", "سعر", "ليله", "hotel", "hotels", "in", "the", "a", "an", "and", "or",
+    "for", "to", "of", "is", "what", "which", "me", "price", "night", "stay", "want", "find", "show",
+}
+
+# إعدادات مهام تحليل الحجوزات في الخلفية
+ANALYSIS_WORKERS = int(os.environ.get("ANALYSIS_WORKERS", 4))          # عدد العمال المتوازيين
+ANALYSIS_MAX_PENDING = int(os.environ.get("ANALYSIS_MAX_PENDING", 32))  # أقصى عدد مهام في الانتظار
+ANALYSIS_TIMEOUT = float(os.environ.get("ANALYSIS_TIMEOUT", 60))       # مهلة المهمة الواحدة (بالثواني)
+ANALYSIS_JOB_TTL = 600                                                # مدة الاحتفاظ بنتيجة المهمة في الذاكرة
+
+# حدود استخدام الذكاء الاصطناعي: token bucket = (عدد الطلبات في الدقيقة، أقصى دفعة متتالية)
+CHAT_RATE_LIMIT = (float(os.environ.get("CHAT_RATE_PER_MIN", 10)), 5)          # لكل مستخدم أو جلسة
+CHAT_IP_RATE_LIMIT = (float(os.environ.get("CHAT_IP_RATE_PER_MIN", 30)), 10)   # لكل عنوان IP
+ANALYZE_RATE_LIMIT = (float(os.environ.get("ANALYZE_RATE_PER_MIN", 5)), 3)     # لكل مستخدم
+RATE_LIMIT_MAX_KEYS = 100_000                                                 # أقصى عدد مفاتيح محفوظة لكل محدد
+GEMINI_MAX_CONCURRENT = int(os.environ.get("GEMINI_MAX_CONCURRENT", 8))        # أقصى عدد استدعاءات Gemini متزامنة
+GEMINI_QUEUE_TIMEOUT = float(os.environ.get("GEMINI_QUEUE_TIMEOUT", 5))        # أقصى انتظار لمكان شاغر (بالثواني)
+
+# إعدادات كاش المستخدمين (يُستخدم في load_user مع كل طلب)
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", 4096))
+USER_CACHE_TTL = float(os.environ.get("USER_CACHE_TTL", 300))
+
+# إعدادات تشفير كلمات المرور
+# PASSWORD_HASH_METHOD: scrypt أو pbkdf2، PASSWORD_HASH_COST: قيمة n لـ scrypt أو عدد التكرارات لـ pbkdf2
+PASSWORD_HASH_METHOD = os.environ.get("PASSWORD_HASH_METHOD", "scrypt")
+PASSWORD_HASH_COST = int(os.environ.get("PASSWORD_HASH_COST", 0))  # 0 = القيمة الافتراضية لـ Werkzeug
+# عدد العمليات المخصصة للتشفير (0 = التشفير داخل نفس الـ thread)
+PASSWORD_HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", min(4, os.cpu_count() or 1)))
+# العمليات لا تُنشأ بـ fork: العملية الرئيسية فيها threads (الكتابة، المهام، Flask) وقد ترث العملية الجديدة
+# أقفالاً محجوزة. forkserver يبدأ العمليات من عملية خادم بدون threads (و spawn حيث لا يتوفر)
+PASSWORD_POOL_START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+# إعدادات قائمة الحجوزات
+BOOKINGS_DEFAULT_LIMIT = 50    # عدد الحجوزات الافتراضي في الصفحة الواحدة
+BOOKINGS_MAX_LIMIT = 200       # أقصى عدد حجوزات في الصفحة
+# الأعمدة المسموح بطلبها عبر fields= (العمود id يُرجع دائماً لأنه مؤشر الصفحة)
+BOOKING_FIELDS = (
+    "id", "user_id", "user_name", "hotel_name", "city",
+    "check_in", "check_out", "price", "hotel_image_url", "room_type_id"
+)
+
+# إعدادات الإكمال التلقائي للبحث
+AUTOCOMPLETE_DEFAULT_LIMIT = 8
+AUTOCOMPLETE_MAX_LIMIT = 20
+AUTOCOMPLETE_CACHE_SIZE = int(os.environ.get("AUTOCOMPLETE_CACHE_SIZE", 4096))
+# rowid الفندق في hotels_rank_fts: التقييم تنازلياً (بدقة 0.01) في البتات العليا ورقم الفندق في السفلى،
+# فترتيب rowid هو ترتيب النتائج ويتوقف الفهرس بعد أول LIMIT تطابق بدلاً من ترتيب كل التطابقات
+AUTOCOMPLETE_RANK_KEY = "((500 - MAX(0, MIN(500, CAST(ROUND({row}rating * 100) AS INTEGER)))) << 32) | {row}id"
+
+# إعدادات البحث الجغرافي
+NEARBY_DEFAULT_LIMIT = 20
+NEARBY_MAX_LIMIT = 100
+NEARBY_START_RADIUS_KM = 2        # نصف القطر الأول عند البحث عن الأقرب بدون تحديد مسافة
+NEARBY_MAX_RADIUS_KM = 1000       # أقصى نصف قطر للبحث
+EARTH_RADIUS_KM = 6371.0
+
+# إعدادات استيراد كتالوج الفنادق
+IMPORT_CHUNK_SIZE = int(os.environ.get("IMPORT_CHUNK_SIZE", 5000))   # عدد الصفوف في كل transaction
+IMPORT_DEFER_INDEXES_BYTES = 5 * 1024 * 1024    # الملفات الأكبر من هذا الحجم تؤجل بناء الفهارس (سطر الأوامر فقط)
+IMPORT_API_CHUNK_SIZE = 500                     # حجم الدفعة في الاستيراد عبر الـ API (عملية قصيرة في خيط الكتابة)
+IMPORT_MAX_ERRORS = 20                          # عدد أخطاء الصفوف المعروضة في التقرير
+CATALOG_IMPORT_TOKEN = os.environ.get("CATALOG_IMPORT_TOKEN")   # مطلوب لاستخدام API الاستيراد
+
+# إعدادات الغرف والتوفر
+DEFAULT_ROOMS_PER_HOTEL = int(os.environ.get("DEFAULT_ROOMS_PER_HOTEL", 10))  # غرف النوع الافتراضي لكل فندق
+MAX_STAY_NIGHTS = 30           # أقصى عدد ليالٍ في الحجز الواحد
+
+# أخطاء الحجز: الكود -> (الرسالة، كود HTTP)
+BOOKING_ERRORS = {
+    "dates": ("تواريخ الحجز غير صالحة", 400),
+    "room_type": ("نوع الغرفة غير صالح لهذا الفندق", 400),
+    "sold_out": ("لا توجد غرف متاحة في هذه التواريخ", 409),
+    "db": ("فشل في إضافة الحجز", 500),
+    "busy": ("الخدمة مشغولة حالياً، حاول لاحقاً", 503),
+}
+
+# خيارات الترتيب المدعومة: الاسم -> (العمود، الاتجاه)
+SEARCH_SORTS = {
+    "default": ("id", "ASC"),
+    "price_asc": ("price", "ASC"),
+    "price_desc": ("price", "DESC"),
+    "rating_desc": ("rating", "DESC"),
+    "rating_asc": ("rating", "ASC"),
+}
 
 # المسار الأساسي للمشروع
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
+# ملف الفنادق الافتراضية (يُستورد عند إنشاء قاعدة بيانات فارغة)
+SEED_CATALOG_FILE = os.path.join(BASE_DIR, 'data', 'hotels.csv')
+
 # مسار ملفات الـ static
 STATIC_DIR = os.path.join(BASE_DIR, 'static',)
 
 # إنشاء تطبيق Flask
 app = Flask(__name__, static_folder=STATIC_DIR, static_url_path='')
 
+# ملف manifest لصور الفنادق المصغرة (يُنشأ بواسطة build_images.py)
+IMAGE_MANIFEST_FILE = os.path.join(STATIC_DIR, 'image', 'build', 'manifest.json')
+
+# الملفات الثابتة التي تُضغط مسبقاً (الصور مضغوطة أصلاً فتُعطى بصمة فقط)
+COMPRESSIBLE_ASSET_TYPES = ('.html', '.js', '.css', '.svg', '.json', '.txt')
+ASSET_MAX_AGE = 365 * 24 * 3600   # مدة التخزين في المتصفح للملفات ذات البصمة
+# أقل مدة بين فحصين لتعديل الملفات الثابتة (بالثواني) خارج وضع التطوير؛ في وضع التطوير تُفحص مع كل طلب
+ASSET_CHECK_SECONDS = float(os.environ.get("ASSET_CHECK_SECONDS", 60))
+
+# ضغط استجابات الـ API الكبيرة (بالبايت)
+JSON_COMPRESS_MIN_BYTES = int(os.environ.get("JSON_COMPRESS_MIN_BYTES", 1024))
+JSON_COMPRESS_LEVEL = 6
+
 # مفتاح أمان الجلسات
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'kjgtuyf*ytdS$rtyuf/fu675e65d')
 
@@ -111,131 +322,1667 @@ def load_user(user_id):
     return db_manager.get_user_by_id(user_id)
 
 # ----------------------------------------------------
-# 5. كلاس إدارة قاعدة البيانات
+# تشفير كلمات المرور في عمليات منفصلة
+# ----------------------------------------------------
+# التشفير ثقيل على المعالج ويحجز الـ GIL، لذا يعمل في ProcessPool حتى لا يبطئ باقي الطلبات
+
+_password_pool = None
+_password_pool_lock = threading.Lock()
+
+# صيغة طريقة التشفير الحالية كما تكتبها Werkzeug في بداية الهاش (مثل scrypt:32768:8:1)
+def password_hash_method():
+    if PASSWORD_HASH_METHOD == "pbkdf2":
+        return f"pbkdf2:sha256:{PASSWORD_HASH_COST or 1_000_000}"
+    return f"scrypt:{PASSWORD_HASH_COST or 32768}:8:1"
+
+def _get_password_pool():
+    global _password_pool
+    if PASSWORD_HASH_WORKERS <= 0:
+        return None
+    with _password_pool_lock:
+        if _password_pool is None:
+            _password_pool = ProcessPoolExecutor(
+                max_workers=PASSWORD_HASH_WORKERS,
+                mp_context=multiprocessing.get_context(PASSWORD_POOL_START_METHOD)
+            )
+        return _password_pool
+
+# تنفيذ دالة التشفير في الـ pool (أو مباشرة إذا كان الـ pool معطلاً)
+def _run_password_task(fn, *args):
+    global _password_pool
+    pool = _get_password_pool()
+    if pool is None:
+        return fn(*args)
+    try:
+        return pool.submit(fn, *args).result()
+    except BrokenProcessPool:
+        # إغلاق الـ pool التالف (وعملياته المتبقية) قبل استبداله بآخر عند الطلب التالي
+        with _password_pool_lock:
+            if _password_pool is pool:
+                _password_pool = None
+        pool.shutdown(wait=False, cancel_futures=True)
+        return fn(*args)
+
+def hash_password(password):
+    return _run_password_task(generate_password_hash, password, password_hash_method())
+
+def verify_password(password_hash, password):
+    return _run_password_task(check_password_hash, password_hash, password)
+
+# هل الهاش المحفوظ بإعدادات قديمة (طريقة أو تكلفة مختلفة)؟
+def password_needs_rehash(password_hash):
+    return password_hash.split("$", 1)[0] != password_hash_method()
+
+# ----------------------------------------------------
+# 5. مقاييس الأداء (Prometheus)
+# ----------------------------------------------------
+
+# حدود خانات المدرج التكراري للأزمنة (بالثواني)
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# سجل مقاييس داخل الذاكرة بصيغة Prometheus النصية
+# التسجيل = قفل + عملية على قاموس (بضع ميكروثانيات) فيمكن تركه مفعلاً في الإنتاج
+class Metrics:
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._meta = {}              # name -> (type, help)
+        self._counters = {}          # (name, labels) -> value
+        self._histograms = {}        # (name, labels) -> [عدد كل خانة..., +Inf, المجموع]
+        self._collectors = []        # دوال تُستدعى عند القراءة وترجع (name, labels, value)
+
+    def describe(self, name, kind, help_text):
+        self._meta[name] = (kind, help_text)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            histogram[index] += 1
+            histogram[-1] += value
+
+    # قياس زمن تنفيذ كتلة with
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    # تغليف دالة بقياس زمنها
+    def timed(self, name, func, **labels):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.observe(name, time.perf_counter() - start, **labels)
+        return wrapper
+
+    # مقاييس تُقرأ وقت الطلب (مثل إحصائيات الكاش ومجمع الاتصالات)
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    def render(self):
+        samples = {}
+        with self._lock:
+            for (name, labels), value in self._counters.items():
+                samples.setdefault(name, []).append((name, labels, value))
+            for (name, labels), histogram in self._histograms.items():
+                rows = samples.setdefault(name, [])
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float('inf'),), histogram):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    rows.append((f"{name}_bucket", labels + (('le', le),), cumulative))
+                rows.append((f"{name}_sum", labels, histogram[-1]))
+                rows.append((f"{name}_count", labels, cumulative))
+        for collector in self._collectors:
+            for name, labels, value in collector():
+                samples.setdefault(name, []).append((name, tuple(sorted(labels.items())), value))
+
+        lines = []
+        for name in sorted(samples):
+            kind, help_text = self._meta.get(name, ('untyped', ''))
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for sample, labels, value in samples[name]:
+                label_text = ",".join(f'{k}="{metric_label(v)}"' for k, v in labels)
+                lines.append(f"{sample}{{{label_text}}} {value}" if label_text else f"{sample} {value}")
+        return "\n".join(lines) + "\n"
+
+# تهريب قيم الـ labels حسب صيغة Prometheus
+def metric_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+metrics = Metrics()
+for _name, _kind, _help in (
+    ("http_requests_total", "counter", "HTTP requests by route, method and status"),
+    ("http_request_duration_seconds", "histogram", "HTTP request latency by route (until headers for streams)"),
+    ("db_method_duration_seconds", "histogram", "Time spent in DBManager methods"),
+    ("db_pool_connections_opened_total", "counter", "SQLite connections opened by the pool"),
+    ("db_pool_waits_total", "counter", "Times a request waited for a pooled connection"),
+    ("db_pool_connections_open", "gauge", "SQLite connections currently open"),
+    ("db_write_ops_total", "counter", "Write operations committed by the writer thread"),
+    ("db_write_batches_total", "counter", "Group-committed write transactions"),
+    ("db_write_rejected_total", "counter", "Writes rejected because the write queue was full"),
+    ("db_write_queue_pending", "gauge", "Writes waiting in the write queue"),
+    ("gemini_request_duration_seconds", "histogram", "Gemini call latency by operation"),
+    ("gemini_failures_total", "counter", "Failed Gemini calls by operation"),
+    ("gemini_tokens_total", "counter", "Gemini tokens by operation and kind"),
+    ("rate_limited_total", "counter", "Requests rejected by rate or concurrency limits"),
+    ("single_flight_leaders_total", "counter", "Coalesced work executed (one per group of identical requests)"),
+    ("single_flight_shared_total", "counter", "Requests that reused an in-flight identical result"),
+    ("cache_hits_total", "counter", "In-memory cache hits"),
+    ("cache_misses_total", "counter", "In-memory cache misses"),
+    ("cache_hit_ratio", "gauge", "In-memory cache hit ratio since start"),
+    ("cache_entries", "gauge", "Entries currently held by the cache"),
+):
+    metrics.describe(_name, _kind, _help)
+
+# ----------------------------------------------------
+# 6. كاش داخل الذاكرة (LRU + TTL)
+# ----------------------------------------------------
+
+class LRUCache:
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl                  # None = بدون انتهاء صلاحية
+        self._data = OrderedDict()      # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # جلب قيمة من الكاش (أو default إذا لم توجد أو انتهت صلاحيتها)
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                expires_at, value = item
+                if expires_at is None or expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    # حفظ قيمة في الكاش مع حذف الأقدم عند الامتلاء
+    def set(self, key, value):
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    # إحصائيات الكاش
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            }
+
+# تنفيذ واحد للعمل المتطابق المتزامن (single-flight):
+# أول طلب لمفتاح ما ينفذ العمل، والطلبات المتطابقة التي تصل أثناء تنفيذه تنتظر نتيجته (أو خطأه)
+# بدلاً من تكرار نفس الاستعلام أو استدعاء Gemini. الانتظار محدود بمهلة (TimeoutError)
+class SingleFlight:
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self._calls = {}                # key -> Future للتنفيذ الجاري
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.shared = 0
+
+    # يرجع (future، هل هذا الطلب هو المنفذ)؛ المنفذ يجب أن يستدعي finish دائماً
+    def claim(self, key):
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                self.shared += 1
+                return future, False
+            future = self._calls[key] = Future()
+            self.leaders += 1
+            return future, True
+
+    def finish(self, key, future, result=None, error=None):
+        with self._lock:
+            if self._calls.get(key) is future:
+                del self._calls[key]
+        if future.done():
+            return
+        if error is None:
+            future.set_result(result)
+        else:
+            future.set_exception(error)
+
+    # تنفيذ fn مرة واحدة لكل مجموعة طلبات متزامنة بنفس المفتاح
+    def do(self, key, fn):
+        future, leader = self.claim(key)
+        if not leader:
+            return future.result(self.timeout)
+        try:
+            result = fn()
+        except Exception as e:
+            self.finish(key, future, error=e)
+            raise
+        self.finish(key, future, result)
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {"leaders": self.leaders, "shared": self.shared, "in_flight": len(self._calls)}
+
+# ----------------------------------------------------
+# 7. طابور المهام في الخلفية
+# ----------------------------------------------------
+
+class JobQueue:
+    def __init__(self, workers, max_pending, timeout, ttl=ANALYSIS_JOB_TTL):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="restavo-job")
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.ttl = ttl
+        self._jobs = {}                  # job_id -> بيانات المهمة
+        self._lock = threading.Lock()
+
+    # إضافة مهمة جديدة (يرجع None إذا كان الطابور ممتلئاً)
+    def submit(self, fn, *args, owner=None):
+        with self._lock:
+            self._purge_finished()
+            active = sum(1 for job in self._jobs.values() if job["status"] in ("pending", "running"))
+            if active >= self.max_pending:
+                return None
+            job_id = uuid.uuid4().hex
+            self._jobs[job_id] = {
+                "status": "pending", "owner": owner, "result": None, "error": None,
+                "created_at": time.monotonic(), "started_at": None, "finished_at": None,
+            }
+        self._executor.submit(self._run, job_id, fn, args)
+        return job_id
+
+    def _run(self, job_id, fn, args):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job["status"] != "pending":
+                return
+            job["status"] = "running"
+            job["started_at"] = time.monotonic()
+        try:
+            result, status, error = fn(*args), "done", None
+        except Exception as e:
+            result, status, error = None, "error", str(e) or e.__class__.__name__
+        with self._lock:
+            # إذا انتهت المهلة أثناء التنفيذ تبقى المهمة فاشلة
+            if job["status"] == "running":
+                job.update(status=status, result=result, error=error, finished_at=time.monotonic())
+
+    # حالة المهمة (None إذا لم توجد أو تخص مستخدماً آخر)
+    def get(self, job_id, owner=None):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job["owner"] != owner:
+                return None
+            now = time.monotonic()
+            if job["status"] in ("pending", "running") and now - job["created_at"] > self.timeout:
+                job.update(status="error", error="timeout", finished_at=now)
+            return {"status": job["status"], "result": job["result"], "error": job["error"]}
+
+    # حذف المهام المنتهية منذ أكثر من ttl
+    def _purge_finished(self):
+        now = time.monotonic()
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job["finished_at"] is not None and now - job["finished_at"] > self.ttl]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+# ----------------------------------------------------
+# 8. تحديد معدل الطلبات والتزامن
 # ----------------------------------------------------
 
+# token bucket لكل مفتاح (مستخدم، جلسة، IP): الرصيد يمتلئ بمعدل ثابت حتى حد الدفعة
+# المفاتيح الأقدم استخداماً تُحذف عند تجاوز الحد حتى لا تكبر الذاكرة
+class RateLimiter:
+    def __init__(self, per_minute, burst, max_keys=RATE_LIMIT_MAX_KEYS):
+        self.rate = per_minute / 60.0
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()    # key -> (tokens, last_refill)
+        self._lock = threading.Lock()
+
+    # استهلاك طلب واحد؛ يرجع 0 إذا سُمح به، وإلا عدد الثواني حتى يتوفر رصيد
+    def acquire(self, key):
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now)
+                retry_after = 0
+            else:
+                self._buckets[key] = (tokens, now)
+                retry_after = (1 - tokens) / self.rate if self.rate else 60
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return retry_after
+
+# لا يوجد مكان شاغر لاستدعاء Gemini خلال مهلة الانتظار
+class LLMBusy(Exception):
+    pass
+
+# حد أقصى للاستدعاءات المتزامنة: الطلب الزائد ينتظر مكاناً حتى المهلة ثم يُرفض
+class ConcurrencyLimiter:
+    def __init__(self, limit, timeout):
+        self.limit = limit
+        self.timeout = timeout
+        self._semaphore = threading.BoundedSemaphore(limit)
+
+    def acquire(self):
+        if not self._semaphore.acquire(timeout=self.timeout):
+            raise LLMBusy()
+
+    def release(self):
+        self._semaphore.release()
+
+    @contextmanager
+    def slot(self):
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+# ----------------------------------------------------
+# 9. مجمع اتصالات قاعدة البيانات
+# ----------------------------------------------------
+
+# سجل الاستعلامات البطيئة مع خطة التنفيذ (EXPLAIN QUERY PLAN) لكل استعلام
+# لا تُحفظ قيم المعاملات (قد تحتوي بيانات المستخدمين)، والخطة تُحسب مرة واحدة لكل استعلام
+# على اتصال مستقل حتى لا تتداخل مع transaction الاتصال الأصلي
+class SlowQueryLog:
+    def __init__(self, db_file, threshold_ms, max_statements=SLOW_QUERY_MAX_STATEMENTS):
+        self.db_file = db_file
+        self.threshold = threshold_ms / 1000
+        self.max_statements = max_statements
+        self._entries = {}            # SQL بعد توحيد المسافات -> الإحصائيات
+        self._lock = threading.Lock()
+        self._explain_conn = None
+
+    def record(self, sql, elapsed):
+        if elapsed < self.threshold:
+            return
+        sql = " ".join(sql.split())
+        with self._lock:
+            entry = self._entries.get(sql)
+            if entry is None:
+                if len(self._entries) >= self.max_statements:
+                    return
+                entry = self._entries[sql] = {
+                    "sql": sql, "count": 0, "total_ms": 0.0, "max_ms": 0.0, "plan": None, "full_scan": False,
+                }
+            entry["count"] += 1
+            entry["total_ms"] += elapsed * 1000
+            entry["max_ms"] = max(entry["max_ms"], elapsed * 1000)
+            if entry["plan"] is None:
+                entry["plan"] = self._explain(sql)
+                entry["full_scan"] = any(is_full_scan(line) for line in entry["plan"])
+
+    # خطة التنفيذ بقيم NULL بدلاً من المعاملات (الخطة لا تعتمد على القيم)
+    def _explain(self, sql):
+        if sql.split(' ', 1)[0].upper() not in ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH', 'REPLACE'):
+            return []
+        try:
+            if self._explain_conn is None:
+                self._explain_conn = sqlite3.connect(self.db_file, check_same_thread=False)
+            rows = self._explain_conn.execute(f"EXPLAIN QUERY PLAN {sql}", [None] * sql.count('?')).fetchall()
+            return [row[3] for row in rows]
+        except sqlite3.Error as e:
+            return [f"EXPLAIN failed: {e}"]
+
+    # أسوأ الاستعلامات مرتبة بالزمن الكلي أو الأقصى
+    def top(self, limit=20, sort="total_ms"):
+        with self._lock:
+            entries = [dict(e, plan=list(e["plan"] or [])) for e in self._entries.values()]
+        entries.sort(key=lambda e: e[sort], reverse=True)
+        for entry in entries[:limit]:
+            entry["total_ms"] = round(entry["total_ms"], 3)
+            entry["max_ms"] = round(entry["max_ms"], 3)
+        return entries[:limit]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def close(self):
+        with self._lock:
+            if self._explain_conn is not None:
+                self._explain_conn.close()
+                self._explain_conn = None
+
+# سطر خطة يمسح الجدول كاملاً (SCAN بدون فهرس، وليس جدولاً افتراضياً مثل FTS أو R-tree)
+def is_full_scan(plan_line):
+    return plan_line.startswith("SCAN ") and "USING" not in plan_line and "VIRTUAL TABLE" not in plan_line
+
+# مؤشر يقيس زمن كل استعلام (التنفيذ + جلب الصفوف) ويسجله عند انتهائه
+class ProfiledCursor(sqlite3.Cursor):
+    _sql = None
+    _elapsed = 0.0
+
+    def _timed(self, method, *args):
+        start = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            self._elapsed += time.perf_counter() - start
+
+    def _finish(self):
+        if self._sql is not None:
+            self.connection.slow_log.record(self._sql, self._elapsed)
+            self._sql = None
+
+    def execute(self, sql, parameters=()):
+        self._finish()
+        self._sql, self._elapsed = sql, 0.0
+        self._timed(super().execute, sql, parameters)
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        self._finish()
+        self._sql, self._elapsed = sql, 0.0
+        self._timed(super().executemany, sql, seq_of_parameters)
+        return self
+
+    def fetchone(self):
+        return self._timed(super().fetchone)
+
+    def fetchmany(self, size=None):
+        return self._timed(super().fetchmany, self.arraysize if size is None else size)
+
+    def fetchall(self):
+        rows = self._timed(super().fetchall)
+        self._finish()
+        return rows
+
+    def __next__(self):
+        try:
+            return self._timed(super().__next__)
+        except StopIteration:
+            self._finish()
+            raise
+
+    def close(self):
+        self._finish()
+        super().close()
+
+    def __del__(self):
+        try:
+            self._finish()
+        except Exception:
+            pass
+
+# اتصال تستخدم كل مؤشراته ProfiledCursor
+# (conn.execute في sqlite3 لا يمر عبر cursor() لذلك نعيد تعريفه أيضاً)
+class ProfiledConnection(sqlite3.Connection):
+    slow_log = None
+
+    def cursor(self, factory=ProfiledCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+class ConnectionPool:
+    def __init__(self, db_file, size=DB_POOL_SIZE, timeout=DB_POOL_TIMEOUT, slow_log=None):
+        self.db_file = db_file
+        self.size = max(1, int(size))
+        self.timeout = timeout
+        self.slow_log = slow_log
+        self._idle = queue.LifoQueue()   # LIFO: نعيد استخدام أحدث اتصال (صفحاته ساخنة في الكاش)
+        self._lock = threading.Lock()
+        self._open_count = 0
+        self._closed = False
+        # إحصائيات: hits = اتصال جاهز، waits = انتظار اتصال، opens = اتصال جديد
+        self._stats = {"hits": 0, "waits": 0, "opens": 0}
+
+    # فتح اتصال جديد مع إعدادات الأداء
+    def _open(self):
+        conn = sqlite3.connect(
+            self.db_file,
+            check_same_thread=False,
+            timeout=self.timeout,
+            cached_statements=DB_STATEMENT_CACHE,
+            factory=ProfiledConnection if self.slow_log else sqlite3.Connection
+        )
+        if self.slow_log:
+            conn.slow_log = self.slow_log
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+        conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
+
+    # اتصال مستقل خارج المجمع بنفس الإعدادات (لخيط الكتابة)
+    def open_dedicated(self):
+        return self._open()
+
+    # حجز اتصال من المجمع
+    def _acquire(self):
+        try:
+            conn = self._idle.get_nowait()
+            with self._lock:
+                self._stats["hits"] += 1
+            return conn
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            can_open = self._open_count < self.size
+            if can_open:
+                self._open_count += 1
+                self._stats["opens"] += 1
+            else:
+                self._stats["waits"] += 1
+
+        if can_open:
+            try:
+                return self._open()
+            except Exception:
+                with self._lock:
+                    self._open_count -= 1
+                raise
+
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise sqlite3.OperationalError("انتهت مهلة انتظار اتصال متاح بقاعدة البيانات")
+
+    # إرجاع الاتصال إلى المجمع (مع إلغاء أي معاملة غير مكتملة)
+    def _release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        if self._closed:
+            conn.close()
+            with self._lock:
+                self._open_count -= 1
+            return
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self._acquire()
+        try:
+            yield conn
+        finally:
+            try:
+                self._release(conn)
+            except sqlite3.Error:
+                # الاتصال تالف: نغلقه ونسمح بفتح غيره
+                conn.close()
+                with self._lock:
+                    self._open_count -= 1
+
+    # إحصائيات المجمع
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, size=self.size, open=self._open_count, idle=self._idle.qsize())
+
+    # إغلاق كل الاتصالات الخاملة
+    def close(self):
+        self._closed = True
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._open_count -= 1
+
+# طابور الكتابة ممتلئ (ضغط عكسي): المستدعي يرجع "الخدمة مشغولة" بدلاً من تراكم الطلبات
+class WriteQueueFull(Exception):
+    pass
+
+# خيط الكتابة متوقف أو لم يُنهِ العملية خلال المهلة: يُعامل مثل الطابور الممتلئ ("الخدمة مشغولة")
+class WriterUnavailable(WriteQueueFull):
+    pass
+
+# خيط كتابة واحد يجمع عمليات الكتابة المنتظرة في transaction واحدة (group commit)
+# بدلاً من تنافس كل الـ threads على قفل الكتابة وعمل commit لكل عملية.
+# كل عملية دالة fn(cursor) تعمل داخل SAVEPOINT خاص بها: فشلها يلغي تغييراتها فقط،
+# ونتيجتها أو خطؤها يرجع لمستدعيها بعد نجاح الـ commit
+class WriteQueue:
+    def __init__(self, connect, max_pending=WRITE_QUEUE_MAX, max_batch=WRITE_BATCH_SIZE,
+                 timeout=WRITE_QUEUE_TIMEOUT, result_timeout=WRITE_RESULT_TIMEOUT):
+        self._connect = connect
+        self._queue = queue.Queue(maxsize=max_pending)
+        self.max_batch = max_batch
+        self.timeout = timeout
+        self.result_timeout = result_timeout
+        self._stopped = None  # سبب توقف خيط الكتابة (None = يعمل)
+        self._lock = threading.Lock()
+        self._stats = {"ops": 0, "batches": 0, "rejected": 0}
+        self._thread = threading.Thread(target=self._run, name="restavo-writer", daemon=True)
+        self._thread.start()
+
+    # إضافة عملية كتابة للطابور (يرفع WriteQueueFull إذا بقي الطابور ممتلئاً طوال المهلة)
+    def submit(self, fn):
+        if self._stopped is not None:
+            raise WriterUnavailable(self._stopped)
+        future = Future()
+        try:
+            self._queue.put((fn, future), timeout=self.timeout)
+        except queue.Full:
+            with self._lock:
+                self._stats["rejected"] += 1
+            raise WriteQueueFull()
+        if self._stopped is not None:
+            # توقف الخيط أثناء الإضافة: لا أحد سيقرأ الطابور بعد الآن
+            self._fail_pending()
+        return future
+
+    # تنفيذ عملية كتابة وانتظار نتيجتها (أو رفع الخطأ الذي حدث فيها)
+    # عند انتهاء المهلة تُلغى العملية إذا لم تبدأ بعد، فالفشل المُبلغ للمستدعي يعني أنه لم يُكتب شيء
+    def execute(self, fn):
+        future = self.submit(fn)
+        try:
+            return future.result(self.result_timeout)
+        except FuturesTimeoutError:
+            if future.cancel():
+                raise WriterUnavailable("write did not start in time")
+            # بدأت العملية فعلاً: نتيجتها (commit أو خطأ) تصل مع انتهاء الـ transaction الحالية
+            return future.result()
+
+    def _run(self):
+        try:
+            conn = self._connect()
+        except Exception as e:
+            self._stop(e)
+            return
+        running = True
+        try:
+            while running:
+                batch = [self._queue.get()]
+                # كل ما تراكم أثناء الـ transaction السابقة يدخل في الـ transaction التالية
+                while len(batch) < self.max_batch:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                if None in batch:
+                    running = False
+                    batch = [item for item in batch if item is not None]
+                if batch:
+                    self._commit_batch(conn, batch)
+        except Exception as e:
+            self._stop(e)
+            raise
+        finally:
+            conn.close()
+        self._stop("writer closed")
+
+    # إيقاف الطابور: العمليات المنتظرة والجديدة تفشل فوراً بدلاً من الانتظار للأبد
+    def _stop(self, reason):
+        self._stopped = reason
+        self._fail_pending()
+
+    def _fail_pending(self):
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if item is not None and item[1].set_running_or_notify_cancel():
+                item[1].set_exception(WriterUnavailable(self._stopped))
+
+    def _commit_batch(self, conn, batch):
+        results = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for fn, future in batch:
+                # العملية التي ألغاها مستدعيها (انتهت مهلة انتظاره) لا تُنفذ
+                if not future.set_running_or_notify_cancel():
+                    continue
+                conn.execute("SAVEPOINT write_op")
+                try:
+                    result, error = fn(conn.cursor()), None
+                    conn.execute("RELEASE write_op")
+                except Exception as e:
+                    result, error = None, e
+                    conn.execute("ROLLBACK TO write_op")
+                    conn.execute("RELEASE write_op")
+                results.append((future, result, error))
+            conn.commit()
+        except Exception as e:
+            # فشل الـ transaction كلها (مثلاً قاعدة البيانات مقفلة من عملية أخرى)
+            try:
+                conn.rollback()
+            except sqlite3.Error:
+                pass
+            for _, future in batch:
+                if future.running() or future.set_running_or_notify_cancel():
+                    future.set_exception(e)
+            return
+        with self._lock:
+            self._stats["ops"] += len(results)
+            self._stats["batches"] += 1
+        for future, result, error in results:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    # إحصائيات الطابور
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, pending=self._queue.qsize())
+
+    # إنهاء خيط الكتابة بعد تنفيذ ما في الطابور
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(timeout=5)
+
+# ----------------------------------------------------
+# 10. كلاس إدارة قاعدة البيانات
+# ----------------------------------------------------
+
+# قائمة ليالي الإقامة بصيغة YYYY-MM-DD (None إذا كانت التواريخ غير صالحة)
+def stay_nights(check_in, check_out):
+    try:
+        start = date.fromisoformat(check_in)
+        end = date.fromisoformat(check_out)
+    except (TypeError, ValueError):
+        return None
+    count = (end - start).days
+    if count < 1 or count > MAX_STAY_NIGHTS:
+        return None
+    return [(start + timedelta(days=i)).isoformat() for i in range(count)]
+
+# تاريخ المغادرة الموحد (اليوم التالي لآخر ليلة)
+def stay_end(nights):
+    return (date.fromisoformat(nights[-1]) + timedelta(days=1)).isoformat()
+
+# المسافة بين نقطتين على سطح الأرض (بالكيلومتر)
+def haversine_km(lat1, lng1, lat2, lng2):
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+# مربع الإحداثيات المحيط بدائرة نصف قطرها radius_km
+def bounding_box(lat, lng, radius_km):
+    dlat = radius_km / 111.32
+    dlng = radius_km / (111.32 * max(math.cos(math.radians(lat)), 0.01))
+    return max(lat - dlat, -90), min(lat + dlat, 90), max(lng - dlng, -180), min(lng + dlng, 180)
+
+# النسبة المئوية من قائمة مرتبة (مع الاستيفاء الخطي بين القيمتين المتجاورتين)
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    position = (len(sorted_values) - 1) * fraction
+    low = int(position)
+    high = min(low + 1, len(sorted_values) - 1)
+    return sorted_values[low] + (sorted_values[high] - sorted_values[low]) * (position - low)
+
+# مقارنة سعر ليلة (وتقييم الفندق إن وُجد) بإحصائيات مدينته
+# value_score = (التقييم / متوسط تقييم المدينة) ÷ (السعر / متوسط سعر المدينة): أكبر من 1 = قيمة أفضل من المتوسط
+def compare_price(price, rating, stats):
+    price = float(price)
+    mean = stats['mean']
+    if price <= stats['p25']:
+        band = "lowest_quarter"
+    elif price <= stats['p50']:
+        band = "below_median"
+    elif price <= stats['p75']:
+        band = "above_median"
+    else:
+        band = "highest_quarter"
+    value_score = None
+    if rating is not None and price > 0 and stats['avg_rating']:
+        value_score = round((rating / stats['avg_rating']) / (price / mean), 2)
+    return dict(
+        stats,
+        price=price,
+        rating=rating,
+        diff_pct=round((price - mean) / mean * 100, 1) if mean else 0.0,
+        band=band,
+        value_score=value_score,
+    )
+
+# تقسيم نص الإكمال التلقائي إلى كلمات بعد إزالة التشكيل العربي والتطويل
+ARABIC_MARKS = re.compile(r'[\u0610-\u061a\u064b-\u065f\u0670\u06d6-\u06ed\u0640]')
+
+def autocomplete_tokens(text):
+    if not text:
+        return []
+    text = ARABIC_MARKS.sub('', text.lower())
+    return re.findall(r'\w+', text)[:5]
+
+# توحيد كلمات سؤال المحادثة: بدون تشكيل، وتوحيد الألف والتاء المربوطة والألف المقصورة
+ARABIC_LETTERS = str.maketrans({"أ": "ا", "إ": "ا", "آ": "ا", "ة": "ه", "ى": "ي"})
+
+def chat_terms(text):
+    if not text:
+        return []
+    text = ARABIC_MARKS.sub('', text.lower()).translate(ARABIC_LETTERS)
+    return re.findall(r'\w+', text)
+
+# استخراج نية السؤال: الترتيب المطلوب وحدود السعر والتقييم
+# "أرخص فندق تحت 200" -> price ASC مع max_price=200، "4 نجوم" -> min_rating=4
+def chat_intent(text):
+    terms = set(chat_terms(text))
+    normalized = " ".join(chat_terms(text))
+    intent = {"sort": "rating", "max_price": None, "min_rating": None}
+    if terms & CHAT_CHEAP_WORDS:
+        intent["sort"] = "price_asc"
+    elif terms & CHAT_LUXURY_WORDS:
+        intent["sort"] = "price_desc"
+
+    budget = re.search(r'(?:under|below|less than|max|تحت|اقل من|لا يزيد عن|حتي|بحدود)\s*(\d+)', normalized)
+    if budget:
+        intent["max_price"] = float(budget.group(1))
+    stars = re.search(r'(\d(?:\s\d)?)\s*(?:نجوم|نجمات|نجمه|stars?)', normalized)
+    if stars:
+        intent["min_rating"] = min(float(stars.group(1).replace(" ", ".")), 5)
+    return intent
+
+# سطر فندق واحد في تعليمات الذكاء الاصطناعي
+def format_hotel_line(row):
+    return f"- {row['name']} في {row['city']} (السعر: ${row['price']}, التقييم: {row['rating']}⭐)"
+
+# قراءة صفوف ملف الكتالوج (CSV أو JSONL) كـ generator: (رقم السطر، القاموس)
+def read_catalog_rows(stream, fmt):
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row
+        return
+    for line_no, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        yield line_no, row if isinstance(row, dict) else None
+
+# التحقق من الصفوف وتحويلها إلى tuples جاهزة للإدخال، والصفوف الخاطئة تُسجل في errors
+def validate_catalog_rows(rows, errors):
+    for line_no, row in rows:
+        try:
+            if row is None:
+                raise ValueError("صيغة السطر غير صالحة")
+            name = str(row.get('name') or '').strip()
+            city = str(row.get('city') or '').strip()
+            if not name or not city:
+                raise ValueError("الاسم والمدينة مطلوبان")
+            price = float(row.get('price'))
+            rating = float(row.get('rating'))
+            if price < 0 or not 0 <= rating <= 5:
+                raise ValueError("السعر أو التقييم خارج النطاق")
+            lat, lng = row.get('latitude'), row.get('longitude')
+            if lat in (None, '') or lng in (None, ''):
+                lat = lng = None
+            else:
+                lat, lng = float(lat), float(lng)
+                if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+                    raise ValueError("إحداثيات غير صالحة")
+            image_url = str(row.get('image_url') or '').strip() or None
+        except (TypeError, ValueError) as e:
+            errors.append((line_no, str(e)))
+            continue
+        yield (name, city, price, rating, image_url, lat, lng)
+
+# تقسيم generator إلى دفعات بحجم ثابت
+def chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+# الفنادق المختارة لسؤال معين منسقة للذكاء الاصطناعي مع رقم نسخة جدول الفنادق وبصمة النص
+class CatalogSnapshot:
+    def __init__(self, version, context):
+        self.version = version
+        self.context = context
+        self.hash = hashlib.sha256(context.encode('utf-8')).hexdigest()
+
 class DBManager:
-    def __init__(self, db_file):
+    def __init__(self, db_file, pool_size=DB_POOL_SIZE, slow_query_ms=SLOW_QUERY_MS):
         self.db_file = db_file
-        self.init_db()
+        # سجل الاستعلامات البطيئة (None = غير مفعّل ولا يوجد أي قياس)
+        self.slow_queries = SlowQueryLog(db_file, slow_query_ms) if slow_query_ms is not None else None
+        self.pool = ConnectionPool(db_file, size=pool_size, slow_log=self.slow_queries)
+        # كاش نتائج البحث، يُفرّغ عند تغيّر نسخة جدول الفنادق
+        self.search_cache = LRUCache(maxsize=SEARCH_CACHE_SIZE)
+        self._search_cache_version = None
+        # دمج قراءات البحث والتوفر المتطابقة المتزامنة في استعلام واحد
+        self.read_flight = SingleFlight(DB_FLIGHT_TIMEOUT)
+        # كاش الإكمال التلقائي (المفتاح يحتوي رقم نسخة الفنادق)
+        self.autocomplete_cache = LRUCache(maxsize=AUTOCOMPLETE_CACHE_SIZE)
+        self.fts_enabled = False
+        self._city_index = None
+        # كاش بيانات المستخدمين: user_id -> (id, username, full_name, phone)
+        self.user_cache = LRUCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+        # كاش سياق الفنادق المختار للذكاء الاصطناعي (المفتاح يحتوي رقم نسخة الفنادق)
+        self.chat_context_cache = LRUCache(maxsize=CHAT_CONTEXT_CACHE_SIZE)
+        # الترحيلات (وأول PRAGMA journal_mode=WAL) تنتهي قبل بدء خيط الكتابة: فتح اتصاله مع أول اتصال
+        # بقاعدة بيانات جديدة في نفس اللحظة يفشل فوراً بـ "database is locked" ويوقف الخيط نهائياً
+        seed = self.init_db()
+        # كل عمليات الكتابة العادية تمر عبر خيط كتابة واحد (group commit)
+        self.writer = WriteQueue(self.pool.open_dedicated)
+        if seed:
+            self.seed_hotels()
 
-    # إنشاء اتصال بقاعدة البيانات
+    # حجز اتصال من المجمع (يعود للمجمع تلقائياً عند انتهاء with)
     def get_connection(self):
-        conn = sqlite3.connect(self.db_file, check_same_thread=False)
-        conn.row_factory = sqlite3.Row
-        # 🟢 (تعديل) إرجاع الاتصال داخل closing ليتم إغلاقه تلقائياً عند انتهاء with
-        return closing(conn)
+        return self.pool.connection()
+
+    # إغلاق اتصالات قاعدة البيانات
+    def close(self):
+        self.writer.close()
+        self.pool.close()
+        if self.slow_queries:
+            self.slow_queries.close()
 
     # إنشاء الجداول في قاعدة البيانات
+    # تهيئة قاعدة البيانات: تنفيذ الترحيلات (migrations) غير المطبقة فقط حسب PRAGMA user_version
+    # قاعدة البيانات المحدثة لا تنفذ أي DDL عند بدء التشغيل
+    # ترجع True لقاعدة بيانات جديدة (أو من إصدار قديم بدون ترقيم) تحتاج تعبئة الفنادق الافتراضية
     def init_db(self):
         with self.get_connection() as conn:
-            cursor = conn.cursor()
-
-            # جدول المستخدمين
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    username TEXT NOT NULL UNIQUE,
-                    password_hash TEXT NOT NULL,
-                    full_name TEXT,
-                    phone TEXT,
-                    age INTEGER       
-                )
-            ''')
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            migrated_from = None
+            if version < len(self.MIGRATIONS):
+                # قفل الكتابة حتى لا تنفذ عدة عمليات (workers) نفس الترحيل معاً
+                conn.execute("BEGIN IMMEDIATE")
+                version = conn.execute("PRAGMA user_version").fetchone()[0]
+                migrated_from = version
+                for target, migration in enumerate(self.MIGRATIONS[version:], version + 1):
+                    migration(self, conn.cursor())
+                    conn.execute(f"PRAGMA user_version = {target}")
+                conn.commit()
+            self.fts_enabled = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'hotels_fts'"
+            ).fetchone() is not None
+        return migrated_from == 0
+
+    # الترحيل 1: المخطط الكامل (آمن للتطبيق على قواعد البيانات القديمة قبل ترقيم الإصدارات)
+    def _migration_1_initial_schema(self, cursor):
+        # جدول المستخدمين
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                username TEXT NOT NULL UNIQUE,
+                password_hash TEXT NOT NULL,
+                full_name TEXT,
+                phone TEXT,
+                age INTEGER       
+            )
+        ''')
 
-            # إضافة أعمدة في حال كانت غير موجودة (للتوافق مع الإصدارات السابقة)
-            try:
-                cursor.execute("ALTER TABLE users ADD COLUMN full_name TEXT")
-            except sqlite3.OperationalError: pass
-            try:
-                cursor.execute("ALTER TABLE users ADD COLUMN phone TEXT")
-            except sqlite3.OperationalError: pass
-            try:
-                cursor.execute("ALTER TABLE users ADD COLUMN age INTEGER")
-            except sqlite3.OperationalError: pass
+        # إضافة أعمدة في حال كانت غير موجودة (للتوافق مع الإصدارات السابقة)
+        try:
+            cursor.execute("ALTER TABLE users ADD COLUMN full_name TEXT")
+        except sqlite3.OperationalError: pass
+        try:
+            cursor.execute("ALTER TABLE users ADD COLUMN phone TEXT")
+        except sqlite3.OperationalError: pass
+        try:
+            cursor.execute("ALTER TABLE users ADD COLUMN age INTEGER")
+        except sqlite3.OperationalError: pass
+
+        # جدول الحجوزات
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS bookings (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                user_name TEXT NOT NULL,
+                hotel_name TEXT NOT NULL,
+                city TEXT NOT NULL,
+                check_in TEXT NOT NULL,
+                check_out TEXT NOT NULL,
+                price REAL NOT NULL,
+                hotel_image_url TEXT,
+                FOREIGN KEY (user_id) REFERENCES users (id)
+            )
+        ''')
+
+        # فهرس مركب لجلب حجوزات المستخدم مرتبة بالأحدث دون مسح الجدول
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_bookings_user_id ON bookings (user_id, id)"
+        )
+
+        # جدول المفضلة
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS favorites (
+                user_id INTEGER NOT NULL,
+                item_name TEXT NOT NULL,
+                city TEXT NOT NULL,
+                added_at TEXT NOT NULL,
+                PRIMARY KEY (user_id, item_name),
+                FOREIGN KEY (user_id) REFERENCES users (id)
+            )
+        ''')
+
+        # جدول نتائج تحليل الحجوزات (نتيجة واحدة لكل حجز)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS booking_analyses (
+                booking_id INTEGER PRIMARY KEY,
+                result TEXT NOT NULL,
+                created_at TEXT NOT NULL,
+                FOREIGN KEY (booking_id) REFERENCES bookings (id)
+            )
+        ''')
+
+        # جدول المحادثات مع الذكاء الاصطناعي (الجلسة تحفظ المعرف فقط)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS chat_conversations (
+                id TEXT PRIMARY KEY,
+                summary TEXT NOT NULL DEFAULT '',
+                messages TEXT NOT NULL DEFAULT '[]',
+                updated_at REAL NOT NULL
+            )
+        ''')
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_chat_conversations_updated_at "
+            "ON chat_conversations (updated_at)"
+        )
+
+        # جدول الفنادق
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS hotels (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT NOT NULL,
+                city TEXT NOT NULL,
+                price REAL NOT NULL,
+                rating REAL NOT NULL,
+                image_url TEXT
+            )
+        ''')
+
+        # مفتاح التحديث عند الاستيراد: الفندق يُعرف باسمه ومدينته
+        cursor.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS idx_hotels_name_city ON hotels (name, city)"
+        )
+
+        # فهارس البحث: المدينة (بدون حساسية لحالة الأحرف) متبوعة بالسعر أو التقييم
+        # حتى تُطبق فلاتر السعر/التقييم والترتيب من الفهرس مباشرة دون مسح الجدول
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_hotels_city_price "
+            "ON hotels (city COLLATE NOCASE, price, rating)"
+        )
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_hotels_city_rating "
+            "ON hotels (city COLLATE NOCASE, rating, price)"
+        )
+
+        # جدول بيانات عامة (مثل رقم نسخة جدول الفنادق)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS app_meta (
+                key TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            )
+        ''')
+        cursor.execute("INSERT OR IGNORE INTO app_meta (key, value) VALUES ('hotels_version', 0)")
 
-            # جدول الحجوزات
+        # إحداثيات الفندق (للبحث الجغرافي)
+        try:
+            cursor.execute("ALTER TABLE hotels ADD COLUMN latitude REAL")
+        except sqlite3.OperationalError: pass
+        try:
+            cursor.execute("ALTER TABLE hotels ADD COLUMN longitude REAL")
+        except sqlite3.OperationalError: pass
+
+        # فهرس R-tree للإحداثيات متزامن مع جدول الفنادق عبر triggers
+        rtree_exists = cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'hotels_rtree'"
+        ).fetchone()
+        cursor.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS hotels_rtree USING rtree(
+                id, min_lat, max_lat, min_lng, max_lng
+            )
+        ''')
+        # (execute وليس executescript لأن executescript ينهي transaction الترحيل)
+        for trigger in (
+            '''CREATE TRIGGER IF NOT EXISTS trg_hotels_rtree_insert AFTER INSERT ON hotels
+            WHEN NEW.latitude IS NOT NULL AND NEW.longitude IS NOT NULL BEGIN
+                INSERT INTO hotels_rtree VALUES (NEW.id, NEW.latitude, NEW.latitude, NEW.longitude, NEW.longitude);
+            END''',
+            '''CREATE TRIGGER IF NOT EXISTS trg_hotels_rtree_update AFTER UPDATE OF latitude, longitude ON hotels BEGIN
+                DELETE FROM hotels_rtree WHERE id = OLD.id;
+                INSERT INTO hotels_rtree
+                SELECT NEW.id, NEW.latitude, NEW.latitude, NEW.longitude, NEW.longitude
+                WHERE NEW.latitude IS NOT NULL AND NEW.longitude IS NOT NULL;
+            END''',
+            '''CREATE TRIGGER IF NOT EXISTS trg_hotels_rtree_delete AFTER DELETE ON hotels BEGIN
+                DELETE FROM hotels_rtree WHERE id = OLD.id;
+            END''',
+        ):
+            cursor.execute(trigger)
+        if not rtree_exists:
             cursor.execute('''
-                CREATE TABLE IF NOT EXISTS bookings (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    user_name TEXT NOT NULL,
-                    hotel_name TEXT NOT NULL,
-                    city TEXT NOT NULL,
-                    check_in TEXT NOT NULL,
-                    check_out TEXT NOT NULL,
-                    price REAL NOT NULL,
-                    hotel_image_url TEXT,
-                    FOREIGN KEY (user_id) REFERENCES users (id)
-                )
+                INSERT INTO hotels_rtree
+                SELECT id, latitude, latitude, longitude, longitude FROM hotels
+                WHERE latitude IS NOT NULL AND longitude IS NOT NULL
             ''')
 
-            # جدول المفضلة
+        # أنواع الغرف لكل فندق مع عدد الغرف الكلي
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS room_types (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                hotel_id INTEGER NOT NULL,
+                name TEXT NOT NULL,
+                capacity INTEGER NOT NULL DEFAULT 2,
+                total_rooms INTEGER NOT NULL,
+                price REAL NOT NULL,
+                FOREIGN KEY (hotel_id) REFERENCES hotels (id)
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_room_types_hotel ON room_types (hotel_id)")
+
+        # عداد الغرف المحجوزة لكل نوع غرفة في كل ليلة (الصف غير الموجود = صفر محجوز)
+        # التوفر يُحسب من هذا الجدول بقراءة نطاق ليالٍ من المفتاح الأساسي بدلاً من مسح الحجوزات
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS room_inventory (
+                room_type_id INTEGER NOT NULL,
+                night TEXT NOT NULL,
+                booked INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (room_type_id, night),
+                FOREIGN KEY (room_type_id) REFERENCES room_types (id)
+            ) WITHOUT ROWID
+        ''')
+
+        # ربط الحجز بنوع الغرفة المحجوزة
+        try:
+            cursor.execute("ALTER TABLE bookings ADD COLUMN room_type_id INTEGER")
+        except sqlite3.OperationalError: pass
+
+        # كل فندق جديد يحصل على نوع غرفة افتراضي
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_hotels_default_room_type
+            AFTER INSERT ON hotels
+            BEGIN
+                INSERT INTO room_types (hotel_id, name, capacity, total_rooms, price)
+                VALUES (NEW.id, 'Standard', 2, {DEFAULT_ROOMS_PER_HOTEL}, NEW.price);
+            END
+        ''')
+        # الفنادق الموجودة مسبقاً بدون أنواع غرف
+        cursor.execute(f'''
+            INSERT INTO room_types (hotel_id, name, capacity, total_rooms, price)
+            SELECT id, 'Standard', 2, {DEFAULT_ROOMS_PER_HOTEL}, price FROM hotels
+            WHERE id NOT IN (SELECT hotel_id FROM room_types)
+        ''')
+
+        # فهرس FTS5 لأسماء الفنادق والمدن (للإكمال التلقائي) متزامن مع جدول الفنادق عبر triggers
+        try:
+            exists = cursor.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'hotels_fts'"
+            ).fetchone()
             cursor.execute('''
-                CREATE TABLE IF NOT EXISTS favorites (
-                    user_id INTEGER NOT NULL,
-                    item_name TEXT NOT NULL,
-                    city TEXT NOT NULL,
-                    added_at TEXT NOT NULL,
-                    PRIMARY KEY (user_id, item_name),
-                    FOREIGN KEY (user_id) REFERENCES users (id)
+                CREATE VIRTUAL TABLE IF NOT EXISTS hotels_fts USING fts5(
+                    name, city,
+                    content='hotels', content_rowid='id',
+                    tokenize='unicode61 remove_diacritics 2',
+                    prefix='1 2 3'
                 )
             ''')
-
-            # جدول الفنادق
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS hotels (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    name TEXT NOT NULL,
-                    city TEXT NOT NULL,
-                    price REAL NOT NULL,
-                    rating REAL NOT NULL,
-                    image_url TEXT
-                )
+            for trigger in (
+                '''CREATE TRIGGER IF NOT EXISTS trg_hotels_fts_insert AFTER INSERT ON hotels BEGIN
+                    INSERT INTO hotels_fts (rowid, name, city) VALUES (NEW.id, NEW.name, NEW.city);
+                END''',
+                '''CREATE TRIGGER IF NOT EXISTS trg_hotels_fts_delete AFTER DELETE ON hotels BEGIN
+                    INSERT INTO hotels_fts (hotels_fts, rowid, name, city)
+                    VALUES ('delete', OLD.id, OLD.name, OLD.city);
+                END''',
+                '''CREATE TRIGGER IF NOT EXISTS trg_hotels_fts_update AFTER UPDATE OF name, city ON hotels BEGIN
+                    INSERT INTO hotels_fts (hotels_fts, rowid, name, city)
+                    VALUES ('delete', OLD.id, OLD.name, OLD.city);
+                    INSERT INTO hotels_fts (rowid, name, city) VALUES (NEW.id, NEW.name, NEW.city);
+                END''',
+            ):
+                cursor.execute(trigger)
+            if not exists:
+                cursor.execute("INSERT INTO hotels_fts (hotels_fts) VALUES ('rebuild')")
+        except sqlite3.OperationalError:
+            # نسخة SQLite بدون FTS5: الإكمال التلقائي يعمل ببحث LIKE
+            pass
+
+        # زيادة رقم النسخة تلقائياً عند أي تعديل على جدول الفنادق (حتى من عمليات أخرى)
+        for event in ("INSERT", "UPDATE", "DELETE"):
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS trg_hotels_version_{event.lower()}
+                AFTER {event} ON hotels
+                BEGIN
+                    UPDATE app_meta SET value = value + 1 WHERE key = 'hotels_version';
+                END
             ''')
 
-            conn.commit()
-            self.seed_hotels()
-
-    # إدخال بيانات الفنادق الافتراضية
+    # الترحيل 2: إحصائيات الأسعار لكل مدينة (تُحدّث تلقائياً من جدولي الفنادق والحجوزات)
+    # العدد والمجاميع تُحدّث بالـ triggers مع كل تعديل، أما الأدنى والأعلى والنسب المئوية
+    # فتُحسب عند أول قراءة بعد التعديل (stale = 1) من فهرس (city, price)
+    def _migration_2_city_price_stats(self, cursor):
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS city_price_stats (
+                city TEXT PRIMARY KEY,
+                hotels_count INTEGER NOT NULL DEFAULT 0,
+                price_sum REAL NOT NULL DEFAULT 0,
+                price_sq_sum REAL NOT NULL DEFAULT 0,
+                rating_sum REAL NOT NULL DEFAULT 0,
+                bookings_count INTEGER NOT NULL DEFAULT 0,
+                booking_price_sum REAL NOT NULL DEFAULT 0,
+                price_min REAL,
+                price_max REAL,
+                price_p25 REAL,
+                price_p50 REAL,
+                price_p75 REAL,
+                stale INTEGER NOT NULL DEFAULT 1
+            )
+        ''')
+
+        add_hotel = '''
+            INSERT OR IGNORE INTO city_price_stats (city) VALUES (NEW.city);
+            UPDATE city_price_stats SET
+                hotels_count = hotels_count + 1, price_sum = price_sum + NEW.price,
+                price_sq_sum = price_sq_sum + NEW.price * NEW.price, rating_sum = rating_sum + NEW.rating,
+                stale = 1
+            WHERE city = NEW.city;
+        '''
+        remove_hotel = '''
+            UPDATE city_price_stats SET
+                hotels_count = hotels_count - 1, price_sum = price_sum - OLD.price,
+                price_sq_sum = price_sq_sum - OLD.price * OLD.price, rating_sum = rating_sum - OLD.rating,
+                stale = 1
+            WHERE city = OLD.city;
+        '''
+        add_booking = '''
+            INSERT OR IGNORE INTO city_price_stats (city) VALUES (NEW.city);
+            UPDATE city_price_stats SET
+                bookings_count = bookings_count + 1, booking_price_sum = booking_price_sum + NEW.price
+            WHERE city = NEW.city;
+        '''
+        remove_booking = '''
+            UPDATE city_price_stats SET
+                bookings_count = bookings_count - 1, booking_price_sum = booking_price_sum - OLD.price
+            WHERE city = OLD.city;
+        '''
+        for trigger in (
+            f"CREATE TRIGGER IF NOT EXISTS trg_city_stats_hotel_insert AFTER INSERT ON hotels BEGIN {add_hotel} END",
+            f"CREATE TRIGGER IF NOT EXISTS trg_city_stats_hotel_delete AFTER DELETE ON hotels BEGIN {remove_hotel} END",
+            f'''CREATE TRIGGER IF NOT EXISTS trg_city_stats_hotel_update AFTER UPDATE OF city, price, rating ON hotels
+                BEGIN {remove_hotel} {add_hotel} END''',
+            f"CREATE TRIGGER IF NOT EXISTS trg_city_stats_booking_insert AFTER INSERT ON bookings BEGIN {add_booking} END",
+            f"CREATE TRIGGER IF NOT EXISTS trg_city_stats_booking_delete AFTER DELETE ON bookings BEGIN {remove_booking} END",
+        ):
+            cursor.execute(trigger)
+        self._rebuild_city_stats(cursor)
+
+    # الترحيل 3: مفتاح المدينة في city_price_stats بدون حساسية لحالة الأحرف
+    # (مثل فهرس city, price) حتى تُجمع "Dubai" و "dubai" في صف واحد ويُقرأ الصف بنفس المقارنة
+    def _migration_3_city_stats_nocase(self, cursor):
+        cursor.execute("DROP TABLE IF EXISTS city_price_stats")
+        cursor.execute('''
+            CREATE TABLE city_price_stats (
+                city TEXT PRIMARY KEY COLLATE NOCASE,
+                hotels_count INTEGER NOT NULL DEFAULT 0,
+                price_sum REAL NOT NULL DEFAULT 0,
+                price_sq_sum REAL NOT NULL DEFAULT 0,
+                rating_sum REAL NOT NULL DEFAULT 0,
+                bookings_count INTEGER NOT NULL DEFAULT 0,
+                booking_price_sum REAL NOT NULL DEFAULT 0,
+                price_min REAL,
+                price_max REAL,
+                price_p25 REAL,
+                price_p50 REAL,
+                price_p75 REAL,
+                stale INTEGER NOT NULL DEFAULT 1
+            )
+        ''')
+        self._rebuild_city_stats(cursor)
+
+    # الترحيل 4: فهارس ترتيب الكتالوج كاملاً بالتقييم أو السعر
+    # (اختيار فنادق المحادثة بدون مدينة يقرأ أول الفهرس بدلاً من ترتيب كل الفنادق)
+    def _migration_4_hotel_order_indexes(self, cursor):
+        # اتجاه العمود الثاني يطابق ORDER BY في _build_chat_context (rating DESC, price ASC) و (price ASC, rating DESC)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_hotels_rating_price ON hotels (rating, price DESC)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_hotels_price_rating ON hotels (price, rating DESC)")
+
+    # الترحيل 5: إنشاء صف المدينة في triggers الإحصائيات بدون INSERT OR IGNORE
+    # (سياسة التعارض للأمر الخارجي تتجاوز OR IGNORE داخل الـ trigger، فكان upsert لفندق موجود
+    # عند الاستيراد يفشل بـ UNIQUE constraint على city_price_stats)
+    def _migration_5_city_stats_triggers(self, cursor):
+        ensure_city = '''
+            INSERT INTO city_price_stats (city)
+            SELECT NEW.city WHERE NOT EXISTS (SELECT 1 FROM city_price_stats WHERE city = NEW.city);
+        '''
+        add_hotel = ensure_city + '''
+            UPDATE city_price_stats SET
+                hotels_count = hotels_count + 1, price_sum = price_sum + NEW.price,
+                price_sq_sum = price_sq_sum + NEW.price * NEW.price, rating_sum = rating_sum + NEW.rating,
+                stale = 1
+            WHERE city = NEW.city;
+        '''
+        remove_hotel = '''
+            UPDATE city_price_stats SET
+                hotels_count = hotels_count - 1, price_sum = price_sum - OLD.price,
+                price_sq_sum = price_sq_sum - OLD.price * OLD.price, rating_sum = rating_sum - OLD.rating,
+                stale = 1
+            WHERE city = OLD.city;
+        '''
+        add_booking = ensure_city + '''
+            UPDATE city_price_stats SET
+                bookings_count = bookings_count + 1, booking_price_sum = booking_price_sum + NEW.price
+            WHERE city = NEW.city;
+        '''
+        for name in ("trg_city_stats_hotel_insert", "trg_city_stats_hotel_update", "trg_city_stats_booking_insert"):
+            cursor.execute(f"DROP TRIGGER IF EXISTS {name}")
+        for trigger in (
+            f"CREATE TRIGGER trg_city_stats_hotel_insert AFTER INSERT ON hotels BEGIN {add_hotel} END",
+            f'''CREATE TRIGGER trg_city_stats_hotel_update AFTER UPDATE OF city, price, rating ON hotels
+                BEGIN {remove_hotel} {add_hotel} END''',
+            f"CREATE TRIGGER trg_city_stats_booking_insert AFTER INSERT ON bookings BEGIN {add_booking} END",
+        ):
+            cursor.execute(trigger)
+
+    # الترحيل 6: فهرس FTS5 للإكمال التلقائي مرتب بالتقييم (rowid = AUTOCOMPLETE_RANK_KEY)
+    # جدول بدون محتوى (content='') يخزن الفهرس فقط، والبادئات حتى 6 أحرف مفهرسة حتى لا تُدمج قوائم الكلمات
+    def _migration_6_autocomplete_rank_fts(self, cursor):
+        if not cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'hotels_fts'").fetchone():
+            return
+        cursor.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS hotels_rank_fts USING fts5(
+                name, city,
+                content='',
+                tokenize='unicode61 remove_diacritics 2',
+                prefix='1 2 3 4 5 6'
+            )
+        ''')
+        new_key = AUTOCOMPLETE_RANK_KEY.format(row="NEW.")
+        old_key = AUTOCOMPLETE_RANK_KEY.format(row="OLD.")
+        insert = f"INSERT INTO hotels_rank_fts (rowid, name, city) VALUES ({new_key}, NEW.name, NEW.city);"
+        delete = (
+            "INSERT INTO hotels_rank_fts (hotels_rank_fts, rowid, name, city) "
+            f"VALUES ('delete', {old_key}, OLD.name, OLD.city);"
+        )
+        for trigger in (
+            f"CREATE TRIGGER IF NOT EXISTS trg_hotels_rank_fts_insert AFTER INSERT ON hotels BEGIN {insert} END",
+            f"CREATE TRIGGER IF NOT EXISTS trg_hotels_rank_fts_delete AFTER DELETE ON hotels BEGIN {delete} END",
+            f'''CREATE TRIGGER IF NOT EXISTS trg_hotels_rank_fts_update AFTER UPDATE OF name, city, rating ON hotels
+                BEGIN {delete} {insert} END''',
+        ):
+            cursor.execute(trigger)
+        self._rebuild_rank_fts(cursor)
+
+    # إعادة تعبئة فهرس الإكمال التلقائي من جدول الفنادق (الجدول بدون محتوى فلا يدعم 'rebuild')
+    def _rebuild_rank_fts(self, cursor):
+        cursor.execute("INSERT INTO hotels_rank_fts (hotels_rank_fts) VALUES ('delete-all')")
+        cursor.execute(f'''
+            INSERT INTO hotels_rank_fts (rowid, name, city)
+            SELECT {AUTOCOMPLETE_RANK_KEY.format(row="")}, name, city FROM hotels
+        ''')
+
+    # الترحيل 7: حفظ أسعار كل المدن مسبقاً حتى لا تحتاج قراءة الإحصائيات إلى الكتابة
+    def _migration_7_city_stats_backfill(self, cursor):
+        self._refresh_stale_city_stats(cursor)
+
+    # إعادة حساب مجاميع كل المدن من الجداول (عند الترحيل وبعد استيراد مع تأجيل الفهارس)
+    def _rebuild_city_stats(self, cursor):
+        cursor.execute("DELETE FROM city_price_stats")
+        cursor.execute('''
+            INSERT INTO city_price_stats (city, hotels_count, price_sum, price_sq_sum, rating_sum)
+            SELECT city, COUNT(*), SUM(price), SUM(price * price), SUM(rating) FROM hotels
+            GROUP BY city COLLATE NOCASE
+        ''')
+        cursor.execute('''
+            INSERT INTO city_price_stats (city, bookings_count, booking_price_sum)
+            SELECT city, COUNT(*), SUM(price) FROM bookings WHERE true GROUP BY city COLLATE NOCASE
+            ON CONFLICT (city) DO UPDATE SET
+                bookings_count = excluded.bookings_count, booking_price_sum = excluded.booking_price_sum
+        ''')
+
+    # قائمة الترحيلات بالترتيب؛ رقم الترحيل = موقعه في القائمة (يُحفظ في PRAGMA user_version)
+    # ترحيل جديد يُضاف في نهاية القائمة ولا يُعدل ترحيل سابق بعد نشره
+    MIGRATIONS = [
+        _migration_1_initial_schema,
+        _migration_2_city_price_stats,
+        _migration_3_city_stats_nocase,
+        _migration_4_hotel_order_indexes,
+        _migration_5_city_stats_triggers,
+        _migration_6_autocomplete_rank_fts,
+        _migration_7_city_stats_backfill,
+    ]
+
+    # إدخال بيانات الفنادق الافتراضية من ملف الكتالوج
     def seed_hotels(self):
+        if not os.path.exists(SEED_CATALOG_FILE):
+            return
         with self.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT COUNT(*) FROM hotels")
-            if cursor.fetchone()[0] == 0:
-                hotels = [
-                    ("Grand Hotel Dubai", "Dubai", 250, 4.8, "./static/image/Hotel1.jpg"),
-                    ("Dubai Marina View", "Dubai", 300, 4.9, "./static/image/Hotel2.jpg"),
-                    ("Palm Resort", "Dubai", 450, 5.0, "./static/image/Hotel3.jpg"),
-                    ("Cairo Nile View", "Cairo", 120, 4.5, "./static/image/Hotel4.jpg"),
-                    ("Pyramids Plaza", "Cairo", 150, 4.6, "./static/image/Hotel5.jpg"),
-                    ("Riyadh Business Stay", "Riyadh", 200, 4.7, "./static/image/Hotel6.jpg"),
-                    ("Kingdom Tower Hotel", "Riyadh", 350, 4.8, "./static/image/Hotel7.jpg"),
-                    ("London Bridge Inn", "London", 180, 4.3, "./static/image/Hotel8.jpg"),
-                    ("Hyde Park Suites", "London", 220, 4.6, "./static/image/Hotel9.jpg")
-                ]
-                cursor.executemany(
-                    "INSERT INTO hotels (name, city, price, rating, image_url) VALUES (?, ?, ?, ?, ?)",
-                    hotels
+            empty = conn.execute("SELECT COUNT(*) FROM hotels").fetchone()[0] == 0
+        with open(SEED_CATALOG_FILE, encoding='utf-8-sig', newline='') as f:
+            rows = validate_catalog_rows(read_catalog_rows(f, 'csv'), [])
+            if empty:
+                self.import_hotels(rows)
+                return
+            # إضافة الإحداثيات للفنادق الافتراضية في قواعد البيانات القديمة
+            with self.get_connection() as conn:
+                conn.executemany(
+                    "UPDATE hotels SET latitude = ?, longitude = ? "
+                    "WHERE name = ? AND city = ? AND latitude IS NULL",
+                    [(h[5], h[6], h[0], h[1]) for h in rows]
                 )
                 conn.commit()
 
-    # جلب الفنادق كنص للذكاء الاصطناعي
-    def get_all_hotels_formatted(self):
-        try:
+    # استيراد الفنادق على دفعات (تحديث الفندق الموجود بنفس الاسم والمدينة)
+    # الوضع العادي: كل دفعة عملية في خيط الكتابة، فتتناوب مع الحجوزات ولا تحجز قفل الكتابة طويلاً
+    # defer_indexes: حذف الفهارس والـ triggers أثناء التحميل ثم إعادة بنائها مرة واحدة في النهاية،
+    # ويتم التحميل كله في transaction واحدة حتى لا يرى القراء الكتالوج بدون فهارسه
+    # (يحجز قفل الكتابة طوال التحميل، لذلك للاستيراد من سطر الأوامر فقط وليس من الـ API)
+    def import_hotels(self, rows, chunk_size=IMPORT_CHUNK_SIZE, defer_indexes=False, progress=None):
+        stats = {"rows": 0, "chunks": 0}
+        start = time.perf_counter()
+        upsert = '''
+            INSERT INTO hotels (name, city, price, rating, image_url, latitude, longitude)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (name, city) DO UPDATE SET
+                price = excluded.price, rating = excluded.rating, image_url = excluded.image_url,
+                latitude = excluded.latitude, longitude = excluded.longitude
+        '''
+
+        def loaded(chunk):
+            stats["rows"] += len(chunk)
+            stats["chunks"] += 1
+            if progress:
+                progress(stats["rows"], time.perf_counter() - start)
+
+        if not defer_indexes:
+            for chunk in chunked(rows, chunk_size):
+                self.writer.execute(lambda cursor, chunk=chunk: cursor.executemany(upsert, chunk))
+                loaded(chunk)
+            # حفظ أسعار المدن المتغيرة مرة واحدة بعد آخر دفعة (بدلاً من إعادة حسابها مع كل دفعة)
+            if stats["chunks"]:
+                self.writer.execute(self._refresh_stale_city_stats)
+        else:
             with self.get_connection() as conn:
                 cursor = conn.cursor()
-                cursor.execute("SELECT name, city, price, rating FROM hotels")
-                hotels = cursor.fetchall()
-                if not hotels:
-                    return "لا توجد بيانات فنادق حالياً."
-                hotel_list = "\n".join([
-                    f"- {h['name']} في {h['city']} (السعر: ${h['price']}, التقييم: {h['rating']}⭐)"
-                    for h in hotels
-                ])
-                return hotel_list
+                cursor.execute("BEGIN IMMEDIATE")
+                deferred = cursor.execute('''
+                    SELECT type, name, sql FROM sqlite_master
+                    WHERE tbl_name = 'hotels' AND type IN ('index', 'trigger')
+                      AND sql IS NOT NULL AND name != 'idx_hotels_name_city'
+                ''').fetchall()
+                try:
+                    for kind, name, _ in deferred:
+                        cursor.execute(f"DROP {kind.upper()} {name}")
+                    for chunk in chunked(rows, chunk_size):
+                        cursor.executemany(upsert, chunk)
+                        loaded(chunk)
+                    for _, _, sql in deferred:
+                        cursor.execute(sql)
+                    self._rebuild_hotel_derived(cursor)
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+        stats["seconds"] = round(time.perf_counter() - start, 3)
+        stats["rows_per_sec"] = round(stats["rows"] / stats["seconds"]) if stats["seconds"] else stats["rows"]
+        return stats
+
+    # إعادة بناء ما تحدّثه triggers الفنادق عادةً (بعد استيراد مع تأجيل الفهارس)
+    def _rebuild_hotel_derived(self, cursor):
+        cursor.execute("DELETE FROM hotels_rtree")
+        cursor.execute('''
+            INSERT INTO hotels_rtree
+            SELECT id, latitude, latitude, longitude, longitude FROM hotels
+            WHERE latitude IS NOT NULL AND longitude IS NOT NULL
+        ''')
+        cursor.execute(f'''
+            INSERT INTO room_types (hotel_id, name, capacity, total_rooms, price)
+            SELECT id, 'Standard', 2, {DEFAULT_ROOMS_PER_HOTEL}, price FROM hotels
+            WHERE id NOT IN (SELECT hotel_id FROM room_types)
+        ''')
+        if self.fts_enabled:
+            cursor.execute("INSERT INTO hotels_fts (hotels_fts) VALUES ('rebuild')")
+            self._rebuild_rank_fts(cursor)
+        self._rebuild_city_stats(cursor)
+        self._refresh_stale_city_stats(cursor)
+        cursor.execute("UPDATE app_meta SET value = value + 1 WHERE key = 'hotels_version'")
+
+    # اختيار الفنادق الأكثر صلة بسؤال المستخدم وتنسيقها للذكاء الاصطناعي
+    # حجم النص ثابت مهما كبر الكتالوج: قائمة المدن + عدد محدود من الفنادق
+    def get_chat_context(self, query, limit=CHAT_CONTEXT_HOTELS):
+        try:
+            version = self.get_hotels_version()
+            cache_key = (version, " ".join(chat_terms(query)), limit)
+            snapshot = self.chat_context_cache.get(cache_key)
+            if snapshot is None:
+                snapshot = CatalogSnapshot(version, self._build_chat_context(version, query, limit))
+                self.chat_context_cache.set(cache_key, snapshot)
+            return snapshot
         except Exception:
-            return "غير قادر على جلب بيانات الفنادق."
+            # لا نحفظ النسخة الفاشلة حتى نعيد المحاولة في الطلب التالي
+            return CatalogSnapshot(None, "غير قادر على جلب بيانات الفنادق.")
+
+    def _build_chat_context(self, version, query, limit):
+        city_index = self._get_city_index(version)
+        if not city_index:
+            return "لا توجد بيانات فنادق حالياً."
+
+        terms = chat_terms(query)
+        intent = chat_intent(query)
+        # المدن المذكورة في السؤال (بالاسم كما في الجدول أو بالاسم العربي)
+        term_set = set(terms) | {term[1:] for term in terms if term[:1] in "بلو" and len(term) > 3}
+        aliases = {CITY_ALIASES[term].lower() for term in term_set if term in CITY_ALIASES}
+        cities, city_words = [], set()
+        for _, city, _ in city_index:
+            words = chat_terms(city)
+            if (words and all(word in term_set for word in words)) or city.lower() in aliases:
+                cities.append(city)
+                city_words.update(words)
+        name_terms = [
+            term for term in terms
+            if len(term) > 2 and not term.isdigit() and term not in CHAT_STOP_WORDS
+            and term not in city_words and term not in CITY_ALIASES
+            and term not in CHAT_CHEAP_WORDS and term not in CHAT_LUXURY_WORDS
+        ]
+
+        order = {
+            "price_asc": "price ASC, rating DESC",
+            "price_desc": "price DESC, rating DESC",
+            "rating": "rating DESC, price ASC",
+        }[intent["sort"]]
+        conditions, params = [], []
+        if intent["max_price"] is not None:
+            conditions.append("price <= ?")
+            params.append(intent["max_price"])
+        if intent["min_rating"] is not None:
+            conditions.append("rating >= ?")
+            params.append(intent["min_rating"])
+
+        with self.get_connection() as conn:
+            hotels = []
+            # 1. الفنادق المذكورة بالاسم (ترتيب BM25 من فهرس FTS5)
+            if name_terms:
+                if self.fts_enabled:
+                    match = "name : (" + " OR ".join(f'"{term}"' for term in name_terms) + ")"
+                    hotels += conn.execute('''
+                        SELECT h.name, h.city, h.price, h.rating FROM hotels_fts
+                        JOIN hotels h ON h.id = hotels_fts.rowid
+                        WHERE hotels_fts MATCH ?
+                        ORDER BY bm25(hotels_fts) LIMIT ?
+                    ''', (match, CHAT_CONTEXT_NAME_MATCHES)).fetchall()
+                else:
+                    where = " OR ".join("name LIKE ?" for _ in name_terms)
+                    hotels += conn.execute(
+                        f"SELECT name, city, price, rating FROM hotels WHERE {where} LIMIT ?",
+                        [f"%{term}%" for term in name_terms] + [CHAT_CONTEXT_NAME_MATCHES]
+                    ).fetchall()
+
+            # 2. فنادق المدن المذكورة (أو كل المدن) حسب نية السعر والتقييم
+            # كل مدينة باستعلام مستقل حتى يُستخدم فهرس (city, price) أو (city, rating) بدون ترتيب كامل،
+            # وبدون مدينة يُستخدم فهرس (price, rating) أو (rating, price)
+            for city in cities[:5] or [None]:
+                where = list(conditions) + (["city = ? COLLATE NOCASE"] if city else [])
+                sql = "SELECT name, city, price, rating FROM hotels"
+                if where:
+                    sql += " WHERE " + " AND ".join(where)
+                hotels += conn.execute(
+                    f"{sql} ORDER BY {order} LIMIT ?",
+                    params + ([city] if city else []) + [limit]
+                ).fetchall()
+
+        selected, seen = [], set()
+        for row in hotels:
+            key = (row['name'], row['city'])
+            if key not in seen:
+                seen.add(key)
+                selected.append(row)
+        selected = selected[:limit]
+
+        total = sum(count for _, _, count in city_index)
+        city_list = "، ".join(f"{city} ({count})" for _, city, count in city_index[:CHAT_CONTEXT_CITIES])
+        lines = [f"المدن التي نخدمها (عدد الفنادق): {city_list}"]
+        if len(city_index) > CHAT_CONTEXT_CITIES:
+            lines.append(f"و{len(city_index) - CHAT_CONTEXT_CITIES} مدن أخرى.")
+        lines.append(f"الفنادق الأكثر صلة بالسؤال ({len(selected)} من أصل {total}):")
+        if selected:
+            lines += [format_hotel_line(row) for row in selected]
+        else:
+            lines.append("لا توجد فنادق تطابق شروط السؤال.")
+        return "\n".join(lines)
 
     # تسجيل مستخدم جديد
     def register_user(self, username, password, age):
@@ -253,18 +2000,21 @@ class DBManager:
         if not re.match(r"[^@]+@[^@]+\.[^@]+", username):
             return False, "البريد الإلكتروني غير صالح"
 
+        password_hash = hash_password(password)
+
+        def insert_user(cursor):
+            cursor.execute(
+                "INSERT INTO users (username, password_hash, age) VALUES (?, ?, ?)",
+                (username, password_hash, age)
+            )
+
         try:
-            password_hash = generate_password_hash(password)
-            with self.get_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute(
-                    "INSERT INTO users (username, password_hash, age) VALUES (?, ?, ?)",
-                    (username, password_hash, age)
-                )
-                conn.commit()
-                return True, "تم التسجيل بنجاح"
+            self.writer.execute(insert_user)
+            return True, "تم التسجيل بنجاح"
         except sqlite3.IntegrityError:
             return False, "المستخدم موجود مسبقاً"
+        except WriteQueueFull:
+            return False, "الخدمة مشغولة حالياً، حاول لاحقاً"
 
     # التحقق من بيانات المستخدم عند تسجيل الدخول
     def verify_user(self, username, password):
@@ -272,112 +2022,542 @@ class DBManager:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM users WHERE username = ?", (username,))
             user_data = cursor.fetchone()
-            if user_data and check_password_hash(user_data['password_hash'], password):
-                return User(
-                    user_data['id'],
-                    user_data['username'],
-                    user_data['full_name'],
-                    user_data['phone']
-                )
+        if user_data and verify_password(user_data['password_hash'], password):
+            # ترقية الهاش تلقائياً إذا كان بإعدادات تشفير قديمة (تُجرب في الدخول التالي إذا كان الطابور ممتلئاً)
+            if password_needs_rehash(user_data['password_hash']):
+                new_hash = hash_password(password)
+                try:
+                    self.writer.execute(lambda cursor: cursor.execute(
+                        "UPDATE users SET password_hash = ? WHERE id = ?",
+                        (new_hash, user_data['id'])
+                    ))
+                except WriteQueueFull:
+                    pass
+            return User(
+                user_data['id'],
+                user_data['username'],
+                user_data['full_name'],
+                user_data['phone']
+            )
         return None
 
     # جلب مستخدم حسب ID
+    # (نحفظ البيانات في الكاش وننشئ كائن User جديداً لكل طلب حتى لا يُشارك بين الطلبات)
     def get_user_by_id(self, user_id):
+        key = str(user_id)
+        cached = self.user_cache.get(key)
+        if cached is not None:
+            return User(*cached)
+
         with self.get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT * FROM users WHERE id = ?", (user_id,))
+            cursor.execute("SELECT id, username, full_name, phone FROM users WHERE id = ?", (user_id,))
             data = cursor.fetchone()
             if data:
-                return User(data['id'], data['username'], data['full_name'], data['phone'])
+                values = (data['id'], data['username'], data['full_name'], data['phone'])
+                self.user_cache.set(key, values)
+                return User(*values)
         return None
 
     # تحديث بيانات الملف الشخصي
     def update_user_profile(self, user_id, new_username, full_name, phone, new_password=None):
-        try:
-            with self.get_connection() as conn:
-                cursor = conn.cursor()
+        pw_hash = hash_password(new_password) if new_password else None
 
-                # التحقق من أن البريد غير مستخدم من شخص آخر
+        def update_profile(cursor):
+            # التحقق من أن البريد غير مستخدم من شخص آخر
+            cursor.execute(
+                "SELECT id FROM users WHERE username = ? AND id != ?",
+                (new_username, user_id)
+            )
+            if cursor.fetchone():
+                return False
+
+            if pw_hash:
                 cursor.execute(
-                    "SELECT id FROM users WHERE username = ? AND id != ?",
-                    (new_username, user_id)
+                    "UPDATE users SET username = ?, full_name = ?, phone = ?, password_hash = ? WHERE id = ?",
+                    (new_username, full_name, phone, pw_hash, user_id)
                 )
-                if cursor.fetchone():
-                    return False, "البريد الإلكتروني مستخدم بالفعل"
-
-                if new_password:
-                    pw_hash = generate_password_hash(new_password)
-                    cursor.execute(
-                        "UPDATE users SET username = ?, full_name = ?, phone = ?, password_hash = ? WHERE id = ?",
-                        (new_username, full_name, phone, pw_hash, user_id)
-                    )
-                else:
-                    cursor.execute(
-                        "UPDATE users SET username = ?, full_name = ?, phone = ? WHERE id = ?",
-                        (new_username, full_name, phone, user_id)
-                    )
+            else:
+                cursor.execute(
+                    "UPDATE users SET username = ?, full_name = ?, phone = ? WHERE id = ?",
+                    (new_username, full_name, phone, user_id)
+                )
+            return True
 
-                conn.commit()
-                return True,"تم تحديث الملف الشخصي بنجاح"
+        try:
+            if not self.writer.execute(update_profile):
+                return False, "البريد الإلكتروني مستخدم بالفعل"
+            self.user_cache.pop(str(user_id))
+            return True,"تم تحديث الملف الشخصي بنجاح"
+        except WriteQueueFull:
+            return False, "الخدمة مشغولة حالياً، حاول لاحقاً"
         except Exception as e:
             print(f"Error updating profile: {e}")
             return False,"خطأ في قاعدة البيانات"
 
-    # البحث عن فنادق حسب المدينة
-    def search_hotels(self, city):
+    # رقم نسخة جدول الفنادق (يزيد مع كل إضافة أو تعديل أو حذف)
+    def get_hotels_version(self):
         with self.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "SELECT * FROM hotels WHERE city = ? COLLATE NOCASE",
-                (city,)
-            )
-            return [dict(row) for row in cursor.fetchall()]
+            row = conn.execute("SELECT value FROM app_meta WHERE key = 'hotels_version'").fetchone()
+            return row[0] if row else 0
+
+    # البحث عن فنادق حسب المدينة مع فلاتر السعر والتقييم والترتيب والتقسيم لصفحات
+    # cursor: (قيمة عمود الترتيب، id) لآخر نتيجة في الصفحة السابقة
+    def search_hotels(self, city, min_price=None, max_price=None, min_rating=None,
+                      sort="default", limit=SEARCH_DEFAULT_LIMIT, cursor=None):
+        column, direction = SEARCH_SORTS[sort]
+        version = self.get_hotels_version()
+        if version != self._search_cache_version:
+            self.search_cache.clear()
+            self._search_cache_version = version
+
+        cache_key = (
+            version, city.strip().lower(), min_price, max_price, min_rating,
+            sort, limit, tuple(cursor) if cursor else None
+        )
+        cached = self.search_cache.get(cache_key)
+        if cached is not None:
+            return list(cached)
+
+        conditions = ["city = ? COLLATE NOCASE"]
+        params = [city.strip()]
+        if min_price is not None:
+            conditions.append("price >= ?")
+            params.append(min_price)
+        if max_price is not None:
+            conditions.append("price <= ?")
+            params.append(max_price)
+        if min_rating is not None:
+            conditions.append("rating >= ?")
+            params.append(min_rating)
+
+        # ترقيم الصفحات بالمفتاح (keyset) بدلاً من OFFSET
+        op = ">" if direction == "ASC" else "<"
+        if cursor:
+            if column == "id":
+                conditions.append(f"id {op} ?")
+                params.append(cursor[-1])
+            else:
+                conditions.append(f"({column}, id) {op} (?, ?)")
+                params.extend(cursor)
+
+        order_by = "id ASC" if column == "id" else f"{column} {direction}, id {direction}"
+        sql = f"SELECT * FROM hotels WHERE {' AND '.join(conditions)} ORDER BY {order_by} LIMIT ?"
+        params.append(limit)
+
+        def run_query():
+            with self.get_connection() as conn:
+                results = [dict(row) for row in conn.execute(sql, params).fetchall()]
+            self.search_cache.set(cache_key, results)
+            return results
+
+        # الطلبات المتطابقة المتزامنة تنتظر نفس الاستعلام، وعند انتهاء المهلة ينفذ كل طلب استعلامه
+        try:
+            results = self.read_flight.do(("search",) + cache_key, run_query)
+        except FuturesTimeoutError:
+            results = run_query()
+        return list(results)
 
     # إضافة حجز جديد
+    # يرجع (id الحجز، None) عند النجاح أو (None، كود الخطأ من BOOKING_ERRORS)
+    # إذا كان الفندق معروفاً تُحجز غرفة من المخزون في نفس المعاملة، وإلا يُحفظ الحجز كما هو
     def add_booking(self, user_id, booking_name, data):
+        nights = stay_nights(data.get('check_in'), data.get('check_out'))
+        if not nights:
+            return None, "dates"
+        room_type_id = data.get('room_type_id')
+        if room_type_id not in (None, ''):
+            try:
+                room_type_id = int(room_type_id)
+            except (TypeError, ValueError):
+                return None, "room_type"
+        else:
+            room_type_id = None
+        hotel_name = " ".join(str(data.get('hotel_name') or '').split())
+        city = " ".join(str(data.get('city') or '').split())
+
+        # تعمل داخل خيط الكتابة، فلا يحجز طلبان نفس الغرفة الأخيرة
+        def book(cursor):
+            hotel, candidates = self._room_type_candidates(cursor, hotel_name, city, room_type_id)
+            reserved = None
+            if hotel is not None:
+                if room_type_id is not None and not candidates:
+                    return None, "room_type"
+                for candidate in candidates:
+                    if self._reserve_room(cursor, candidate, nights):
+                        reserved = candidate
+                        break
+                if reserved is None:
+                    return None, "sold_out"
+                # سعر الفندق المعروف من نوع الغرفة المحجوزة في الكتالوج، وليس السعر المرسل من العميل
+                price = cursor.execute("SELECT price FROM room_types WHERE id = ?", (reserved,)).fetchone()[0]
+            elif room_type_id is not None:
+                return None, "room_type"
+            else:
+                price = data['price']
+
+            # التواريخ تُحفظ بالصيغة الموحدة (YYYY-MM-DD) حتى تطابق ليالي المخزون عند الإلغاء
+            cursor.execute('''
+                INSERT INTO bookings (
+                    user_id, user_name, hotel_name, city,
+                    check_in, check_out, price, hotel_image_url, room_type_id
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (
+                user_id, booking_name,
+                hotel['name'] if hotel else data['hotel_name'],
+                hotel['city'] if hotel else data['city'],
+                nights[0], stay_end(nights),
+                price, data.get('hotel_image_url'), reserved
+            ))
+            return cursor.lastrowid, None
+
         try:
-            with self.get_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute('''
-                    INSERT INTO bookings (
-                        user_id, user_name, hotel_name, city,
-                        check_in, check_out, price, hotel_image_url
-                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (
-                    user_id, booking_name,
-                    data['hotel_name'], data['city'],
-                    data['check_in'], data['check_out'],
-                    data['price'], data.get('hotel_image_url')
-                ))
-                conn.commit()
-                return cursor.lastrowid
+            return self.writer.execute(book)
+        except WriteQueueFull:
+            return None, "busy"
         except Exception:
+            return None, "db"
+
+    # الفندق المحجوز (الاسم والمدينة بدون حساسية لحالة الأحرف) وأنواع غرفه المرشحة مرتبة بالسعر
+    # يرجع (None، []) لفندق غير معروف (حجز بدون مخزون)
+    # room_type_id المرسل من العميل يُقبل فقط إذا كان يتبع نفس الفندق
+    def _room_type_candidates(self, cursor, hotel_name, city, room_type_id=None):
+        hotel = cursor.execute('''
+            SELECT id, name, city FROM hotels
+            WHERE city = ? COLLATE NOCASE AND name = ? COLLATE NOCASE
+            ORDER BY name = ? DESC LIMIT 1
+        ''', (city, hotel_name, hotel_name)).fetchone()
+        if hotel is None:
+            return None, []
+        if room_type_id is not None:
+            rows = cursor.execute(
+                "SELECT id FROM room_types WHERE id = ? AND hotel_id = ?", (room_type_id, hotel['id'])
+            ).fetchall()
+        else:
+            rows = cursor.execute(
+                "SELECT id FROM room_types WHERE hotel_id = ? ORDER BY price, id", (hotel['id'],)
+            ).fetchall()
+        return hotel, [row[0] for row in rows]
+
+    # حجز غرفة واحدة لكل ليلة (يتراجع عن الليالي السابقة إذا امتلأت أي ليلة)
+    def _reserve_room(self, cursor, room_type_id, nights):
+        cursor.execute("SELECT total_rooms FROM room_types WHERE id = ?", (room_type_id,))
+        row = cursor.fetchone()
+        if not row or row[0] < 1:
+            return False
+        cursor.execute("SAVEPOINT reserve_room")
+        for night in nights:
+            cursor.execute('''
+                INSERT INTO room_inventory (room_type_id, night, booked) VALUES (?, ?, 1)
+                ON CONFLICT (room_type_id, night) DO UPDATE SET booked = booked + 1
+                WHERE booked < ?
+            ''', (room_type_id, night, row[0]))
+            if cursor.rowcount == 0:
+                cursor.execute("ROLLBACK TO reserve_room")
+                cursor.execute("RELEASE reserve_room")
+                return False
+        cursor.execute("RELEASE reserve_room")
+        return True
+
+    # الإكمال التلقائي: مدن وفنادق تبدأ كلماتها بالنص المكتوب، مرتبة حسب التقييم
+    def autocomplete(self, text, limit=AUTOCOMPLETE_DEFAULT_LIMIT):
+        tokens = autocomplete_tokens(text)
+        if not tokens:
+            return {"cities": [], "hotels": []}
+
+        version = self.get_hotels_version()
+        cache_key = (version, " ".join(tokens), limit)
+        cached = self.autocomplete_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+        with self.get_connection() as conn:
+            if self.fts_enabled:
+                match = " ".join(f'"{token}"*' for token in tokens)
+                # التطابقات تُقرأ بترتيب rowid (التقييم ثم رقم الفندق) فلا تُرتب ولا يُحسب bm25 لكل تطابق
+                hotels = conn.execute('''
+                    SELECT h.id, h.name, h.city, h.rating FROM (
+                        SELECT rowid & 4294967295 AS id FROM hotels_rank_fts
+                        WHERE hotels_rank_fts MATCH ? ORDER BY rowid LIMIT ?
+                    ) ranked
+                    JOIN hotels h ON h.id = ranked.id
+                    ORDER BY h.rating DESC, h.id
+                ''', (match, limit)).fetchall()
+            else:
+                pattern = " ".join(tokens) + "%"
+                hotels = conn.execute('''
+                    SELECT id, name, city, rating FROM hotels
+                    WHERE name LIKE ? OR city LIKE ?
+                    ORDER BY rating DESC LIMIT ?
+                ''', (pattern, pattern, limit)).fetchall()
+
+        # المدن قليلة العدد، لذا تُطابق من قائمة في الذاكرة بدلاً من تجميع كل نتائج الفهرس
+        cities = [
+            city for words, city, _ in self._get_city_index(version)
+            if all(any(word.startswith(token) for word in words) for token in tokens)
+        ][:5]
+
+        result = {
+            "cities": cities,
+            "hotels": [dict(row) for row in hotels],
+        }
+        self.autocomplete_cache.set(cache_key, result)
+        return result
+
+    # قائمة المدن (كلمات كل مدينة، اسمها، عدد فنادقها) مرتبة بعدد الفنادق، تُبنى مرة لكل نسخة من جدول الفنادق
+    def _get_city_index(self, version):
+        index = self._city_index
+        if index is not None and index[0] == version:
+            return index[1]
+        with self.get_connection() as conn:
+            rows = conn.execute('''
+                SELECT city, COUNT(*) AS hotels_count FROM hotels
+                GROUP BY city COLLATE NOCASE ORDER BY hotels_count DESC
+            ''').fetchall()
+        cities = [(autocomplete_tokens(row['city']), row['city'], row['hotels_count']) for row in rows]
+        self._city_index = (version, cities)
+        return cities
+
+    # الفنادق داخل مربع إحداثيات (باستخدام فهرس R-tree) مع فلاتر السعر والتقييم
+    # أقرب limit فندقاً من center (مركز المربع افتراضياً) تُختار في SQL بمسافة تقريبية (خط العرض وخط الطول
+    # مضروباً في جيب تمام خط عرض المركز)، فلا يُنقل كل محتوى مربع كبير إلى Python
+    def get_hotels_in_box(self, min_lat, max_lat, min_lng, max_lng,
+                          min_price=None, max_price=None, min_rating=None,
+                          center=None, limit=NEARBY_MAX_LIMIT):
+        center_lat, center_lng = center or ((min_lat + max_lat) / 2, (min_lng + max_lng) / 2)
+        lng_scale = math.cos(math.radians(center_lat)) ** 2
+        where = "r.max_lat >= ? AND r.min_lat <= ? AND r.max_lng >= ? AND r.min_lng <= ?"
+        params = [min_lat, max_lat, min_lng, max_lng]
+        for condition, value in (("h.price >= ?", min_price), ("h.price <= ?", max_price),
+                                 ("h.rating >= ?", min_rating)):
+            if value is not None:
+                where += f" AND {condition}"
+                params.append(value)
+        # الربط مع جدول الفنادق داخل الاستعلام الفرعي فقط عند وجود فلاتر على أعمدته
+        join = " JOIN hotels h ON h.id = r.id" if len(params) > 4 else ""
+        sql = f'''
+            SELECT h.id, h.name, h.city, h.price, h.rating, h.image_url, h.latitude, h.longitude
+            FROM (
+                SELECT r.id FROM hotels_rtree r{join}
+                WHERE {where}
+                ORDER BY (r.min_lat - ?) * (r.min_lat - ?) + (r.min_lng - ?) * (r.min_lng - ?) * ?
+                LIMIT ?
+            ) nearest
+            JOIN hotels h ON h.id = nearest.id
+        '''
+        params += [center_lat, center_lat, center_lng, center_lng, lng_scale, limit]
+        with self.get_connection() as conn:
+            return [dict(row) for row in conn.execute(sql, params).fetchall()]
+
+    # أقرب الفنادق لنقطة مرتبة بالمسافة
+    # بدون radius_km يتوسع البحث تدريجياً حتى نجد limit فندقاً أو نصل للحد الأقصى
+    # box: حدود الخريطة الظاهرة؛ البحث يتوسع من المركز داخل المربع حتى يغطيه كاملاً،
+    # فالخريطة البعيدة (مربع كبير) تقرأ من الفهرس ما حول المركز فقط
+    def get_nearby_hotels(self, lat, lng, limit=NEARBY_DEFAULT_LIMIT, radius_km=None, box=None, **filters):
+        max_radius = NEARBY_MAX_RADIUS_KM
+        if box is not None:
+            corners = [(box_lat, box_lng) for box_lat in box[:2] for box_lng in box[2:]]
+            max_radius = max(NEARBY_START_RADIUS_KM, *(haversine_km(lat, lng, *corner) for corner in corners))
+        radius = radius_km or NEARBY_START_RADIUS_KM
+        while True:
+            area = bounding_box(lat, lng, radius)
+            if box is not None:
+                area = (max(area[0], box[0]), min(area[1], box[1]), max(area[2], box[2]), min(area[3], box[3]))
+            # الخطوة الأخيرة مع box تغطي المربع كله، فكل فندق داخله مقبول حتى خارج الدائرة
+            covered = box is not None and radius >= max_radius
+            # ضعف العدد من SQL حتى لا يُستبعد فندق قريب بسبب تقريب المسافة قبل ترتيبها بدقة هنا
+            hotels = []
+            for hotel in self.get_hotels_in_box(*area, center=(lat, lng), limit=limit * 2, **filters):
+                distance = haversine_km(lat, lng, hotel['latitude'], hotel['longitude'])
+                if distance <= radius or covered:
+                    hotel['distance_km'] = round(distance, 3)
+                    hotels.append(hotel)
+            # كل فندق أقرب من radius موجود داخل المربع، لذا النتيجة صحيحة إذا وجدنا limit فندقاً
+            if radius_km or len(hotels) >= limit or radius >= max_radius:
+                break
+            radius = min(radius * 4, max_radius)
+        hotels.sort(key=lambda h: h['distance_km'])
+        return hotels[:limit]
+
+    # الفنادق المتاحة في مدينة بين تاريخين مع أنواع الغرف المتاحة وعدد الغرف المتبقية
+    def get_available_hotels(self, city, check_in, check_out, rooms=1):
+        nights = stay_nights(check_in, check_out)
+        if not nights:
             return None
+        key = ("availability", city.strip().lower(), nights[0], len(nights), rooms)
+        try:
+            return self.read_flight.do(key, lambda: self._query_available_hotels(city, nights, rooms))
+        except FuturesTimeoutError:
+            return self._query_available_hotels(city, nights, rooms)
+
+    def _query_available_hotels(self, city, nights, rooms):
+        with self.get_connection() as conn:
+            rows = conn.execute('''
+                SELECT h.id AS hotel_id, h.name, h.city, h.rating, h.image_url,
+                       rt.id AS room_type_id, rt.name AS room_type, rt.capacity, rt.price,
+                       rt.total_rooms - COALESCE(MAX(inv.booked), 0) AS rooms_left
+                FROM hotels h
+                JOIN room_types rt ON rt.hotel_id = h.id
+                LEFT JOIN room_inventory inv
+                    ON inv.room_type_id = rt.id AND inv.night >= ? AND inv.night < ?
+                WHERE h.city = ? COLLATE NOCASE
+                GROUP BY rt.id
+                HAVING rooms_left >= ?
+                ORDER BY h.id, rt.price
+            ''', (nights[0], stay_end(nights), city.strip(), rooms)).fetchall()
+
+        hotels = {}
+        for row in rows:
+            hotel = hotels.setdefault(row['hotel_id'], {
+                "id": row['hotel_id'], "name": row['name'], "city": row['city'],
+                "rating": row['rating'], "image_url": row['image_url'], "room_types": []
+            })
+            hotel["room_types"].append({
+                "id": row['room_type_id'], "name": row['room_type'], "capacity": row['capacity'],
+                "price": row['price'], "rooms_left": row['rooms_left']
+            })
+        return list(hotels.values())
 
     # جلب حجوزات المستخدم
-    def get_user_bookings(self, user_id):
+    # before_id: جلب الحجوزات الأقدم من هذا الـ id (ترقيم بالمفتاح)
+    # fields: قائمة أعمدة اختيارية (من BOOKING_FIELDS) لتقليل حجم الاستجابة
+    def get_user_bookings(self, user_id, limit=None, before_id=None, fields=None):
+        columns = "*"
+        if fields:
+            selected = ["id"] + [f for f in BOOKING_FIELDS if f in fields and f != "id"]
+            columns = ", ".join(selected)
+
+        sql = f"SELECT {columns} FROM bookings WHERE user_id = ?"
+        params = [user_id]
+        if before_id is not None:
+            sql += " AND id < ?"
+            params.append(before_id)
+        sql += " ORDER BY id DESC"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+
         with self.get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute(
-                "SELECT * FROM bookings WHERE user_id = ? ORDER BY id DESC",
-                (user_id,)
-            )
+            cursor.execute(sql, params)
             return [dict(row) for row in cursor.fetchall()]
 
     # حذف حجز
     def delete_booking(self, booking_id, user_id):
+        def delete(cursor):
+            cursor.execute(
+                "SELECT room_type_id, check_in, check_out FROM bookings WHERE id = ? AND user_id = ?",
+                (booking_id, user_id)
+            )
+            booking = cursor.fetchone()
+            cursor.execute(
+                "DELETE FROM bookings WHERE id = ? AND user_id = ?",
+                (booking_id, user_id)
+            )
+            deleted = cursor.rowcount > 0
+            if deleted:
+                cursor.execute("DELETE FROM booking_analyses WHERE booking_id = ?", (booking_id,))
+                # إعادة الغرفة إلى المخزون
+                # (الحجوزات القديمة قد تحمل تواريخ بصيغة أخرى مثل 20260110 فتُوحد أولاً)
+                nights = stay_nights(booking['check_in'], booking['check_out'])
+                if booking['room_type_id'] is not None and nights:
+                    cursor.execute('''
+                        UPDATE room_inventory SET booked = booked - 1
+                        WHERE room_type_id = ? AND night >= ? AND night < ? AND booked > 0
+                    ''', (booking['room_type_id'], nights[0], stay_end(nights)))
+            return deleted
+
         try:
-            with self.get_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute(
-                    "DELETE FROM bookings WHERE id = ? AND user_id = ?",
-                    (booking_id, user_id)
-                )
-                conn.commit()
-                return cursor.rowcount > 0
+            return self.writer.execute(delete)
         except Exception:
             return False
 
+    # جلب نتيجة تحليل محفوظة لحجز
+    def get_booking_analysis(self, booking_id):
+        with self.get_connection() as conn:
+            row = conn.execute(
+                "SELECT result FROM booking_analyses WHERE booking_id = ?",
+                (booking_id,)
+            ).fetchone()
+            return json.loads(row['result']) if row else None
+
+    # إحصائيات أسعار مدينة من جدول city_price_stats (None إذا لم يكن فيها فنادق)
+    def get_city_price_stats(self, city):
+        with self.get_connection() as conn:
+            row = conn.execute("SELECT * FROM city_price_stats WHERE city = ?", (city,)).fetchone()
+            if row is None or row['hotels_count'] <= 0:
+                return None
+            row = dict(row)
+            if row['stale']:
+                # حدث تعديل على فنادق المدينة بعد آخر حفظ: الأدنى والأعلى والنسب المئوية تُحسب من اتصال
+                # القراءة بدون حفظ (القراءة لا تنتظر خيط الكتابة؛ الحفظ يتم بعد الاستيراد)
+                row.update(self._city_price_quartiles(conn, city))
+
+        count = row['hotels_count']
+        mean = row['price_sum'] / count
+        return {
+            "city": row['city'],
+            "hotels_count": count,
+            "min": row['price_min'],
+            "max": row['price_max'],
+            "mean": round(mean, 2),
+            "stddev": round(math.sqrt(max(row['price_sq_sum'] / count - mean * mean, 0)), 2),
+            "p25": row['price_p25'],
+            "p50": row['price_p50'],
+            "p75": row['price_p75'],
+            "avg_rating": round(row['rating_sum'] / count, 2),
+            "bookings_count": row['bookings_count'],
+            "avg_booked_price": (
+                round(row['booking_price_sum'] / row['bookings_count'], 2) if row['bookings_count'] else None
+            ),
+        }
+
+    # الأدنى والأعلى والنسب المئوية لأسعار مدينة (مسح نطاق واحد من فهرس city, price بدون ترتيب إضافي)
+    def _city_price_quartiles(self, cursor, city):
+        prices = [row[0] for row in cursor.execute(
+            "SELECT price FROM hotels WHERE city = ? COLLATE NOCASE ORDER BY price", (city,)
+        ).fetchall()]
+        if not prices:
+            return {"price_min": None, "price_max": None, "price_p25": None, "price_p50": None, "price_p75": None}
+        return {
+            "price_min": prices[0],
+            "price_max": prices[-1],
+            "price_p25": round(percentile(prices, 0.25), 2),
+            "price_p50": round(percentile(prices, 0.5), 2),
+            "price_p75": round(percentile(prices, 0.75), 2),
+        }
+
+    # حفظ الأدنى والأعلى والنسب المئوية لكل مدينة تغيّرت فنادقها (بعد الاستيراد وفي الترحيل)
+    def _refresh_stale_city_stats(self, cursor):
+        cities = [row[0] for row in cursor.execute("SELECT city FROM city_price_stats WHERE stale = 1").fetchall()]
+        for city in cities:
+            cursor.execute('''
+                UPDATE city_price_stats SET
+                    price_min = :price_min, price_max = :price_max,
+                    price_p25 = :price_p25, price_p50 = :price_p50, price_p75 = :price_p75, stale = 0
+                WHERE city = :city
+            ''', dict(self._city_price_quartiles(cursor, city), city=city))
+        return len(cities)
+
+    # مقارنة سعر حجز بأسعار فنادق مدينته محلياً (بدون الذكاء الاصطناعي)
+    def get_price_comparison(self, hotel_name, city, price):
+        stats = self.get_city_price_stats(city)
+        if stats is None:
+            return None
+        with self.get_connection() as conn:
+            hotel = conn.execute(
+                "SELECT rating FROM hotels WHERE name = ? AND city = ?", (hotel_name, city)
+            ).fetchone()
+        return compare_price(price, hotel['rating'] if hotel else None, stats)
+
+    # حفظ نتيجة تحليل حجز
+    def save_booking_analysis(self, booking_id, result):
+        payload = json.dumps(result, ensure_ascii=False)
+        self.writer.execute(lambda cursor: cursor.execute(
+            "INSERT OR REPLACE INTO booking_analyses (booking_id, result, created_at) VALUES (?, ?, ?)",
+            (booking_id, payload, datetime.now().isoformat())
+        ))
+
     # جلب حجز واحد بالـ id
     def get_booking_by_id(self, booking_id, user_id):
         with self.get_connection() as conn:
@@ -391,28 +2571,27 @@ class DBManager:
 
     # إضافة أو إزالة من المفضلة
     def toggle_favorite(self, user_id, item_name, city):
-        try:
-            with self.get_connection() as conn:
-                cursor = conn.cursor()
+        def toggle(cursor):
+            cursor.execute(
+                "SELECT 1 FROM favorites WHERE user_id = ? AND item_name = ?",
+                (user_id, item_name)
+            )
+
+            if cursor.fetchone():
                 cursor.execute(
-                    "SELECT 1 FROM favorites WHERE user_id = ? AND item_name = ?",
+                    "DELETE FROM favorites WHERE user_id = ? AND item_name = ?",
                     (user_id, item_name)
                 )
+                return False
+            else:
+                cursor.execute(
+                    "INSERT INTO favorites (user_id, item_name, city, added_at) VALUES (?, ?, ?, ?)",
+                    (user_id, item_name, city, datetime.now().isoformat())
+                )
+                return True
 
-                if cursor.fetchone():
-                    cursor.execute(
-                        "DELETE FROM favorites WHERE user_id = ? AND item_name = ?",
-                        (user_id, item_name)
-                    )
-                    conn.commit()
-                    return False
-                else:
-                    cursor.execute(
-                        "INSERT INTO favorites (user_id, item_name, city, added_at) VALUES (?, ?, ?, ?)",
-                        (user_id, item_name, city, datetime.now().isoformat())
-                    )
-                    conn.commit()
-                    return True
+        try:
+            return self.writer.execute(toggle)
         except Exception:
             return None
 
@@ -429,35 +2608,327 @@ class DBManager:
     # تحديث رقم الهاتف فقط
     def update_user_phone(self, user_id, phone):
         try:
-            conn = self.get_connection()
-            conn.execute(
+            self.writer.execute(lambda cursor: cursor.execute(
                 "UPDATE users SET phone = ? WHERE id = ?",
                 (phone, user_id)
-            )
-            conn.commit()
+            ))
+            self.user_cache.pop(str(user_id))
             return True
-        except sqlite3.IntegrityError:
+        except (sqlite3.IntegrityError, WriteQueueFull):
             return False
         except Exception as e:
             print(f"Error updating phone: {e}")
             return False
 
+    # جلب محادثة محفوظة (None إذا لم توجد أو انتهت صلاحيتها)
+    def get_conversation(self, conversation_id):
+        with self.get_connection() as conn:
+            row = conn.execute(
+                "SELECT summary, messages FROM chat_conversations WHERE id = ? AND updated_at > ?",
+                (conversation_id, time.time() - CHAT_TTL)
+            ).fetchone()
+            if not row:
+                return None
+            return {"summary": row['summary'], "messages": json.loads(row['messages'])}
+
+    # حفظ المحادثة (إضافة أو تحديث)
+    def save_conversation(self, conversation_id, summary, messages):
+        payload = json.dumps(messages, ensure_ascii=False)
+        self.writer.execute(lambda cursor: cursor.execute(
+            '''INSERT INTO chat_conversations (id, summary, messages, updated_at) VALUES (?, ?, ?, ?)
+               ON CONFLICT(id) DO UPDATE SET
+                   summary = excluded.summary,
+                   messages = excluded.messages,
+                   updated_at = excluded.updated_at''',
+            (conversation_id, summary, payload, time.time())
+        ))
+
+    # حذف المحادثات المنتهية الصلاحية
+    def purge_expired_conversations(self):
+        def purge(cursor):
+            cursor.execute(
+                "DELETE FROM chat_conversations WHERE updated_at <= ?",
+                (time.time() - CHAT_TTL,)
+            )
+            return cursor.rowcount
+
+        return self.writer.execute(purge)
+
+# قياس زمن كل دوال DBManager العامة (باسم الدالة)
+for _name, _func in list(vars(DBManager).items()):
+    if callable(_func) and not _name.startswith('_') and _name not in ('get_connection', 'close'):
+        setattr(DBManager, _name, metrics.timed('db_method_duration_seconds', _func, method=_name))
+
 # إنشاء مدير قاعدة البيانات
 db_manager = DBManager(DATABASE_FILE)
 
 # ----------------------------------------------------
-# 6. المسارات (Routes)
+# 11. المسارات (Routes)
 # ----------------------------------------------------
 
+# قياس عدد الطلبات وزمنها لكل مسار (قالب المسار وليس الرابط الفعلي حتى لا تتضخم الـ labels)
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.observe('http_request_duration_seconds', time.perf_counter() - started,
+                        route=route, method=request.method)
+        metrics.inc('http_requests_total', route=route, method=request.method, status=response.status_code)
+    return response
+
+# تحويل البيانات إلى JSON bytes مباشرة (orjson إن وجدت، وإلا المكتبة القياسية)
+def dumps_json(data):
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+# استجابة JSON سريعة لقوائم الـ API مع ضغط gzip إذا تجاوز الحجم الحد المسموح
+def json_response(data, status=200):
+    body = dumps_json(data)
+    response = Response(body, status=status, mimetype='application/json')
+    if len(body) >= JSON_COMPRESS_MIN_BYTES and 'gzip' in request.accept_encodings:
+        response.set_data(gzip.compress(body, compresslevel=JSON_COMPRESS_LEVEL))
+        response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return response
+
+# manifest الصور المصغرة: يُقرأ مرة واحدة ويُعاد تحميله فقط إذا تغيّر الملف
+_image_manifest = {"mtime": None, "data": {}}
+
+def load_image_manifest():
+    try:
+        mtime = os.path.getmtime(IMAGE_MANIFEST_FILE)
+    except OSError:
+        return {}
+    if mtime != _image_manifest["mtime"]:
+        try:
+            with open(IMAGE_MANIFEST_FILE, encoding='utf-8') as f:
+                _image_manifest["data"] = json.load(f)
+        except (OSError, ValueError):
+            _image_manifest["data"] = {}
+        _image_manifest["mtime"] = mtime
+    return _image_manifest["data"]
+
+# حقول الصور الجاهزة لـ srcset من الـ manifest (فارغة إذا لم تُبنَ الصور)
+# image_url في قاعدة البيانات بالشكل ./static/image/Hotel1.jpg
+def image_variant_fields(image_url, prefix='image'):
+    if not image_url:
+        return {}
+    key = image_url.split('static/', 1)[-1].lstrip('./')
+    variants = load_image_manifest().get(key)
+    if not variants:
+        return {}
+    ordered = sorted(variants.values(), key=lambda v: v['width'])
+    return {
+        f"{prefix}_thumb_url": variants.get('thumb', ordered[0])['url'],
+        f"{prefix}_srcset": ", ".join(f"{v['url']} {v['width']}w" for v in ordered),
+    }
+
+# ----------------------------------------------------
+# الملفات الثابتة: ضغط مسبق (gzip/brotli) وأسماء بالبصمة
+# ----------------------------------------------------
+
+class StaticAsset:
+    def __init__(self, data, mimetype, compress):
+        self.mimetype = mimetype
+        self.etag = hashlib.sha256(data).hexdigest()[:16]
+        # الترميز -> المحتوى (نحتفظ بالنسخة المضغوطة فقط إذا كانت أصغر)
+        self.variants = {"identity": data}
+        if compress:
+            gz = gzip.compress(data, compresslevel=9, mtime=0)
+            if len(gz) < len(data):
+                self.variants["gzip"] = gz
+            if brotli is not None:
+                br = brotli.compress(data, quality=11)
+                if len(br) < len(data):
+                    self.variants["br"] = br
+
+class StaticAssets:
+    def __init__(self, static_dir, check_interval=ASSET_CHECK_SECONDS):
+        self.static_dir = static_dir
+        self.check_interval = check_interval
+        self._checked = 0.0
+        self.assets = {}        # المسار (نسبة إلى static) -> StaticAsset
+        self.hashed_names = {}  # المسار الأصلي -> المسار بالبصمة
+        self.hashed_paths = set()  # كل المسارات ذات البصمة (محتواها لا يتغير أبداً)
+        self._mtimes = None
+        self._lock = threading.Lock()
+
+    def _scan_mtimes(self):
+        mtimes = {}
+        for folder, _, files in os.walk(os.path.join(self.static_dir, 'assets')):
+            for name in files:
+                path = os.path.join(folder, name)
+                mtimes[path] = os.path.getmtime(path)
+        mtimes[os.path.join(self.static_dir, 'index.html')] = os.path.getmtime(
+            os.path.join(self.static_dir, 'index.html'))
+        return mtimes
+
+    # إعادة البناء فقط إذا تغيّر أي ملف (يُستدعى مع كل طلب للصفحة الرئيسية أو لملف ثابت)
+    # فحص الملفات نفسه مرة كل check_interval ثانية على الأكثر، إلا في وضع التطوير
+    def refresh(self):
+        now = time.monotonic()
+        if self._mtimes is not None and not app.debug and now - self._checked < self.check_interval:
+            return
+        self._checked = now
+        mtimes = self._scan_mtimes()
+        if mtimes == self._mtimes:
+            return
+        with self._lock:
+            if mtimes != self._mtimes:
+                self._build()
+                self._mtimes = mtimes
+
+    def _build(self):
+        assets, hashed_names = {}, {}
+        for folder, _, files in os.walk(os.path.join(self.static_dir, 'assets')):
+            for name in files:
+                path = os.path.join(folder, name)
+                rel = os.path.relpath(path, self.static_dir).replace(os.sep, '/')
+                with open(path, 'rb') as f:
+                    data = f.read()
+                asset = StaticAsset(
+                    data,
+                    mimetypes.guess_type(name)[0] or 'application/octet-stream',
+                    name.endswith(COMPRESSIBLE_ASSET_TYPES)
+                )
+                root, ext = os.path.splitext(rel)
+                hashed = f"{root}.{asset.etag[:10]}{ext}"
+                assets[rel] = assets[hashed] = asset
+                hashed_names[rel] = hashed
+
+        # استبدال روابط الملفات في index.html بالأسماء ذات البصمة
+        with open(os.path.join(self.static_dir, 'index.html'), encoding='utf-8') as f:
+            html = f.read()
+        for rel, hashed in hashed_names.items():
+            html = html.replace(f'/{rel}', f'/{hashed}')
+        assets['index.html'] = StaticAsset(html.encode('utf-8'), 'text/html', True)
+
+        self.assets, self.hashed_names = assets, hashed_names
+        self.hashed_paths = set(hashed_names.values())
+
+    def get(self, path):
+        if self._mtimes is None:
+            self.refresh()
+        return self.assets.get(path)
+
+    # إرجاع الملف بالترميز المناسب لـ Accept-Encoding مع ETag قوي
+    def response(self, path, immutable):
+        asset = self.get(path)
+        if asset is None:
+            return None
+        encoding = "identity"
+        for candidate in ("br", "gzip"):
+            if candidate in asset.variants and candidate in request.accept_encodings:
+                encoding = candidate
+                break
+        # لكل ترميز ETag مختلف لأن المحتوى المرسل مختلف
+        etag = asset.etag if encoding == "identity" else f"{asset.etag}-{encoding}"
+
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = Response(asset.variants[encoding], mimetype=asset.mimetype)
+            if encoding != "identity":
+                response.headers['Content-Encoding'] = encoding
+        response.set_etag(etag)
+        response.vary.add('Accept-Encoding')
+        if immutable:
+            response.headers['Cache-Control'] = f'public, max-age={ASSET_MAX_AGE}, immutable'
+        else:
+            response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+# البناء عند بدء التشغيل حتى لا يدفع أول طلب ثمن ضغط الملفات
+static_assets = StaticAssets(STATIC_DIR)
+static_assets.refresh()
+
 @app.route('/')
 def index():
-    return send_from_directory(STATIC_DIR, 'index.html')
+    static_assets.refresh()
+    return static_assets.response('index.html', immutable=False)
+
+@app.route('/assets/<path:filename>')
+def serve_asset(filename):
+    path = f'assets/{filename}'
+    # فحص تعديل الملفات قبل تحديد نوع التخزين (أول طلب قبل أي بناء أو ملف عُدّل بعد آخر بناء)
+    static_assets.refresh()
+    # ذات البصمة فقط لا تتغير أبداً، والأسماء الأصلية يجب التحقق منها في كل مرة
+    response = static_assets.response(path, immutable=path in static_assets.hashed_paths)
+    if response is None:
+        return send_from_directory(STATIC_DIR, path)
+    return response
+
+# ترميز مؤشر الصفحة التالية كنص آمن للروابط
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip("=")
+
+# فك ترميز المؤشر (يرجع None إذا كان غير صالح أو عدد قيمه لا يساوي length)
+def decode_cursor(token, length=None):
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(values, list) or not values or not all(
+        isinstance(v, (int, float)) and not isinstance(v, bool) for v in values
+    ):
+        return None
+    if length is not None and len(values) != length:
+        return None
+    return values
+
+# قراءة رقم اختياري من query string (يرفع ValueError إذا كان غير صالح)
+def optional_float_arg(name):
+    value = request.args.get(name)
+    if value is None or value == '':
+        return None
+    return float(value)
 
 @app.route('/api/search', methods=['GET'])
 def search_hotels():
     city = request.args.get('city', 'Dubai')
-    results = db_manager.search_hotels(city)
-    return jsonify(results)
+    sort = request.args.get('sort', 'default')
+    if sort not in SEARCH_SORTS:
+        return jsonify({"message": "طريقة الترتيب غير مدعومة"}), 400
+
+    try:
+        min_price = optional_float_arg('min_price')
+        max_price = optional_float_arg('max_price')
+        min_rating = optional_float_arg('min_rating')
+        limit = int(request.args.get('limit', SEARCH_DEFAULT_LIMIT))
+    except ValueError:
+        return jsonify({"message": "قيم البحث غير صالحة"}), 400
+    limit = max(1, min(limit, SEARCH_MAX_LIMIT))
+
+    cursor = None
+    if request.args.get('cursor'):
+        # ترتيب id يحتاج قيمة واحدة، وباقي الترتيبات (العمود، id)
+        cursor = decode_cursor(request.args['cursor'], 1 if SEARCH_SORTS[sort][0] == 'id' else 2)
+        if cursor is None:
+            return jsonify({"message": "مؤشر الصفحة غير صالح"}), 400
+
+    results = db_manager.search_hotels(
+        city, min_price, max_price, min_rating,
+        sort=sort, limit=limit, cursor=cursor
+    )
+
+    # إضافة روابط الصور المصغرة (نسخة من كل صف حتى لا نعدل نتائج الكاش)
+    results = [dict(h, **image_variant_fields(h.get('image_url'))) for h in results]
+
+    response = json_response(results)
+    # مؤشر الصفحة التالية يُرسل في الهيدر للحفاظ على شكل الاستجابة (قائمة)
+    if len(results) == limit:
+        column = SEARCH_SORTS[sort][0]
+        last = results[-1]
+        values = [last['id']] if column == 'id' else [last[column], last['id']]
+        response.headers['X-Next-Cursor'] = encode_cursor(values)
+    return response
 
 @app.route('/api/register', methods=['POST'])
 def register():
@@ -551,18 +3022,147 @@ def create_booking():
     if not user_booking_name:
         return jsonify({"message": "اسم الحجز مطلوب"}), 400
 
-    res = db_manager.add_booking(
+    booking_id, error = db_manager.add_booking(
         current_user.id,
         user_booking_name,
         data
     )
 
-    return jsonify({"message": "تم الحجز بنجاح", "id": res}), 200 if res else (jsonify({"message": "فشل في إضافة الحجز"}), 500)
+    if booking_id:
+        return jsonify({"message": "تم الحجز بنجاح", "id": booking_id}), 200
+    message, status = BOOKING_ERRORS[error]
+    return jsonify({"message": message}), status
+
+@app.route('/api/autocomplete', methods=['GET'])
+def autocomplete():
+    try:
+        limit = int(request.args.get('limit', AUTOCOMPLETE_DEFAULT_LIMIT))
+    except ValueError:
+        return jsonify({"message": "قيم البحث غير صالحة"}), 400
+    limit = max(1, min(limit, AUTOCOMPLETE_MAX_LIMIT))
+    response = json_response(db_manager.autocomplete(request.args.get('q', ''), limit))
+    # الاقتراحات تتغير فقط مع تغيّر الفنادق، فيمكن للمتصفح الاحتفاظ بها قليلاً
+    response.headers['Cache-Control'] = 'public, max-age=60'
+    return response
+
+# صيغة ملف الكتالوج من الامتداد أو نوع المحتوى
+def catalog_format(filename=None, content_type=None):
+    name = (filename or '').lower()
+    if name.endswith(('.jsonl', '.ndjson')) or 'json' in (content_type or ''):
+        return 'jsonl'
+    return 'csv'
+
+# استيراد كتالوج الفنادق (ملف مرفوع أو جسم الطلب مباشرة) بدون تحميله كاملاً في الذاكرة
+@app.route('/api/hotels/import', methods=['POST'])
+def import_hotels_api():
+    token = request.headers.get('X-Import-Token')
+    if not CATALOG_IMPORT_TOKEN or token != CATALOG_IMPORT_TOKEN:
+        return jsonify({"message": "غير مصرح"}), 403
+
+    upload = request.files.get('file')
+    if upload:
+        stream, filename, content_type = upload.stream, upload.filename, upload.mimetype
+    else:
+        stream, filename, content_type = request.stream, None, request.mimetype
+    fmt = request.args.get('format') or catalog_format(filename, content_type)
+    if fmt not in ('csv', 'jsonl'):
+        return jsonify({"message": "صيغة غير مدعومة"}), 400
+
+    # الاستيراد من الـ API يمر بدفعات صغيرة عبر خيط الكتابة (بدون تأجيل الفهارس)
+    # حتى لا يحجز قفل الكتابة ويوقف الحجوزات أثناء تحميل ملف كبير
+    errors = []
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    try:
+        stats = db_manager.import_hotels(
+            validate_catalog_rows(read_catalog_rows(text, fmt), errors), chunk_size=IMPORT_API_CHUNK_SIZE
+        )
+    except (UnicodeDecodeError, csv.Error):
+        return jsonify({"message": "ملف غير صالح"}), 400
+    except WriteQueueFull:
+        return jsonify({"message": "الخدمة مشغولة حالياً، حاول لاحقاً"}), 503
+    finally:
+        text.detach()
+    stats.update(skipped=len(errors), errors=[
+        {"line": line, "message": message} for line, message in errors[:IMPORT_MAX_ERRORS]
+    ])
+    return jsonify(stats), 200
+
+@app.route('/api/hotels/nearby', methods=['GET'])
+def nearby_hotels():
+    try:
+        filters = {
+            "min_price": optional_float_arg('min_price'),
+            "max_price": optional_float_arg('max_price'),
+            "min_rating": optional_float_arg('min_rating'),
+        }
+        limit = int(request.args.get('limit', NEARBY_DEFAULT_LIMIT))
+        lat, lng = optional_float_arg('lat'), optional_float_arg('lng')
+        radius_km = optional_float_arg('radius_km')
+        box = [optional_float_arg(k) for k in ('min_lat', 'max_lat', 'min_lng', 'max_lng')]
+    except ValueError:
+        return jsonify({"message": "قيم البحث غير صالحة"}), 400
+    limit = max(1, min(limit, NEARBY_MAX_LIMIT))
+
+    if lat is not None and lng is not None:
+        if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+            return jsonify({"message": "إحداثيات غير صالحة"}), 400
+        if radius_km is not None:
+            radius_km = max(0.1, min(radius_km, NEARBY_MAX_RADIUS_KM))
+        hotels = db_manager.get_nearby_hotels(lat, lng, limit, radius_km, **filters)
+    elif all(v is not None for v in box):
+        # البحث داخل المربع الظاهر في الخريطة: أقرب limit فندقاً من مركزه
+        center_lat, center_lng = (box[0] + box[1]) / 2, (box[2] + box[3]) / 2
+        hotels = db_manager.get_nearby_hotels(center_lat, center_lng, limit, box=box, **filters)
+    else:
+        return jsonify({"message": "يجب تحديد lat و lng أو حدود المربع"}), 400
+
+    return json_response(hotels)
+
+@app.route('/api/availability', methods=['GET'])
+def availability():
+    try:
+        rooms = max(1, int(request.args.get('rooms', 1)))
+    except ValueError:
+        return jsonify({"message": "عدد الغرف غير صالح"}), 400
+    hotels = db_manager.get_available_hotels(
+        request.args.get('city', 'Dubai'),
+        request.args.get('check_in'),
+        request.args.get('check_out'),
+        rooms
+    )
+    if hotels is None:
+        return jsonify({"message": BOOKING_ERRORS["dates"][0]}), 400
+    return json_response(hotels)
 
 @app.route('/api/bookings', methods=['GET'])
 @login_required
 def get_bookings():
-    return jsonify(db_manager.get_user_bookings(current_user.id))
+    try:
+        limit = int(request.args.get('limit', BOOKINGS_DEFAULT_LIMIT))
+        before_id = request.args.get('before_id')
+        before_id = int(before_id) if before_id else None
+    except ValueError:
+        return jsonify({"message": "قيم الصفحة غير صالحة"}), 400
+    limit = max(1, min(limit, BOOKINGS_MAX_LIMIT))
+
+    fields = None
+    if request.args.get('fields'):
+        fields = [f.strip() for f in request.args['fields'].split(',') if f.strip()]
+        if any(f not in BOOKING_FIELDS for f in fields):
+            return jsonify({"message": "حقول غير مدعومة"}), 400
+
+    bookings = db_manager.get_user_bookings(
+        current_user.id, limit=limit, before_id=before_id, fields=fields
+    )
+    for booking in bookings:
+        if booking.get('hotel_image_url'):
+            booking.update(image_variant_fields(booking['hotel_image_url'], prefix='hotel_image'))
+
+    response = json_response(bookings)
+    # مؤشر الصفحة التالية: آخر id في الصفحة الحالية
+    if len(bookings) == limit:
+        response.headers['X-Next-Before-Id'] = str(bookings[-1]['id'])
+    return response
 
 @app.route('/api/booking/<int:booking_id>', methods=['DELETE'])
 @login_required
@@ -574,7 +3174,7 @@ def delete_booking(booking_id):
 @app.route('/api/favorites', methods=['GET'])
 @login_required
 def get_favorites():
-    return jsonify(db_manager.get_user_favorites(current_user.id))
+    return json_response(db_manager.get_user_favorites(current_user.id))
 
 @app.route('/api/favorites/toggle', methods=['POST'])
 @login_required
@@ -590,71 +3190,517 @@ def toggle_favorite():
 # ----------------------------------------------------
 # 4. الذكاء الاصطناعي (حقن البيانات الديناميكية)
 # ----------------------------------------------------
-@app.route('/api/gemini/chat', methods=['POST'])
-def gemini_chat():
-    data = request.get_json(silent=True) or {}
-    user_prompt = data.get('prompt')
-    if not user_prompt: return jsonify({"response": "..."}), 400
-    
-    # جلب بيانات الفنادق الحقيقية من قاعدة البيانات
-    hotels_context = db_manager.get_all_hotels_formatted()
-    
-    # 🌟 التعليمات مع حقن البيانات
-    SYSTEM_INSTRUCTION_TEXT = f"""
+
+# محددات استخدام الذكاء الاصطناعي (داخل العملية الواحدة)
+chat_limiter = RateLimiter(*CHAT_RATE_LIMIT)
+chat_ip_limiter = RateLimiter(*CHAT_IP_RATE_LIMIT)
+analyze_limiter = RateLimiter(*ANALYZE_RATE_LIMIT)
+gemini_slots = ConcurrencyLimiter(GEMINI_MAX_CONCURRENT, GEMINI_QUEUE_TIMEOUT)
+
+# مفتاح العميل للتحديد: المستخدم المسجل، وإلا معرف عشوائي محفوظ في الجلسة
+def rate_limit_key():
+    if current_user.is_authenticated:
+        return f"user:{current_user.id}"
+    if 'client_id' not in session:
+        session['client_id'] = uuid.uuid4().hex
+    return f"session:{session['client_id']}"
+
+# رد سريع عند تجاوز الحد مع Retry-After (بالثواني، مقرباً للأعلى)
+def limit_response(retry_after, status=429, key="message"):
+    retry_after = max(1, math.ceil(retry_after))
+    messages = {429: "طلبات كثيرة، حاول بعد قليل", 503: "الخدمة مشغولة حالياً، حاول لاحقاً"}
+    response = jsonify({key: messages[status], "retry_after": retry_after})
+    response.status_code = status
+    response.headers['Retry-After'] = str(retry_after)
+    metrics.inc('rate_limited_total', route=request.url_rule.rule if request.url_rule else 'unmatched',
+                status=status)
+    return response
+
+# تطبيق حدود المستخدم/الجلسة ثم IP (يرجع رد 429 أو None)
+def check_chat_limits():
+    retry_after = chat_limiter.acquire(rate_limit_key()) or chat_ip_limiter.acquire(request.remote_addr)
+    return limit_response(retry_after, key="response") if retry_after else None
+
+# قياس زمن استدعاء Gemini وتسجيل الأخطاء بدلاً من إخفائها
+@contextmanager
+def gemini_metrics(operation):
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        metrics.inc('gemini_failures_total', operation=operation)
+        app.logger.exception("Gemini %s call failed", operation)
+        raise
+    finally:
+        metrics.observe('gemini_request_duration_seconds', time.perf_counter() - start, operation=operation)
+
+# عدد الـ tokens المستهلكة من usage_metadata في استجابة Gemini
+def record_gemini_usage(operation, response):
+    usage = getattr(response, 'usage_metadata', None)
+    if usage is None:
+        return
+    for kind, field in (("prompt", "prompt_token_count"), ("completion", "candidates_token_count")):
+        count = getattr(usage, field, None)
+        if count:
+            metrics.inc('gemini_tokens_total', count, operation=operation, kind=kind)
+
+# كاش إجابات السؤال الأول (بدون سياق محادثة سابق)
+# المفتاح: (السؤال بعد التوحيد، بصمة الفنادق المختارة) فتغيّر هذه الفنادق يلغي الإجابات القديمة تلقائياً
+chat_answer_cache = LRUCache(maxsize=CHAT_CACHE_SIZE, ttl=CHAT_CACHE_TTL)
+
+# 🌟 التعليمات مع حقن بيانات الفنادق (المختارة حسب السؤال)
+def build_system_instruction(hotels_context):
+    return f"""
     أنت المساعد الذكي لتطبيق "Restavo" المتخصص في حجز الفنادق.
     
     🛑 **قاعدة صارمة جداً:** لديك قائمة محددة من الفنادق التي يدعمها التطبيق. **يجب عليك الاقتراح والإجابة بناءً على هذه القائمة فقط.**
     لا تخترع فنادق غير موجودة، ولا تقترح فنادق خارجية (مثل Booking.com وغيرها).
     
-    🏨 **قائمة الفنادق المتاحة لدينا:**
+    🏨 **قائمة الفنادق المتاحة لدينا (الأكثر صلة بسؤال المستخدم):**
     {hotels_context}
     
     تعليمات إضافية:
     1. إذا سأل المستخدم عن فندق في مدينة موجودة في القائمة أعلاه، اقترح عليه الخيارات المتاحة مع ذكر السعر.
-    2. إذا سأل عن مدينة غير موجودة (مثلاً باريس)، اعتذر بلطف وقل أننا لا نخدم هذه المدينة حالياً.
+    2. إذا سأل عن مدينة غير موجودة في قائمة المدن (مثلاً باريس)، اعتذر بلطف وقل أننا لا نخدم هذه المدينة حالياً.
     3. تحدث باللغة العربية بأسلوب مفيد ومختصر.
     """
 
-    # التعامل مع الذاكرة (إعادة تعيين إذا تغيرت التعليمات أو البيانات)
-    # ملاحظة: بما أن بيانات الفنادق قد تتغير، قد نحتاج لتحديث الـ System Prompt دائماً
-    # ولكن للتبسيط هنا، سنقوم بإعادة إنشاء المحادثة إذا كانت فارغة أو إذا أردنا تحديث السياق في كل مرة.
-    # الخيار الأفضل هنا هو إرسال التاريخ كاملاً مع التعليمات الجديدة في كل طلب إذا أمكن، 
-    # أو الاعتماد على أن Gemini يتذكر السياق في الجلسة الواحدة.
-    
-    # هنا سنقوم ببدء جلسة جديدة إذا لم توجد، وسنستخدم الـ System Prompt المحدث.
-    chat_history = session.get('chat_history', [])
-    
-    # للتحقق مما إذا كان السياق قديماً (اختياري، لكن هنا سنفترض التجديد عند الحاجة)
-    # سنقوم ببناء history جديد يبدأ دائماً بالتعليمات المحدثة لضمان دقة البيانات
-    if not chat_history or chat_history[0].get('parts')[0] != SYSTEM_INSTRUCTION_TEXT:
-         chat_history = [
-            {"role": "user", "parts": [SYSTEM_INSTRUCTION_TEXT]},
-            {"role": "model", "parts": ["فهمت. سأقترح الفنادق الموجودة في القائمة المتاحة فقط."]}
+# كاش نص التعليمات لكل سياق فنادق مختار (حتى لا يُبنى النص في كل طلب)
+system_instruction_cache = LRUCache(maxsize=CHAT_CONTEXT_CACHE_SIZE)
+
+def get_system_instruction(catalog):
+    text = system_instruction_cache.get(catalog.hash)
+    if text is None:
+        text = build_system_instruction(catalog.context)
+        system_instruction_cache.set(catalog.hash, text)
+    return text
+
+# نص اختيار الفنادق: السؤال الحالي + آخر سؤال سابق (لأسئلة المتابعة مثل "وأرخص منه؟")
+def chat_retrieval_query(user_prompt, messages):
+    previous = [" ".join(m['parts']) for m in messages if m['role'] == 'user'][-1:]
+    return " ".join(previous + [user_prompt])
+
+# ضغط المحادثة: الرسائل الأقدم من الميزانية تُنقل إلى ملخص مختصر
+# يرجع (الملخص، الرسائل المتبقية)
+def compact_conversation(summary, messages):
+    messages = list(messages)
+    lines = [summary] if summary else []
+
+    def over_budget():
+        total_chars = sum(len(part) for m in messages for part in m['parts'])
+        return len(messages) > CHAT_MAX_MESSAGES or total_chars > CHAT_MAX_CHARS
+
+    while len(messages) > 2 and over_budget():
+        question, answer = messages[0], messages[1]
+        messages = messages[2:]
+        lines.append(
+            f"- سأل المستخدم: {' '.join(question['parts'])[:150]}"
+            f" | أجاب المساعد: {' '.join(answer['parts'])[:150]}"
+        )
+
+    summary = "\n".join(lines)
+    if len(summary) > CHAT_SUMMARY_MAX_CHARS:
+        # نحتفظ بالجزء الأحدث من الملخص
+        summary = summary[-CHAT_SUMMARY_MAX_CHARS:].split("\n", 1)[-1]
+    return summary, messages
+
+# بناء السجل المرسل للنموذج: التعليمات + ملخص ما سبق + آخر الرسائل
+def build_chat_history(catalog, summary, messages):
+    history = [
+        {"role": "user", "parts": [get_system_instruction(catalog)]},
+        {"role": "model", "parts": ["فهمت. سأقترح الفنادق الموجودة في القائمة المتاحة فقط."]}
+    ]
+    if summary:
+        history += [
+            {"role": "user", "parts": [f"ملخص المحادثة السابقة:\n{summary}"]},
+            {"role": "model", "parts": ["حسناً، سأراعي هذا الملخص في إجاباتي."]}
         ]
+    return history + messages
+
+# توحيد نص السؤال: حروف صغيرة، مسافات موحدة، بدون علامات ترقيم في النهاية
+def normalize_prompt(prompt):
+    text = " ".join(prompt.lower().split())
+    return text.rstrip(" ?!.؟،,")
+
+# دمج نفس السؤال الأول المتزامن (نفس مفتاح كاش الإجابة) في استدعاء Gemini واحد
+chat_flight = SingleFlight(CHAT_FLIGHT_TIMEOUT)
+
+# تحميل محادثة المستخدم من السيرفر (أو بدء محادثة جديدة)
+# الجلسة (الكوكي) تحمل معرف المحادثة فقط
+def load_chat_conversation():
+    if 'chat_history' in session:
+        session.pop('chat_history')  # سجل قديم من الإصدارات السابقة
+    conversation_id = session.get('chat_id')
+    conversation = db_manager.get_conversation(conversation_id) if conversation_id else None
+    if conversation is None:
+        # تنظيف المحادثات المنتهية صيانة فقط: تُتخطى إذا كان خيط الكتابة مشغولاً
+        try:
+            db_manager.purge_expired_conversations()
+        except WriteQueueFull:
+            pass
+        conversation_id = uuid.uuid4().hex
+        session['chat_id'] = conversation_id
+        conversation = {"summary": "", "messages": []}
+    return conversation_id, conversation['summary'], conversation['messages']
+
+# مفتاح كاش الإجابة: فقط للسؤال الأول في المحادثة لأنه لا يعتمد على سياق سابق
+def chat_cache_key(catalog, summary, messages, user_prompt):
+    if summary or messages or catalog.version is None:
+        return None
+    return (normalize_prompt(user_prompt), catalog.hash)
+
+# حفظ الرسائل الجديدة ثم ضغط ما زاد عن الميزانية
+def save_chat_turn(conversation_id, summary, messages, new_messages):
+    summary, messages = compact_conversation(summary, messages + new_messages)
+    db_manager.save_conversation(conversation_id, summary, messages)
+
+@app.route('/api/gemini/chat', methods=['POST'])
+def gemini_chat():
+    data = request.get_json(silent=True) or {}
+    user_prompt = data.get('prompt')
+    if not user_prompt: return jsonify({"response": "..."}), 400
+    limited = check_chat_limits()
+    if limited: return limited
     
-    try:
+    conversation_id, summary, messages = load_chat_conversation()
+    # الفنادق المتعلقة بالسؤال فقط (حجم التعليمات لا يكبر مع عدد الفنادق)
+    catalog = db_manager.get_chat_context(chat_retrieval_query(user_prompt, messages))
+
+    cache_key = chat_cache_key(catalog, summary, messages, user_prompt)
+    if cache_key is not None:
+        cached_answer = chat_answer_cache.get(cache_key)
+        if cached_answer is not None:
+            try:
+                save_chat_turn(conversation_id, summary, messages, [
+                    {"role": "user", "parts": [user_prompt]},
+                    {"role": "model", "parts": [cached_answer]}
+                ])
+            except WriteQueueFull:
+                return jsonify({"response": "الخدمة مشغولة حالياً، حاول لاحقاً"}), 503
+            return jsonify({"response": cached_answer})
+
+    def ask_gemini():
         model = genai.GenerativeModel('gemini-2.5-flash')
-        chat = model.start_chat(history=chat_history)
-        response = chat.send_message(user_prompt)
-        session['chat_history'] = [message_to_dict(m) for m in chat.history]
-        return jsonify({"response": response.text})
+        history = build_chat_history(catalog, summary, messages)
+        chat = model.start_chat(history=history)
+        with gemini_slots.slot(), gemini_metrics('chat'):
+            response = chat.send_message(user_prompt)
+        record_gemini_usage('chat', response)
+        if cache_key is not None:
+            chat_answer_cache.set(cache_key, response.text)
+        return response.text
+
+    try:
+        # نفس السؤال الأول من عدة مستخدمين في نفس اللحظة يُرسل لـ Gemini مرة واحدة
+        answer = chat_flight.do(cache_key, ask_gemini) if cache_key is not None else ask_gemini()
+        # نحفظ الرسائل الجديدة فقط (بدون التعليمات والملخص)
+        save_chat_turn(conversation_id, summary, messages, [
+            {"role": "user", "parts": [user_prompt]},
+            {"role": "model", "parts": [answer]}
+        ])
+        return jsonify({"response": answer})
+    except (LLMBusy, FuturesTimeoutError):
+        return limit_response(GEMINI_QUEUE_TIMEOUT, status=503, key="response")
+    except WriteQueueFull:
+        return jsonify({"response": "الخدمة مشغولة حالياً، حاول لاحقاً"}), 503
     except Exception: return jsonify({"response": "خطأ في الاتصال"}), 500
 
+# تنسيق حدث Server-Sent Events
+def sse_event(data, event=None):
+    payload = f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+    return f"event: {event}\n{payload}" if event else payload
+
+# نسخة متدفقة من المحادثة: تُرسل أجزاء الإجابة فور وصولها من Gemini
+@app.route('/api/gemini/chat/stream', methods=['POST'])
+def gemini_chat_stream():
+    data = request.get_json(silent=True) or {}
+    user_prompt = data.get('prompt')
+    if not user_prompt: return jsonify({"response": "..."}), 400
+    limited = check_chat_limits()
+    if limited: return limited
+
+    # يجب تحميل المحادثة قبل بدء الإرسال لأن الكوكي لا يمكن تعديله بعد إرسال الهيدرز
+    conversation_id, summary, messages = load_chat_conversation()
+    catalog = db_manager.get_chat_context(chat_retrieval_query(user_prompt, messages))
+    cache_key = chat_cache_key(catalog, summary, messages, user_prompt)
+    cached_answer = chat_answer_cache.get(cache_key) if cache_key is not None else None
+
+    # نفس السؤال الأول الجاري بثه لمستخدم آخر: ننتظر إجابته بدلاً من استدعاء Gemini مرة ثانية
+    future, leader = None, True
+    if cached_answer is None and cache_key is not None:
+        future, leader = chat_flight.claim(cache_key)
+
+    # حجز مكان لاستدعاء Gemini قبل إرسال الهيدرز حتى يمكن الرد بـ 503 عند الانشغال
+    # المكان يبقى محجوزاً طوال البث ويُحرر مرة واحدة عند انتهائه أو إغلاق الاتصال
+    # (ومعه يُنهى الـ single-flight حتى لا ينتظره الآخرون إذا أُغلق البث قبل اكتماله)
+    released = []
+    def release_slot(answer=None, error=None):
+        if not released:
+            released.append(True)
+            gemini_slots.release()
+            if future is not None:
+                if answer is None and error is None:
+                    error = RuntimeError("stream closed before completion")
+                chat_flight.finish(cache_key, future, answer, error)
+
+    if cached_answer is None and leader:
+        try:
+            gemini_slots.acquire()
+        except LLMBusy as e:
+            if future is not None:
+                chat_flight.finish(cache_key, future, error=e)
+            return limit_response(GEMINI_QUEUE_TIMEOUT, status=503, key="response")
+    else:
+        released.append(True)
+
+    def generate():
+        answer = cached_answer
+        if answer is None and not leader:
+            try:
+                answer = future.result(CHAT_FLIGHT_TIMEOUT)
+            except Exception:
+                yield sse_event({"response": "خطأ في الاتصال"}, event="error")
+                return
+        if answer is not None:
+            save_chat_turn(conversation_id, summary, messages, [
+                {"role": "user", "parts": [user_prompt]},
+                {"role": "model", "parts": [answer]}
+            ])
+            yield sse_event({"text": answer})
+            yield sse_event({}, event="done")
+            return
+
+        try:
+            model = genai.GenerativeModel('gemini-2.5-flash')
+            history = build_chat_history(catalog, summary, messages)
+            chat = model.start_chat(history=history)
+            chunks = []
+            # الزمن المقاس يشمل استقبال كل الأجزاء
+            with gemini_metrics('chat_stream'):
+                stream = chat.send_message(user_prompt, stream=True)
+                for chunk in stream:
+                    if chunk.text:
+                        chunks.append(chunk.text)
+                        yield sse_event({"text": chunk.text})
+            record_gemini_usage('chat_stream', stream)
+            answer = "".join(chunks)
+            if cache_key is not None:
+                chat_answer_cache.set(cache_key, answer)
+            release_slot(answer)
+            save_chat_turn(conversation_id, summary, messages, [
+                {"role": "user", "parts": [user_prompt]},
+                {"role": "model", "parts": [answer]}
+            ])
+            yield sse_event({}, event="done")
+        except Exception as e:
+            release_slot(error=e)
+            yield sse_event({"response": "خطأ في الاتصال"}, event="error")
+        finally:
+            release_slot()
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    response.call_on_close(release_slot)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # منع التخزين المؤقت في Nginx
+    return response
+
+# طابور تحليل الحجوزات: الطلب يرجع فوراً بمعرف مهمة بدلاً من حجز عامل Flask طوال مدة الاتصال بـ Gemini
+analysis_jobs = JobQueue(ANALYSIS_WORKERS, ANALYSIS_MAX_PENDING, ANALYSIS_TIMEOUT)
+
+# وصف نطاق السعر بين فنادق المدينة
+PRICE_BANDS = {
+    "lowest_quarter": "ضمن الربع الأرخص",
+    "below_median": "أقل من الوسيط",
+    "above_median": "أعلى من الوسيط",
+    "highest_quarter": "ضمن الربع الأغلى",
+}
+
+# تحليل سعر الحجز محلياً من إحصائيات المدينة (بدون Gemini، يعمل حتى عند تعطل الذكاء الاصطناعي)
+def local_booking_analysis(manager, booking):
+    comparison = manager.get_price_comparison(booking['hotel_name'], booking['city'], booking['price'])
+    if comparison is None:
+        text = f"لا توجد بيانات أسعار كافية لفنادق {booking['city']} للمقارنة."
+    else:
+        direction = "أقل" if comparison['diff_pct'] < 0 else "أعلى"
+        text = (
+            f"سعر الليلة ${comparison['price']:g} {direction} من متوسط فنادق {comparison['city']}"
+            f" (${comparison['mean']:g}) بنسبة {abs(comparison['diff_pct']):g}%،"
+            f" و{PRICE_BANDS[comparison['band']]} بين {comparison['hotels_count']} فنادق"
+            f" (من ${comparison['min']:g} إلى ${comparison['max']:g}، الوسيط ${comparison['p50']:g})."
+        )
+        if comparison['value_score'] is not None:
+            text += f" مؤشر القيمة مقابل التقييم: {comparison['value_score']:g} (أكبر من 1 = أفضل من متوسط المدينة)."
+    return {
+        "title": f"تحليل حجز {booking['hotel_name']}",
+        "price_analysis": text,
+        "price_stats": comparison,
+        "activity_suggestions": [],
+        "summary": text,
+        "source": "local",
+    }
+
+# تحليل الحجز وحفظ النتيجة (يعمل داخل عامل في الخلفية)
+# مقارنة السعر تُحسب محلياً، وGemini يكتب العنوان والخلاصة واقتراحات الأنشطة فقط
+def run_booking_analysis(manager, booking):
+    result = local_booking_analysis(manager, booking)
+    try:
+        model = genai.GenerativeModel('gemini-2.5-flash')
+        prompt = (
+            f"حجز فندق {booking['hotel_name']} في {booking['city']} بسعر {booking['price']}."
+            f" تحليل السعر (محسوب من بياناتنا، لا تغيّره): {result['price_analysis']}"
+            " JSON format: title, activity_suggestions (list of {name, reason}), summary."
+        )
+        with gemini_slots.slot(), gemini_metrics('analyze'):
+            response = model.generate_content(
+                prompt,
+                generation_config=genai.GenerationConfig(response_mime_type="application/json"),
+                request_options={"timeout": ANALYSIS_TIMEOUT}
+            )
+        record_gemini_usage('analyze', response)
+        narrative = json.loads(response.text)
+    except Exception:
+        # Gemini غير متاح: نرجع التحليل المحلي بدون حفظه حتى يُكمل طلب لاحق الأنشطة
+        return result
+
+    result.update(
+        title=narrative.get('title') or result['title'],
+        activity_suggestions=narrative.get('activity_suggestions') or [],
+        summary=narrative.get('summary') or result['summary'],
+        source="gemini",
+    )
+    manager.save_booking_analysis(booking['id'], result)
+    return result
+
 @app.route('/api/gemini/analyze', methods=['POST'])
 @login_required
 def gemini_analyze():
     data = request.get_json(silent=True) or {}
     booking = db_manager.get_booking_by_id(data.get('booking_id'), current_user.id)
     if not booking: return jsonify({"message": "Not found"}), 404
-    
+
+    # التحليل المحفوظ مسبقاً يُرجع فوراً بدون استدعاء Gemini
+    stored = db_manager.get_booking_analysis(booking['id'])
+    if stored is not None:
+        return jsonify({"job_id": None, "status": "done", "result": stored}), 200
+
+    retry_after = analyze_limiter.acquire(f"user:{current_user.id}")
+    if retry_after:
+        return limit_response(retry_after)
+
+    job_id = analysis_jobs.submit(run_booking_analysis, db_manager, booking, owner=current_user.id)
+    if job_id is None:
+        # طابور التحليل ممتلئ: نرجع تحليل السعر المحلي فوراً بدلاً من رفض الطلب
+        return jsonify({"job_id": None, "status": "done", "result": local_booking_analysis(db_manager, booking)}), 200
+    return jsonify({"job_id": job_id, "status": "pending", "result": None}), 202
+
+@app.route('/api/gemini/analyze/<job_id>', methods=['GET'])
+@login_required
+def gemini_analyze_status(job_id):
+    job = analysis_jobs.get(job_id, owner=current_user.id)
+    if job is None: return jsonify({"message": "Not found"}), 404
+    if job['status'] == 'error':
+        return jsonify({"job_id": job_id, "status": "error", "message": "Error"}), 200
+    return jsonify({"job_id": job_id, "status": job['status'], "result": job['result']}), 200
+
+# ----------------------------------------------------
+# مقاييس الأداء (GET /metrics بصيغة Prometheus)
+# ----------------------------------------------------
+
+# إحصائيات كل الكاشات وقت القراءة
+def cache_metrics():
+    caches = {
+        "search": db_manager.search_cache,
+        "autocomplete": db_manager.autocomplete_cache,
+        "user": db_manager.user_cache,
+        "chat_answer": chat_answer_cache,
+        "system_instruction": system_instruction_cache,
+        "chat_context": db_manager.chat_context_cache,
+    }
+    for name, cache in caches.items():
+        stats = cache.stats()
+        yield "cache_hits_total", {"cache": name}, stats["hits"]
+        yield "cache_misses_total", {"cache": name}, stats["misses"]
+        yield "cache_hit_ratio", {"cache": name}, stats["hit_rate"]
+        yield "cache_entries", {"cache": name}, stats["size"]
+
+# إحصائيات مجمع اتصالات قاعدة البيانات وطابور الكتابة
+def pool_metrics():
+    stats = db_manager.pool.stats()
+    yield "db_pool_connections_opened_total", {}, stats["opens"]
+    yield "db_pool_waits_total", {}, stats["waits"]
+    yield "db_pool_connections_open", {}, stats["open"]
+    writes = db_manager.writer.stats()
+    yield "db_write_ops_total", {}, writes["ops"]
+    yield "db_write_batches_total", {}, writes["batches"]
+    yield "db_write_rejected_total", {}, writes["rejected"]
+    yield "db_write_queue_pending", {}, writes["pending"]
+
+# إحصائيات دمج الطلبات المتطابقة (single-flight)
+def flight_metrics():
+    for name, flight in (("db_read", db_manager.read_flight), ("chat", chat_flight)):
+        stats = flight.stats()
+        yield "single_flight_leaders_total", {"flight": name}, stats["leaders"]
+        yield "single_flight_shared_total", {"flight": name}, stats["shared"]
+
+metrics.add_collector(cache_metrics)
+metrics.add_collector(flight_metrics)
+metrics.add_collector(pool_metrics)
+
+# أسوأ الاستعلامات البطيئة مع خطط تنفيذها (متاح فقط عند تفعيل SLOW_QUERY_MS)
+@app.route('/api/debug/slow-queries', methods=['GET'])
+def slow_queries_endpoint():
+    if db_manager.slow_queries is None:
+        return jsonify({"message": "سجل الاستعلامات البطيئة غير مفعّل (SLOW_QUERY_MS)"}), 404
+    sort = {"total": "total_ms", "max": "max_ms", "count": "count"}.get(request.args.get('sort', 'total'))
+    if sort is None:
+        return jsonify({"message": "ترتيب غير مدعوم"}), 400
     try:
-        model = genai.GenerativeModel('gemini-2.5-flash')
-        prompt = f"حلل حجز فندق {booking['hotel_name']} في {booking['city']} بسعر {booking['price']}. JSON format: title, price_analysis, activity_suggestions (list of {{name, reason}}), summary."
-        response = model.generate_content(prompt, generation_config=genai.GenerationConfig(response_mime_type="application/json"))
-        return jsonify(json.loads(response.text))
-    except Exception: return jsonify({"message": "Error"}), 500
+        limit = max(1, min(int(request.args.get('limit', 20)), 200))
+    except ValueError:
+        return jsonify({"message": "قيم غير صالحة"}), 400
+    return json_response({
+        "threshold_ms": db_manager.slow_queries.threshold * 1000,
+        "queries": db_manager.slow_queries.top(limit, sort),
+    })
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
 
-def message_to_dict(message):
-    return {'role': message.role, 'parts': [part.text for part in message.parts]}
+# ----------------------------------------------------
+# أوامر سطر الأوامر (flask --app app <command>)
+# ----------------------------------------------------
+
+# استيراد كتالوج فنادق كبير من ملف CSV أو JSONL مع عرض التقدم وسرعة التحميل
+@app.cli.command('import-hotels')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), help="صيغة الملف (تُحدد من الامتداد افتراضياً)")
+@click.option('--chunk-size', type=int, default=IMPORT_CHUNK_SIZE, show_default=True)
+@click.option('--defer-indexes/--no-defer-indexes', default=None,
+              help="تأجيل بناء الفهارس حتى نهاية التحميل (تلقائي حسب حجم الملف)")
+def import_hotels_command(path, fmt, chunk_size, defer_indexes):
+    fmt = fmt or catalog_format(path)
+    if defer_indexes is None:
+        defer_indexes = os.path.getsize(path) > IMPORT_DEFER_INDEXES_BYTES
+    last_report = [0.0]
+
+    def report(rows, elapsed):
+        if elapsed - last_report[0] >= 1:
+            last_report[0] = elapsed
+            click.echo(f"{rows} rows  {rows / elapsed:,.0f} rows/s")
+
+    errors = []
+    with open(path, encoding='utf-8-sig', newline='') as f:
+        stats = db_manager.import_hotels(
+            validate_catalog_rows(read_catalog_rows(f, fmt), errors),
+            chunk_size=max(1, chunk_size), defer_indexes=defer_indexes, progress=report
+        )
+    for line, message in errors[:IMPORT_MAX_ERRORS]:
+        click.echo(f"line {line}: {message}", err=True)
+    click.echo(
+        f"imported {stats['rows']} rows in {stats['seconds']}s "
+        f"({stats['rows_per_sec']:,} rows/s), skipped {len(errors)}"
+        + (", indexes rebuilt at end" if defer_indexes else "")
+    )
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
@@ -0,0 +1,81 @@
+# bench_json.py
+# ====================================================
+#   مقارنة سرعة تحويل القوائم الكبيرة إلى JSON
+# ====================================================
+# يقارن مسار jsonify القياسي في Flask مع json_response (orjson + gzip)
+# على قائمة حجوزات كبيرة مقروءة من قاعدة SQLite مؤقتة.
+#
+# الاستخدام:
+#   python bench_json.py --rows 10000 --repeat 20
+
+import argparse
+import os
+import sqlite3
+import tempfile
+import time
+
+from flask import jsonify
+
+# استيراد app ينشئ قاعدة بياناته ويرحّلها: قاعدة مؤقتة بدلاً من my_app_data.db
+os.environ.setdefault("DATABASE_FILE", os.path.join(tempfile.mkdtemp(), "app_module.db"))
+
+import app
+
+
+# إنشاء قاعدة مؤقتة بعدد كبير من الحجوزات
+def build_rows(count):
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    conn.execute('''
+        CREATE TABLE bookings (
+            id INTEGER PRIMARY KEY, user_id INTEGER, user_name TEXT, hotel_name TEXT, city TEXT,
+            check_in TEXT, check_out TEXT, price REAL, hotel_image_url TEXT
+        )
+    ''')
+    conn.executemany(
+        "INSERT INTO bookings VALUES (NULL, 1, ?, ?, ?, '2025-12-01', '2025-12-05', ?, ?)",
+        [(f"مسافر {i}", f"Hotel {i}", "Dubai", 100 + i % 400, f"./static/image/Hotel{i % 9 + 1}.jpg")
+         for i in range(count)]
+    )
+    return conn
+
+
+def timed(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    return (time.perf_counter() - start) / repeat * 1000, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="JSON serialization benchmark for list endpoints")
+    parser.add_argument("--rows", type=int, default=10000, help="عدد الصفوف")
+    parser.add_argument("--repeat", type=int, default=20, help="عدد مرات التكرار")
+    args = parser.parse_args()
+
+    conn = build_rows(args.rows)
+    query = "SELECT * FROM bookings ORDER BY id DESC"
+
+    def stdlib_path():
+        return jsonify([dict(row) for row in conn.execute(query).fetchall()]).get_data()
+
+    def fast_path():
+        return app.json_response([dict(row) for row in conn.execute(query).fetchall()]).get_data()
+
+    print(f"rows: {args.rows}  orjson: {'yes' if app.orjson else 'no'}")
+    print(f"{'path':<22} {'ms/request':>11} {'bytes':>10}")
+    headers = {"Accept-Encoding": "gzip"}
+    with app.app.test_request_context(headers=headers):
+        ms, body = timed(stdlib_path, args.repeat)
+        print(f"{'jsonify (stdlib)':<22} {ms:>11.2f} {len(body):>10}")
+    with app.app.test_request_context():
+        ms, body = timed(fast_path, args.repeat)
+        print(f"{'json_response':<22} {ms:>11.2f} {len(body):>10}")
+    with app.app.test_request_context(headers=headers):
+        ms, body = timed(fast_path, args.repeat)
+        print(f"{'json_response + gzip':<22} {ms:>11.2f} {len(body):>10}")
+
+
+if __name__ == "__main__":
+    main()
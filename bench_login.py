@@ -0,0 +1,60 @@
+# bench_login.py
+# ====================================================
+#   قياس سرعة تسجيل الدخول (التحقق من كلمة المرور)
+# ====================================================
+# يقيس عدد عمليات التحقق من كلمة المرور في الثانية لكل عدد من العمليات (processes)
+# ويحسب المعدل لكل نواة معالج.
+#
+# الاستخدام:
+#   python bench_login.py --logins 200 --workers 1 2 4
+
+import argparse
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# استيراد app ينشئ قاعدة بياناته ويرحّلها: قاعدة مؤقتة بدلاً من my_app_data.db
+os.environ.setdefault("DATABASE_FILE", os.path.join(tempfile.mkdtemp(), "app_module.db"))
+
+import app
+
+
+def run(workers, logins, password_hash):
+    # إعادة إنشاء الـ pool بالحجم المطلوب
+    app.PASSWORD_HASH_WORKERS = workers
+    app._password_pool = None
+    app.verify_password(password_hash, "benchmark-password")  # تسخين الـ pool
+
+    # عدد threads كافٍ لإبقاء كل العمليات مشغولة (كما يفعل سيرفر متعدد الـ threads)
+    threads = max(1, workers) * 2
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        results = list(executor.map(
+            lambda _: app.verify_password(password_hash, "benchmark-password"),
+            range(logins)
+        ))
+    elapsed = time.perf_counter() - start
+    assert all(results)
+    return logins / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Login (password verification) throughput benchmark")
+    parser.add_argument("--logins", type=int, default=100, help="عدد عمليات الدخول لكل تجربة")
+    parser.add_argument("--workers", type=int, nargs="+",
+                        default=sorted({0, 1, os.cpu_count() or 1}),
+                        help="أحجام الـ process pool المطلوب تجربتها (0 = بدون pool)")
+    args = parser.parse_args()
+
+    password_hash = app.generate_password_hash("benchmark-password", app.password_hash_method())
+    print(f"method: {app.password_hash_method()}  logins per run: {args.logins}")
+    print(f"{'workers':>8} {'logins/s':>10} {'logins/s/core':>14}")
+    for workers in args.workers:
+        rate = run(workers, args.logins, password_hash)
+        cores = max(1, workers)
+        print(f"{workers:>8} {rate:>10.1f} {rate / cores:>14.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+# bench_startup.py
+# ====================================================
+#   قياس زمن بدء التشغيل (Cold Start) لوحدة app
+# ====================================================
+# يستورد app.py في عملية Python جديدة عدة مرات داخل مجلد مؤقت
+# (حتى تُنشأ قاعدة بيانات جديدة في أول تشغيل) ويعرض:
+#   - أول تشغيل: قاعدة بيانات فارغة (تنفيذ الترحيلات وتعبئة الفنادق)
+#   - التشغيلات التالية: قاعدة بيانات محدثة (بدون أي DDL)
+#   - هل تم استيراد مكتبة Gemini أثناء بدء التشغيل
+#
+# الاستخدام:
+#   python bench_startup.py --runs 5
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# الكود الذي يُنفذ في كل عملية جديدة
+PROBE = """
+import json, sys, time
+sys.path.insert(0, {base_dir!r})
+start = time.perf_counter()
+import app
+elapsed = time.perf_counter() - start
+print(json.dumps({{
+    "ms": elapsed * 1000,
+    "genai_loaded": "google.generativeai" in sys.modules,
+}}))
+"""
+
+
+def run_once(workdir):
+    output = subprocess.run(
+        [sys.executable, "-c", PROBE.format(base_dir=BASE_DIR)],
+        cwd=workdir, capture_output=True, text=True, check=True,
+        # قاعدة البيانات الافتراضية داخل المجلد المؤقت حتى لو كان DATABASE_FILE مضبوطاً في البيئة
+        env={k: v for k, v in os.environ.items() if k != "DATABASE_FILE"}
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold-start time of the app module")
+    parser.add_argument("--runs", type=int, default=5, help="عدد التشغيلات على قاعدة البيانات المحدثة")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    first = run_once(workdir)
+    warm = [run_once(workdir) for _ in range(args.runs)]
+    times = sorted(r["ms"] for r in warm)
+
+    print(f"{'run':<24} {'ms':>9}")
+    print(f"{'new database':<24} {first['ms']:>9.1f}")
+    print(f"{'up-to-date (median)':<24} {times[len(times) // 2]:>9.1f}")
+    print(f"{'up-to-date (best)':<24} {times[0]:>9.1f}")
+    print(f"gemini sdk imported at startup: {'yes' if first['genai_loaded'] else 'no'}")
+
+
+if __name__ == "__main__":
+    main()
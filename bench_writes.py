@@ -0,0 +1,94 @@
+# bench_writes.py
+# ====================================================
+#   قياس سرعة الحجوزات المتزامنة (group commit)
+# ====================================================
+# يقارن عدد الحجوزات في الثانية عند 1 و 8 و 32 كاتباً متزامناً بين:
+#   - direct: كل عملية تحجز اتصالاً وتعمل BEGIN IMMEDIATE و commit خاصاً بها
+#   - group:  خيط الكتابة الواحد في DBManager (WriteQueue) مع group commit
+# ويعرض عدد الأخطاء (مثل database is locked) في كل تجربة.
+#
+# الاستخدام:
+#   python bench_writes.py --bookings 2000 --writers 1 8 32
+
+import argparse
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+# استيراد app ينشئ قاعدة بياناته ويرحّلها: قاعدة مؤقتة بدلاً من my_app_data.db
+os.environ.setdefault("DATABASE_FILE", os.path.join(tempfile.mkdtemp(), "app_module.db"))
+
+import app
+
+HOTELS = [
+    ("Grand Hotel Dubai", "Dubai"), ("Palm Resort", "Dubai"), ("Cairo Nile View", "Cairo"),
+    ("Pyramids Plaza", "Cairo"), ("Riyadh Business Stay", "Riyadh"), ("London Bridge Inn", "London"),
+]
+
+
+# تنفيذ العملية مباشرة على اتصال من المجمع (السلوك قبل طابور الكتابة)
+class DirectWriter:
+    def __init__(self, manager):
+        self.manager = manager
+
+    def execute(self, fn):
+        with self.manager.get_connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            result = fn(conn.cursor())
+            conn.commit()
+            return result
+
+    def stats(self):
+        return {"batches": 0}
+
+    def close(self):
+        pass
+
+
+def booking(i):
+    check_in = date(2030, 1, 1) + timedelta(days=i % 3000)
+    name, city = HOTELS[i % len(HOTELS)]
+    return {
+        "hotel_name": name, "city": city, "price": 200,
+        "check_in": check_in.isoformat(), "check_out": (check_in + timedelta(days=1)).isoformat(),
+    }
+
+
+def run(mode, writers, bookings):
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    manager = app.DBManager(path)
+    if mode == "direct":
+        manager.writer.close()
+        manager.writer = DirectWriter(manager)
+
+    def book(i):
+        _, error = manager.add_booking(1 + i % 50, "bench", booking(i))
+        return error
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=writers) as executor:
+        errors = [e for e in executor.map(book, range(bookings)) if e]
+    elapsed = time.perf_counter() - start
+    batches = manager.writer.stats()["batches"]
+    manager.close()
+    return bookings / elapsed, len(errors), batches
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent booking write throughput")
+    parser.add_argument("--bookings", type=int, default=2000, help="عدد الحجوزات لكل تجربة")
+    parser.add_argument("--writers", type=int, nargs="+", default=[1, 8, 32], help="عدد الكتّاب المتزامنين")
+    args = parser.parse_args()
+
+    print(f"bookings per run: {args.bookings}")
+    print(f"{'mode':<8} {'writers':>8} {'bookings/s':>11} {'errors':>7} {'batches':>8}")
+    for writers in args.writers:
+        for mode in ("direct", "group"):
+            rate, errors, batches = run(mode, writers, args.bookings)
+            print(f"{mode:<8} {writers:>8} {rate:>11.1f} {errors:>7} {batches if mode == 'group' else '-':>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+# build_images.py
+# ====================================================
+#   خطوة بناء صور الفنادق (Responsive Images)
+# ====================================================
+# تولد من كل صورة في static/image نسخاً مصغرة بصيغة WebP (thumb و medium)
+# بأسماء تحتوي على بصمة المحتوى، وتكتب ملف manifest.json يستخدمه app.py
+# لإرجاع روابط srcset جاهزة في واجهات البحث والحجوزات.
+#
+# الاستخدام:
+#   python build_images.py
+#
+# يتطلب مكتبة Pillow (مع دعم WebP).
+
+import hashlib
+import json
+import os
+import sys
+from io import BytesIO
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow مطلوبة لخطوة البناء فقط وليس لتشغيل التطبيق
+    Image = None
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(BASE_DIR, "static")
+SOURCE_DIR = os.path.join(STATIC_DIR, "image")
+OUTPUT_DIR = os.path.join(SOURCE_DIR, "build")
+MANIFEST_FILE = os.path.join(OUTPUT_DIR, "manifest.json")
+
+# النسخ المطلوبة: الاسم -> أقصى عرض بالبكسل
+VARIANTS = {
+    "thumb": 320,
+    "medium": 800,
+}
+WEBP_QUALITY = 80
+SOURCE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+
+
+# بناء نسخة واحدة وإرجاع (اسم الملف، العرض، الارتفاع)
+def build_variant(image, stem, variant, max_width):
+    copy = image.copy()
+    if copy.width > max_width:
+        height = round(copy.height * max_width / copy.width)
+        copy = copy.resize((max_width, height), Image.LANCZOS)
+
+    buffer = BytesIO()
+    copy.save(buffer, "WEBP", quality=WEBP_QUALITY, method=6)
+    data = buffer.getvalue()
+
+    digest = hashlib.sha256(data).hexdigest()[:10]
+    filename = f"{stem}-{variant}-{digest}.webp"
+    path = os.path.join(OUTPUT_DIR, filename)
+    if not os.path.exists(path):
+        with open(path, "wb") as f:
+            f.write(data)
+    return filename, copy.width, copy.height
+
+
+def main():
+    if Image is None:
+        print("Pillow is required: pip install Pillow", file=sys.stderr)
+        return 1
+
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    manifest = {}
+    used_files = set()
+
+    for name in sorted(os.listdir(SOURCE_DIR)):
+        if not name.lower().endswith(SOURCE_EXTENSIONS):
+            continue
+        stem = os.path.splitext(name)[0]
+        with Image.open(os.path.join(SOURCE_DIR, name)) as source:
+            image = source.convert("RGB")
+
+        # المفتاح: مسار الصورة الأصلية نسبة إلى مجلد static
+        entry = {}
+        for variant, max_width in VARIANTS.items():
+            filename, width, height = build_variant(image, stem, variant, max_width)
+            used_files.add(filename)
+            entry[variant] = {"url": f"/image/build/{filename}", "width": width, "height": height}
+        manifest[f"image/{name}"] = entry
+
+        original = os.path.getsize(os.path.join(SOURCE_DIR, name))
+        sizes = ", ".join(
+            f"{v}={os.path.getsize(os.path.join(OUTPUT_DIR, os.path.basename(e['url']))) // 1024}KB"
+            for v, e in entry.items()
+        )
+        print(f"{name}: {original // 1024}KB -> {sizes}")
+
+    # حذف النسخ القديمة التي لم تعد مستخدمة
+    for name in os.listdir(OUTPUT_DIR):
+        if name.endswith(".webp") and name not in used_files:
+            os.remove(os.path.join(OUTPUT_DIR, name))
+
+    with open(MANIFEST_FILE, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    print(f"manifest: {os.path.relpath(MANIFEST_FILE, BASE_DIR)} ({len(manifest)} images)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
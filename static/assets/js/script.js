@@ -225,11 +225,14 @@ async function handleSearch(e) {
            const isFav = userFavorites[h.name] ? 'text-red-500 fill-current' : 'text-gray-400';
             
             const correctImageUrl = h.image_url.replace('./static', ''); 
+            // استخدام النسخ المصغرة (WebP) إذا كانت متاحة في الـ manifest
+            const imageSrc = h.image_thumb_url || correctImageUrl;
+            const imageSrcset = h.image_srcset ? `srcset="${h.image_srcset}" sizes="(min-width: 768px) 224px, 100vw"` : '';
 
             const html = `
                 <div class="bg-white rounded-xl shadow-lg mb-4 flex flex-col md:flex-row overflow-hidden border border-gray-100 hover:shadow-xl transition">
                     <div class="w-full md:w-56 bg-gray-200 h-56 md:h-auto relative group">
-                        <img src="${correctImageUrl}" class="w-full h-full object-cover transition duration-500 group-hover:scale-110" >
+                        <img src="${imageSrc}" ${imageSrcset} loading="lazy" decoding="async" alt="${h.name}" class="w-full h-full object-cover transition duration-500 group-hover:scale-110" >
                         <div class="absolute top-2 right-2 bg-white/90 px-2 py-1 rounded text-xs font-bold text-brand-color">⭐ ${h.rating}</div>
                     </div>
                     <div class="p-6 flex-grow flex flex-col justify-between">
@@ -374,15 +377,23 @@ async function executeBooking(data) {
 
 
 
-async function fetchAndRenderBookings() {
+// beforeId: تحميل الصفحة التالية (الحجوزات الأقدم) وإضافتها أسفل القائمة الحالية
+async function fetchAndRenderBookings(beforeId = null) {
     const container = document.getElementById('bookings-list');
-    container.innerHTML = '<p class="text-center p-4">جاري التحميل...</p>';
+    const loadMoreBtn = document.getElementById('bookings-load-more');
+    if (beforeId === null) container.innerHTML = '<p class="text-center p-4">جاري التحميل...</p>';
+    else if (loadMoreBtn) { loadMoreBtn.disabled = true; loadMoreBtn.textContent = 'جاري التحميل...'; }
     try {
-        const response = await fetch(`${API_BASE_URL}/bookings`);
+        // نطلب الأعمدة المعروضة فقط لتقليل حجم الاستجابة
+        let url = `${API_BASE_URL}/bookings?fields=id,hotel_name,city,check_in,check_out,price`;
+        if (beforeId !== null) url += `&before_id=${beforeId}`;
+        const response = await fetch(url);
         if (!response.ok) throw new Error();
         const bookings = await response.json();
-        container.innerHTML = '';
-        if (bookings.length === 0) {
+        const nextBeforeId = response.headers.get('X-Next-Before-Id');
+        if (beforeId === null) container.innerHTML = '';
+        if (loadMoreBtn) loadMoreBtn.remove();
+        if (beforeId === null && bookings.length === 0) {
             container.innerHTML = '<p class="text-center p-4 text-gray-500">لا توجد حجوزات حالياً.</p>';
             return;
         }
@@ -403,9 +414,22 @@ async function fetchAndRenderBookings() {
             `;
             container.insertAdjacentHTML('beforeend', html);
         });
-    } catch (error) { container.innerHTML = '<p class="text-center text-red-500">سجل دخولك أولاً</p>'; }
+        // يوجد حجوزات أقدم: زر لتحميل الصفحة التالية
+        if (nextBeforeId) {
+            container.insertAdjacentHTML('beforeend', `
+                <button id="bookings-load-more" onclick="loadMoreBookings(${Number(nextBeforeId)})" class="w-full py-2 text-brand-color font-bold hover:bg-gray-100 rounded-lg">
+                    عرض الحجوزات الأقدم
+                </button>
+            `);
+        }
+    } catch (error) {
+        if (beforeId === null) container.innerHTML = '<p class="text-center text-red-500">سجل دخولك أولاً</p>';
+        else { showToast("❌ خطأ في الاتصال", true); if (loadMoreBtn) { loadMoreBtn.disabled = false; loadMoreBtn.textContent = 'عرض الحجوزات الأقدم'; } }
+    }
 }
 
+window.loadMoreBookings = (beforeId) => fetchAndRenderBookings(beforeId);
+
 window.deleteBooking = async (id) => {
     if(!confirm("هل أنت متأكد؟")) return;
     try {
@@ -476,16 +500,50 @@ async function sendMessage() {
     container.insertAdjacentHTML('beforeend', `<div class="flex justify-end mb-2"><div class="bg-blue-500 text-white p-2 rounded-lg max-w-[80%]">${msg}</div></div>`);
     input.value = '';
     
+    // فقاعة الرد تُملأ تدريجياً مع وصول أجزاء الإجابة
+    container.insertAdjacentHTML('beforeend', `<div class="flex justify-start mb-2"><div class="bg-gray-100 text-gray-800 p-2 rounded-lg max-w-[80%] border whitespace-pre-wrap"></div></div>`);
+    const bubble = container.lastElementChild.firstElementChild;
+    bubble.textContent = '...';
+    container.scrollTop = container.scrollHeight;
+
     try {
-        const res = await fetch(`${API_BASE_URL}/gemini/chat`, {
+        const res = await fetch(`${API_BASE_URL}/gemini/chat/stream`, {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
             body: JSON.stringify({ prompt: msg })
         });
-        const data = await res.json();
-        container.insertAdjacentHTML('beforeend', `<div class="flex justify-start mb-2"><div class="bg-gray-100 text-gray-800 p-2 rounded-lg max-w-[80%] border">${data.response}</div></div>`);
-        container.scrollTop = container.scrollHeight;
-    } catch (e) {}
+        // تجاوز حد الطلبات أو انشغال الخدمة: نعرض رسالة السيرفر
+        if (res.status === 429 || res.status === 503) {
+            bubble.textContent = (await res.json()).response;
+            return;
+        }
+        if (!res.ok || !res.body) throw new Error();
+
+        const reader = res.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        let answer = '';
+        while (true) {
+            const { done, value } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+            // كل حدث SSE ينتهي بسطر فارغ
+            const events = buffer.split('\n\n');
+            buffer = events.pop();
+            for (const evt of events) {
+                const eventName = (evt.match(/^event: (.*)$/m) || [])[1];
+                const dataLine = (evt.match(/^data: (.*)$/m) || [])[1];
+                if (!dataLine) continue;
+                const payload = JSON.parse(dataLine);
+                if (eventName === 'error') { bubble.textContent = payload.response; return; }
+                if (payload.text) {
+                    answer += payload.text;
+                    bubble.textContent = answer;
+                    container.scrollTop = container.scrollHeight;
+                }
+            }
+        }
+    } catch (e) { bubble.textContent = 'خطأ في الاتصال'; }
 }
 
 window.analyzeBooking = async (id) => {
@@ -505,7 +563,17 @@ window.analyzeBooking = async (id) => {
             headers: {'Content-Type': 'application/json'},
             body: JSON.stringify({ booking_id: id })
         });
-        const data = await res.json();
+        let job = await res.json();
+        if (!res.ok) throw new Error(job.message);
+        // التحليل يعمل في الخلفية: نتابع حالة المهمة حتى تنتهي
+        while (job.status === 'pending' || job.status === 'running') {
+            await new Promise(resolve => setTimeout(resolve, 1000));
+            const statusRes = await fetch(`${API_BASE_URL}/gemini/analyze/${job.job_id}`);
+            job = await statusRes.json();
+            if (!statusRes.ok) throw new Error(job.message);
+        }
+        if (job.status !== 'done') throw new Error(job.message);
+        const data = job.result;
         content.innerHTML = `
             <h3 class="text-xl font-bold text-brand-color mb-3">${data.title}</h3>
             <div class="mb-4 bg-blue-50 p-3 rounded"><p class="font-bold">💰 السعر:</p><p>${data.price_analysis}</p></div><div class="mb-4"><p class="font-bold mb-2>
@@ -3,9 +3,13 @@
 import pytest
 import json
 import os
+import tempfile
 import time
 from werkzeug.security import check_password_hash
 
+# 📌 استيراد app ينشئ قاعدة بياناته ويرحّلها: نوجهه لقاعدة مؤقتة حتى لا يُعدل my_app_data.db
+os.environ.setdefault("DATABASE_FILE", os.path.join(tempfile.mkdtemp(), "app_module.db"))
+
 # 💡 ملاحظة: يجب أن يكون ملف app.py في نفس المجلد
 # نستورد التطبيق (app)، وكلاس إدارة قاعدة البيانات (DBManager)، ووظيفة توليد الهاش
 from app import app, DBManager, generate_password_hash
@@ -15,15 +19,18 @@ TEST_DATABASE_FILE = "test_app_data.db"
 
 # 🛠️ دالة مساعدة لحذف الملف بأمان (تحاول عدة مرات إذا كان مشغولاً)
 def safe_remove_db(db_file):
-    if os.path.exists(db_file):
+    # نحذف ملفات WAL المرافقة أيضاً حتى لا تُطبق على قاعدة جديدة بنفس الاسم
+    for path in (db_file, db_file + "-wal", db_file + "-shm"):
+        if not os.path.exists(path):
+            continue
         for _ in range(5):  # 5 attempts
             try:
-                os.remove(db_file)
+                os.remove(path)
                 break
             except PermissionError:
                 time.sleep(0.1)  # Wait 100ms
         else:
-            print(f"Warning: Could not remove {db_file} after retries.")
+            print(f"Warning: Could not remove {path} after retries.")
 
 # 🛠️ Fixture: إعداد عميل الاختبار وقاعدة البيانات المؤقتة
 # -----------------------------------------------------------
@@ -56,8 +63,8 @@ def client(monkeypatch):
         yield client
 
     # 4. التنظيف بعد الاختبارات
-    # نغلق الاتصال إذا كان هناك أي مرجع معلق (اختياري، لكن جيد للتأكيد)
-    # في app.py قمنا بإصلاح DBManager ليغلق الاتصالات فوراً، لذا الحذف هنا يجب أن ينجح.
+    # نغلق اتصالات المجمع أولاً ثم نحذف قاعدة البيانات المؤقتة.
+    db_manager.close()
     safe_remove_db(TEST_DATABASE_FILE)
 
 
@@ -300,4 +307,1176 @@ def test_booking_and_favorites(client):
     
     # 10. التأكد من إزالة المفضلة
     get_favs_after_remove = client.get('/api/favorites')
-    assert len(json.loads(get_favs_after_remove.data)) == 0
\ No newline at end of file
+    assert len(json.loads(get_favs_after_remove.data)) == 0
+
+
+# 🗄️ اختبار مجمع الاتصالات
+# ------------------------------------------------
+
+def test_connection_pool_reuses_connections():
+    """اختبار أن الاتصالات يعاد استخدامها وأن الإحصائيات تُحدّث ووضع WAL مفعّل."""
+    safe_remove_db(TEST_DATABASE_FILE)
+    manager = DBManager(TEST_DATABASE_FILE, pool_size=2)
+    try:
+        for _ in range(10):
+            manager.search_hotels('Dubai')
+
+        stats = manager.pool.stats()
+        assert stats['opens'] == 1
+        assert stats['hits'] >= 10
+        assert stats['open'] <= 2
+
+        with manager.get_connection() as conn:
+            assert conn.execute("PRAGMA journal_mode").fetchone()[0] == 'wal'
+
+        # تحديث الهاتف يعمل عبر الاتصال المجمّع
+        manager.register_user('pool@app.com', 'password123', 30)
+        user = manager.verify_user('pool@app.com', 'password123')
+        assert manager.update_user_phone(user.id, '0100') is True
+        assert manager.get_user_by_id(user.id).phone == '0100'
+    finally:
+        manager.close()
+        safe_remove_db(TEST_DATABASE_FILE)
+
+
+# 🔎 اختبار البحث المتقدم
+# ------------------------------------------------
+
+def test_search_filters_sort_and_cursor(client):
+    """اختبار فلاتر السعر والتقييم والترتيب والتنقل بين الصفحات بالمؤشر."""
+    response = client.get('/api/search?city=dubai&min_price=260&sort=price_desc')
+    data = json.loads(response.data)
+    assert response.status_code == 200
+    assert [h['price'] for h in data] == [450, 300]
+
+    response = client.get('/api/search?city=Dubai&min_rating=4.9&sort=rating_desc')
+    assert [h['name'] for h in json.loads(response.data)] == ['Palm Resort', 'Dubai Marina View']
+
+    # الصفحة الأولى ثم الثانية باستخدام المؤشر
+    first = client.get('/api/search?city=Dubai&sort=price_asc&limit=2')
+    assert [h['price'] for h in json.loads(first.data)] == [250, 300]
+    cursor = first.headers['X-Next-Cursor']
+    second = client.get(f'/api/search?city=Dubai&sort=price_asc&limit=2&cursor={cursor}')
+    assert [h['price'] for h in json.loads(second.data)] == [450]
+    assert 'X-Next-Cursor' not in second.headers
+
+    assert client.get('/api/search?sort=bogus').status_code == 400
+    assert client.get('/api/search?min_price=abc').status_code == 400
+    assert client.get('/api/search?cursor=not-a-cursor').status_code == 400
+
+    # عدد قيم المؤشر يجب أن يطابق الترتيب
+    from app import encode_cursor
+    assert client.get(f'/api/search?sort=price_asc&cursor={encode_cursor([5])}').status_code == 400
+    assert client.get(f'/api/search?cursor={encode_cursor([300, 5])}').status_code == 400
+
+
+def test_search_cache_invalidated_on_hotels_change(client):
+    """اختبار أن كاش البحث يُستخدم ثم يُلغى عند تعديل جدول الفنادق."""
+    import app as app_module
+    manager = app_module.db_manager
+
+    assert len(manager.search_hotels('Cairo')) == 2
+    manager.search_hotels('cairo ')
+    assert manager.search_cache.stats()['hits'] >= 1
+
+    with manager.get_connection() as conn:
+        conn.execute(
+            "INSERT INTO hotels (name, city, price, rating, image_url) VALUES (?, ?, ?, ?, ?)",
+            ("Zamalek Boutique", "Cairo", 90, 4.4, None)
+        )
+        conn.commit()
+
+    assert len(manager.search_hotels('Cairo')) == 3
+
+    # التأكد من أن الاستعلام يستخدم الفهرس بدلاً من مسح الجدول
+    with manager.get_connection() as conn:
+        plan = " ".join(row[3] for row in conn.execute(
+            "EXPLAIN QUERY PLAN SELECT * FROM hotels WHERE city = ? COLLATE NOCASE ORDER BY price", ("Cairo",)
+        ))
+    assert "idx_hotels_city_price" in plan
+
+
+def test_bookings_pagination_and_fields(client):
+    """اختبار تقسيم الحجوزات لصفحات بـ before_id واختيار الحقول."""
+    register_test_user(client, username='pages@app.com', password='pass12345')
+    client.post('/api/login', json={'username': 'pages@app.com', 'password': 'pass12345'})
+
+    ids = []
+    for i in range(5):
+        res = client.post('/api/booking', json={
+            "booking_name": "Trip", "hotel_name": f"Hotel {i}", "city": "Cairo",
+            "check_in": "2025-12-01", "check_out": "2025-12-03",
+            "price": 100 + i, "hotel_image_url": "img.jpg"
+        })
+        ids.append(json.loads(res.data)['id'])
+
+    first = client.get('/api/bookings?limit=2&fields=hotel_name,price')
+    page = json.loads(first.data)
+    assert [b['id'] for b in page] == ids[::-1][:2]
+    assert set(page[0]) == {'id', 'hotel_name', 'price'}
+
+    before_id = first.headers['X-Next-Before-Id']
+    second = json.loads(client.get(f'/api/bookings?limit=2&before_id={before_id}').data)
+    assert [b['id'] for b in second] == ids[::-1][2:4]
+    assert 'hotel_image_url' in second[0]
+
+    assert client.get('/api/bookings?fields=password_hash').status_code == 400
+    assert client.get('/api/bookings?limit=x').status_code == 400
+
+
+# 🤖 اختبار الذكاء الاصطناعي (باستخدام نموذج وهمي بدلاً من Gemini)
+# ------------------------------------------------
+
+class FakePart:
+    def __init__(self, text):
+        self.text = text
+
+class FakeMessage:
+    def __init__(self, role, text):
+        self.role = role
+        self.parts = [FakePart(text)]
+
+class FakeChat:
+    def __init__(self, model, history):
+        self.model = model
+        self.history = [FakeMessage(m['role'], m['parts'][0]) for m in history]
+
+    def send_message(self, prompt, stream=False):
+        self.model.calls.append(prompt)
+        answer = f"إجابة رقم {len(self.model.calls)}"
+        self.history += [FakeMessage('user', prompt), FakeMessage('model', answer)]
+        if stream:
+            # إرجاع الإجابة على أجزاء (كلمة كلمة) كما يفعل Gemini
+            return [FakePart(word + ' ') for word in answer.split()]
+        return FakePart(answer)
+
+class FakeModel:
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, name):
+        return self
+
+    def start_chat(self, history):
+        return FakeChat(self, history)
+
+    def generate_content(self, prompt, **kwargs):
+        self.calls.append(prompt)
+        return FakePart(json.dumps({
+            "title": "تحليل", "price_analysis": "سعر مناسب",
+            "activity_suggestions": [{"name": "جولة", "reason": "ممتعة"}], "summary": "ممتاز"
+        }))
+
+
+@pytest.fixture
+def fake_gemini(monkeypatch):
+    """يستبدل نموذج Gemini بنموذج وهمي ويفرغ كاش الإجابات."""
+    import app as app_module
+    model = FakeModel()
+    monkeypatch.setattr(app_module.genai, 'GenerativeModel', model)
+    app_module.chat_answer_cache.clear()
+    # محددات جديدة لكل اختبار حتى لا تتراكم طلبات الاختبارات السابقة (نفس IP)
+    for name in ('chat_limiter', 'chat_ip_limiter', 'analyze_limiter'):
+        limiter = getattr(app_module, name)
+        monkeypatch.setattr(app_module, name, app_module.RateLimiter(limiter.rate * 60, limiter.burst))
+    return model
+
+
+def test_chat_answer_cache(client, fake_gemini):
+    """اختبار أن السؤال الأول المتكرر يُجاب من الكاش وأن تغيّر الفنادق يلغيه."""
+    import app as app_module
+
+    first = client.post('/api/gemini/chat', json={'prompt': 'Best hotel in Dubai?'})
+    assert first.status_code == 200
+    assert len(fake_gemini.calls) == 1
+
+    # عميل جديد (جلسة جديدة) يسأل نفس السؤال بصيغة مختلفة قليلاً
+    with app.test_client() as other:
+        second = other.post('/api/gemini/chat', json={'prompt': '  best hotel in   dubai '})
+        assert json.loads(second.data)['response'] == json.loads(first.data)['response']
+        assert len(fake_gemini.calls) == 1
+
+        # السؤال الثاني في نفس المحادثة يعتمد على السياق فلا يُؤخذ من الكاش
+        other.post('/api/gemini/chat', json={'prompt': 'Best hotel in Dubai?'})
+        assert len(fake_gemini.calls) == 2
+
+    stats = app_module.chat_answer_cache.stats()
+    assert stats['hits'] == 1
+
+    # تغيير بيانات الفنادق يغير البصمة فيتم استدعاء النموذج من جديد
+    with app_module.db_manager.get_connection() as conn:
+        conn.execute("UPDATE hotels SET price = price + 1 WHERE city = 'Dubai'")
+        conn.commit()
+    with app.test_client() as third:
+        third.post('/api/gemini/chat', json={'prompt': 'Best hotel in Dubai?'})
+    assert len(fake_gemini.calls) == 3
+
+
+def test_chat_returns_busy_when_writer_is_full(client, fake_gemini, monkeypatch):
+    """اختبار أن امتلاء طابور الكتابة يرجع 503 في المحادثة (من الكاش أو من Gemini) بدلاً من 500."""
+    import app as app_module
+    from app import WriteQueueFull
+    assert client.post('/api/gemini/chat', json={'prompt': 'Best hotel in Dubai?'}).status_code == 200
+
+    def busy(fn):
+        raise WriteQueueFull()
+
+    monkeypatch.setattr(app_module.db_manager.writer, 'execute', busy)
+    for prompt in ('Best hotel in Dubai?', 'Cheapest hotel in Cairo?'):
+        with app.test_client() as other:
+            response = other.post('/api/gemini/chat', json={'prompt': prompt})
+        assert response.status_code == 503
+        assert json.loads(response.data)['response'] == 'الخدمة مشغولة حالياً، حاول لاحقاً'
+
+
+def test_chat_context_selects_relevant_hotels(client):
+    """اختبار أن سياق المحادثة يحتوي الفنادق المتعلقة بالسؤال فقط ويبقى حجمه ثابتاً مع كبر الكتالوج."""
+    import app as app_module
+    manager = app_module.db_manager
+
+    # المدينة بالعربية + نية السعر: فنادق دبي فقط من الأرخص للأغلى
+    context = manager.get_chat_context("أرخص فندق في دبي").context
+    lines = [line for line in context.splitlines() if line.startswith("- ")]
+    assert lines and all("في Dubai" in line for line in lines)
+    prices = [float(line.split("$")[1].split(",")[0]) for line in lines]
+    assert prices == sorted(prices)
+    assert "Cairo (" in context  # قائمة المدن المتاحة تُرسل دائماً
+
+    # اسم فندق (BM25) مع حد أقصى للسعر
+    context = manager.get_chat_context("Is Palm Resort available under 150?").context
+    assert "Palm Resort" in context
+    others = [line for line in context.splitlines() if line.startswith("- ") and "Palm Resort" not in line]
+    assert others and all(float(line.split("$")[1].split(",")[0]) <= 150 for line in others)
+
+    # النتيجة محفوظة حتى يتغير جدول الفنادق
+    first = manager.get_chat_context("Best hotel in Dubai?")
+    assert manager.get_chat_context("best hotel in dubai") is first
+    manager.import_hotels([
+        (f"Desert Inn {i}", "Dubai", 50 + i, 3.5, None, None, None) for i in range(500)
+    ])
+    second = manager.get_chat_context("Best hotel in Dubai?")
+    assert second.version > first.version
+    assert "من أصل 509" in second.context
+
+    # حجم السياق لا يتغير بعد إضافة 500 فندق
+    context = manager.get_chat_context("cheap hotel in Dubai").context
+    assert sum(line.startswith("- ") for line in context.splitlines()) == app_module.CHAT_CONTEXT_HOTELS
+    assert "Desert Inn 0 " in context
+
+    # الاستعلامات تقرأ أول الفهرس بدلاً من مسح وترتيب كل الفنادق
+    with manager.get_connection() as conn:
+        for sql, params in (
+            ("SELECT name FROM hotels ORDER BY rating DESC, price ASC LIMIT 30", ()),
+            ("SELECT name FROM hotels ORDER BY price ASC, rating DESC LIMIT 30", ()),
+            ("SELECT name FROM hotels WHERE city = ? COLLATE NOCASE ORDER BY price ASC, rating DESC LIMIT 30",
+             ("dubai",)),
+        ):
+            plan = " ".join(row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params))
+            assert "USING INDEX" in plan and "TEMP B-TREE FOR ORDER BY" not in plan
+
+
+def test_chat_history_stored_server_side(client, fake_gemini, monkeypatch):
+    """اختبار أن سجل المحادثة يُحفظ في السيرفر ويُضغط عند تجاوز الميزانية."""
+    import app as app_module
+    monkeypatch.setattr(app_module, 'CHAT_MAX_MESSAGES', 4)
+
+    for i in range(4):
+        response = client.post('/api/gemini/chat', json={'prompt': f'سؤال رقم {i}'})
+        assert response.status_code == 200
+
+    with client.session_transaction() as sess:
+        assert 'chat_history' not in sess
+        conversation_id = sess['chat_id']
+
+    conversation = app_module.db_manager.get_conversation(conversation_id)
+    assert len(conversation['messages']) == 4
+    assert conversation['messages'][-2]['parts'] == ['سؤال رقم 3']
+    # الرسائل الأقدم انتقلت إلى الملخص
+    assert 'سؤال رقم 0' in conversation['summary']
+    assert 'سؤال رقم 1' in conversation['summary']
+
+    # انتهاء الصلاحية يحذف المحادثة ويبدأ محادثة جديدة
+    monkeypatch.setattr(app_module, 'CHAT_TTL', -1)
+    assert app_module.db_manager.get_conversation(conversation_id) is None
+    assert app_module.db_manager.purge_expired_conversations() == 1
+
+
+def test_chat_stream_sends_chunks_and_saves_history(client, fake_gemini):
+    """اختبار أن نسخة البث ترسل الأجزاء كأحداث SSE وتحفظ الإجابة الكاملة."""
+    import app as app_module
+
+    response = client.post('/api/gemini/chat/stream', json={'prompt': 'Cheapest in Cairo'})
+    assert response.status_code == 200
+    assert response.mimetype == 'text/event-stream'
+
+    body = response.get_data(as_text=True)
+    chunks = [json.loads(line[len('data: '):]) for line in body.splitlines() if line.startswith('data: ')]
+    assert ''.join(c.get('text', '') for c in chunks) == 'إجابة رقم 1 '
+    assert 'event: done' in body
+
+    with client.session_transaction() as sess:
+        conversation = app_module.db_manager.get_conversation(sess['chat_id'])
+    assert conversation['messages'][0]['parts'] == ['Cheapest in Cairo']
+    assert conversation['messages'][1]['parts'] == ['إجابة رقم 1 ']
+
+    assert client.post('/api/gemini/chat/stream', json={}).status_code == 400
+
+
+def test_analyze_runs_as_background_job(client, fake_gemini):
+    """اختبار أن التحليل يعمل كمهمة في الخلفية وأن النتيجة تُحفظ لكل حجز."""
+    register_test_user(client, username='analyze@app.com', password='pass12345')
+    client.post('/api/login', json={'username': 'analyze@app.com', 'password': 'pass12345'})
+    booking_id = json.loads(client.post('/api/booking', json={
+        "booking_name": "Trip", "hotel_name": "Palm Resort", "city": "Dubai",
+        "check_in": "2025-12-01", "check_out": "2025-12-03", "price": 450
+    }).data)['id']
+
+    submit = client.post('/api/gemini/analyze', json={'booking_id': booking_id})
+    assert submit.status_code == 202
+    job_id = json.loads(submit.data)['job_id']
+
+    for _ in range(50):
+        status = json.loads(client.get(f'/api/gemini/analyze/{job_id}').data)
+        if status['status'] not in ('pending', 'running'):
+            break
+        time.sleep(0.05)
+    assert status['status'] == 'done'
+    assert status['result']['summary'] == 'ممتاز'
+    assert len(fake_gemini.calls) == 1
+
+    # التحليل المتكرر لنفس الحجز يُرجع فوراً من قاعدة البيانات
+    again = client.post('/api/gemini/analyze', json={'booking_id': booking_id})
+    assert again.status_code == 200
+    assert json.loads(again.data)['result']['title'] == 'تحليل'
+    assert len(fake_gemini.calls) == 1
+
+    assert client.get('/api/gemini/analyze/unknown').status_code == 404
+
+
+def test_user_cache_invalidated_on_profile_update(client):
+    """اختبار أن load_user يستخدم الكاش وأن تحديث الملف الشخصي يظهر فوراً."""
+    import app as app_module
+    manager = app_module.db_manager
+
+    register_test_user(client, username='cache@app.com', password='pass12345')
+    client.post('/api/login', json={'username': 'cache@app.com', 'password': 'pass12345'})
+
+    for _ in range(3):
+        client.get('/api/status')
+    assert manager.user_cache.stats()['hits'] >= 2
+
+    client.post('/api/profile/update', json={'username': 'cache@app.com', 'full_name': 'New Name', 'phone': '0111'})
+    status = json.loads(client.get('/api/status').data)
+    assert status['user']['full_name'] == 'New Name'
+
+    manager.update_user_phone(status['user']['id'], '0222')
+    status = json.loads(client.get('/api/status').data)
+    assert status['user']['phone'] == '0222'
+
+
+def test_password_rehashed_on_login_when_params_change(client, monkeypatch):
+    """اختبار ترقية هاش كلمة المرور عند الدخول إذا تغيّرت إعدادات التشفير."""
+    import app as app_module
+    manager = app_module.db_manager
+
+    monkeypatch.setattr(app_module, 'PASSWORD_HASH_METHOD', 'pbkdf2')
+    monkeypatch.setattr(app_module, 'PASSWORD_HASH_COST', 1000)
+    register_test_user(client, username='rehash@app.com', password='pass12345')
+
+    def stored_hash():
+        with manager.get_connection() as conn:
+            return conn.execute("SELECT password_hash FROM users WHERE username = ?", ('rehash@app.com',)).fetchone()[0]
+
+    assert stored_hash().startswith('pbkdf2:sha256:1000$')
+
+    monkeypatch.setattr(app_module, 'PASSWORD_HASH_METHOD', 'scrypt')
+    monkeypatch.setattr(app_module, 'PASSWORD_HASH_COST', 1024)
+    response = client.post('/api/login', json={'username': 'rehash@app.com', 'password': 'pass12345'})
+    assert response.status_code == 200
+
+    new_hash = stored_hash()
+    assert new_hash.startswith('scrypt:1024:8:1$')
+    assert check_password_hash(new_hash, 'pass12345')
+
+
+def test_password_pool_avoids_fork_and_replaces_broken_pool(monkeypatch):
+    """اختبار أن عمليات التشفير لا تُنشأ بـ fork وأن الـ pool التالف يُغلق قبل استبداله."""
+    from concurrent.futures.process import BrokenProcessPool
+    import app as app_module
+    monkeypatch.setattr(app_module, 'PASSWORD_HASH_WORKERS', 1)
+    monkeypatch.setattr(app_module, '_password_pool', None)
+    pool = app_module._get_password_pool()
+    try:
+        assert pool._mp_context.get_start_method() in ('forkserver', 'spawn')
+    finally:
+        pool.shutdown()
+
+    class BrokenPool:
+        closed = False
+
+        def submit(self, fn, *args):
+            raise BrokenProcessPool("worker died")
+
+        def shutdown(self, wait=True, cancel_futures=False):
+            BrokenPool.closed = True
+
+    broken = BrokenPool()
+    monkeypatch.setattr(app_module, '_password_pool', broken)
+    monkeypatch.setattr(app_module, 'PASSWORD_HASH_METHOD', 'pbkdf2')
+    monkeypatch.setattr(app_module, 'PASSWORD_HASH_COST', 1000)
+    assert check_password_hash(app_module.hash_password('secret'), 'secret')
+    assert BrokenPool.closed and app_module._password_pool is None
+
+
+def test_search_returns_srcset_from_image_manifest(client, monkeypatch, tmp_path):
+    """اختبار إرجاع روابط الصور المصغرة من الـ manifest عند توفره."""
+    import app as app_module
+
+    manifest = tmp_path / 'manifest.json'
+    manifest.write_text(json.dumps({
+        "image/Hotel4.jpg": {
+            "thumb": {"url": "/image/build/Hotel4-thumb-abc.webp", "width": 320, "height": 240},
+            "medium": {"url": "/image/build/Hotel4-medium-def.webp", "width": 800, "height": 600}
+        }
+    }))
+    monkeypatch.setattr(app_module, 'IMAGE_MANIFEST_FILE', str(manifest))
+
+    hotels = json.loads(client.get('/api/search?city=Cairo').data)
+    nile = next(h for h in hotels if h['name'] == 'Cairo Nile View')
+    assert nile['image_thumb_url'] == '/image/build/Hotel4-thumb-abc.webp'
+    assert nile['image_srcset'] == '/image/build/Hotel4-thumb-abc.webp 320w, /image/build/Hotel4-medium-def.webp 800w'
+
+    # صورة غير موجودة في الـ manifest تبقى بدون حقول إضافية
+    plaza = next(h for h in hotels if h['name'] == 'Pyramids Plaza')
+    assert 'image_srcset' not in plaza
+
+
+# 📦 اختبار الملفات الثابتة
+# ------------------------------------------------
+
+def test_static_assets_fingerprinted_and_precompressed(client):
+    """اختبار أن الصفحة الرئيسية تشير لملفات ذات بصمة تُرسل مضغوطة مع تخزين طويل."""
+    import re as regex
+    html = client.get('/').get_data(as_text=True)
+    match = regex.search(r'/assets/js/script\.([0-9a-f]{10})\.js', html)
+    assert match, "script.js reference was not fingerprinted"
+
+    url = match.group(0)
+    plain = client.get(url)
+    assert plain.status_code == 200
+    assert 'immutable' in plain.headers['Cache-Control']
+    assert 'Content-Encoding' not in plain.headers
+
+    compressed = client.get(url, headers={'Accept-Encoding': 'gzip'})
+    assert compressed.headers['Content-Encoding'] in ('gzip', 'br')
+    assert len(compressed.data) < len(plain.data)
+    assert 'Accept-Encoding' in compressed.headers['Vary']
+
+    # طلب متكرر بنفس الـ ETag يرجع 304 بدون محتوى
+    etag = compressed.headers['ETag']
+    revalidate = client.get(url, headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+    assert revalidate.status_code == 304
+
+    # الاسم الأصلي ما زال يعمل لكن بدون تخزين طويل
+    original = client.get('/assets/js/script.js')
+    assert original.status_code == 200
+    assert original.headers['Cache-Control'] == 'no-cache'
+    assert client.get('/assets/js/missing.js').status_code == 404
+
+
+def test_static_assets_cold_worker_and_edited_files(client, monkeypatch, tmp_path):
+    """اختبار أن أول طلب لاسم أصلي لا يُخزن طويلاً وأن تعديل الملف يظهر بعد مدة الفحص بدون طلب الصفحة الرئيسية."""
+    import os
+    import app as app_module
+    (tmp_path / 'assets' / 'js').mkdir(parents=True)
+    (tmp_path / 'index.html').write_text('<script src="/assets/js/a.js"></script>')
+    script = tmp_path / 'assets' / 'js' / 'a.js'
+    script.write_text('console.log(1);')
+    assets = app_module.StaticAssets(str(tmp_path))
+    monkeypatch.setattr(app_module, 'static_assets', assets)
+
+    first = client.get('/assets/js/a.js')
+    assert first.headers['Cache-Control'] == 'no-cache'
+    assert client.get('/assets/js/a.not-a-hash.js').status_code == 404
+
+    # داخل مدة الفحص لا تُقرأ الملفات من القرص مع كل طلب
+    script.write_text('console.log(2);')
+    mtime = os.path.getmtime(script) + 10
+    os.utime(script, (mtime, mtime))
+    assert client.get('/assets/js/a.js').get_data(as_text=True) == 'console.log(1);'
+
+    monkeypatch.setattr(assets, 'check_interval', 0)
+    assert client.get('/assets/js/a.js').get_data(as_text=True) == 'console.log(2);'
+
+
+def test_list_endpoints_use_fast_json_and_gzip(client, monkeypatch):
+    """اختبار ضغط استجابات القوائم الكبيرة ومسار JSON الاحتياطي بدون orjson."""
+    import gzip
+    import app as app_module
+    monkeypatch.setattr(app_module, 'JSON_COMPRESS_MIN_BYTES', 100)
+
+    plain = client.get('/api/search?city=Dubai')
+    compressed = client.get('/api/search?city=Dubai', headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in plain.headers
+    assert compressed.headers['Content-Encoding'] == 'gzip'
+    assert json.loads(gzip.decompress(compressed.data)) == json.loads(plain.data)
+
+    # المسار الاحتياطي (المكتبة القياسية) يعطي نفس البيانات
+    monkeypatch.setattr(app_module, 'orjson', None)
+    fallback = client.get('/api/search?city=Dubai')
+    assert json.loads(fallback.data) == json.loads(plain.data)
+    assert fallback.mimetype == 'application/json'
+
+
+# 🛏️ اختبار مخزون الغرف والتوفر
+# ------------------------------------------------
+
+def test_room_inventory_prevents_overbooking(client):
+    """اختبار أن الحجز يستهلك المخزون ويمنع الحجز الزائد وأن الإلغاء يعيد الغرفة."""
+    import app as app_module
+    manager = app_module.db_manager
+    with manager.get_connection() as conn:
+        conn.execute('''
+            UPDATE room_types SET total_rooms = 1
+            WHERE hotel_id = (SELECT id FROM hotels WHERE name = 'Pyramids Plaza')
+        ''')
+        conn.commit()
+
+    register_test_user(client, username='rooms@app.com', password='pass12345')
+    client.post('/api/login', json={'username': 'rooms@app.com', 'password': 'pass12345'})
+
+    def book(check_in, check_out):
+        return client.post('/api/booking', json={
+            "booking_name": "Trip", "hotel_name": "Pyramids Plaza", "city": "Cairo",
+            "check_in": check_in, "check_out": check_out, "price": 150
+        })
+
+    def available_names(check_in, check_out):
+        res = client.get(f'/api/availability?city=cairo&check_in={check_in}&check_out={check_out}')
+        return {h['name'] for h in json.loads(res.data)}
+
+    assert 'Pyramids Plaza' in available_names('2026-01-10', '2026-01-12')
+    first = book('2026-01-10', '2026-01-12')
+    assert first.status_code == 200
+
+    # تداخل في ليلة واحدة => لا توجد غرف
+    overlap = book('2026-01-11', '2026-01-13')
+    assert overlap.status_code == 409
+    assert 'Pyramids Plaza' not in available_names('2026-01-11', '2026-01-12')
+    assert 'Cairo Nile View' in available_names('2026-01-11', '2026-01-12')
+
+    # يوم الخروج ليس ليلة محجوزة
+    assert book('2026-01-12', '2026-01-14').status_code == 200
+
+    # الإلغاء يعيد الغرفة إلى المخزون
+    client.delete(f"/api/booking/{json.loads(first.data)['id']}")
+    assert 'Pyramids Plaza' in available_names('2026-01-10', '2026-01-12')
+
+    assert book('2026-01-12', '2026-01-10').status_code == 400
+    assert client.get('/api/availability?city=Cairo&check_in=bad&check_out=2026-01-02').status_code == 400
+
+
+def test_booking_cannot_bypass_room_inventory(client):
+    """اختبار أن اختلاف حالة الأحرف وصيغة التواريخ ونوع غرفة فندق آخر لا تتجاوز المخزون وأن السعر من الكتالوج."""
+    import app as app_module
+    manager = app_module.db_manager
+    with manager.get_connection() as conn:
+        conn.execute("UPDATE room_types SET total_rooms = 1")
+        conn.commit()
+        palm_room = conn.execute('''
+            SELECT rt.id FROM room_types rt JOIN hotels h ON h.id = rt.hotel_id WHERE h.name = 'Palm Resort'
+        ''').fetchone()[0]
+
+    register_test_user(client, username='bypass@app.com', password='pass12345')
+    client.post('/api/login', json={'username': 'bypass@app.com', 'password': 'pass12345'})
+
+    def book(hotel_name, city, check_in='2026-03-01', check_out='2026-03-03', **extra):
+        return client.post('/api/booking', json={
+            "booking_name": "Trip", "hotel_name": hotel_name, "city": city,
+            "check_in": check_in, "check_out": check_out, "price": 450, **extra
+        })
+
+    assert book('Palm Resort', 'Dubai').status_code == 200
+    assert book('palm  resort', 'DUBAI').status_code == 409
+
+    # نوع غرفة من فندق آخر أو قيمة غير رقمية => 400
+    assert book('Pyramids Plaza', 'Cairo', room_type_id=palm_room).status_code == 400
+    assert book('Pyramids Plaza', 'Cairo', room_type_id='abc').status_code == 400
+
+    # التواريخ بصيغة مختصرة تُحفظ موحدة ويعيد الإلغاء الليالي المحجوزة
+    # السعر المرسل (450) يُستبدل بسعر نوع الغرفة في الكتالوج
+    compact = book('Cairo Nile View', 'Cairo', check_in='20260110', check_out='20260112')
+    assert compact.status_code == 200
+    booking_id = json.loads(compact.data)['id']
+    with manager.get_connection() as conn:
+        stored = conn.execute(
+            "SELECT check_in, check_out, price, room_type_id FROM bookings WHERE id = ?", (booking_id,)
+        ).fetchone()
+        room_price = conn.execute("SELECT price FROM room_types WHERE id = ?", (stored['room_type_id'],)).fetchone()[0]
+    assert tuple(stored)[:2] == ('2026-01-10', '2026-01-12')
+    assert stored['price'] == room_price != 450
+    client.delete(f'/api/booking/{booking_id}')
+    with manager.get_connection() as conn:
+        booked = conn.execute("SELECT SUM(booked) FROM room_inventory WHERE night LIKE '2026-01-1%'").fetchone()[0]
+    assert booked == 0
+
+
+# ⌨️ اختبار الإكمال التلقائي
+# ------------------------------------------------
+
+def test_autocomplete_prefix_arabic_and_sync(client):
+    """اختبار الإكمال التلقائي بالبادئة والترتيب بالتقييم والنص العربي والتزامن مع جدول الفنادق."""
+    import app as app_module
+    manager = app_module.db_manager
+    assert manager.fts_enabled
+
+    data = json.loads(client.get('/api/autocomplete?q=du').data)
+    assert data['cities'] == ['Dubai']
+    ratings = [h['rating'] for h in data['hotels']]
+    assert ratings == sorted(ratings, reverse=True)
+    assert data['hotels'][0]['name'] == 'Palm Resort'
+
+    # إضافة فندق باسم عربي تظهر فوراً، والبحث يتجاهل التشكيل
+    with manager.get_connection() as conn:
+        conn.execute(
+            "INSERT INTO hotels (name, city, price, rating, image_url) VALUES (?, ?, ?, ?, ?)",
+            ("فندق النخيل", "الإسكندرية", 140, 4.2, None)
+        )
+        conn.commit()
+    data = json.loads(client.get('/api/autocomplete?q=النَّخ').data)
+    assert [h['name'] for h in data['hotels']] == ['فندق النخيل']
+
+    # تعديل الاسم يحدّث الفهرس
+    with manager.get_connection() as conn:
+        conn.execute("UPDATE hotels SET name = 'Palm Gardens' WHERE name = 'فندق النخيل'")
+        conn.commit()
+    assert json.loads(client.get('/api/autocomplete?q=النخ').data)['hotels'] == []
+    names = [h['name'] for h in json.loads(client.get('/api/autocomplete?q=palm g').data)['hotels']]
+    assert names == ['Palm Gardens']
+
+    # مفتاح الترتيب مبني على التقييم: تعديل التقييم ينقل الفندق بدون أن يبقى مدخله القديم
+    with manager.get_connection() as conn:
+        conn.execute("UPDATE hotels SET rating = 1.0 WHERE name = 'Palm Gardens'")
+        conn.commit()
+        plan = " ".join(row[3] for row in conn.execute(
+            "EXPLAIN QUERY PLAN SELECT rowid FROM hotels_rank_fts WHERE hotels_rank_fts MATCH 'palm*' ORDER BY rowid LIMIT 8"
+        ))
+    assert 'TEMP B-TREE' not in plan
+    names = [h['name'] for h in json.loads(client.get('/api/autocomplete?q=palm').data)['hotels']]
+    assert names[-1] == 'Palm Gardens' and len(names) == len(set(names))
+
+    assert json.loads(client.get('/api/autocomplete?q=').data) == {"cities": [], "hotels": []}
+
+
+# 📍 اختبار البحث الجغرافي
+# ------------------------------------------------
+
+def test_nearby_hotels_ordered_by_distance(client):
+    """اختبار أقرب الفنادق ونصف القطر والمربع والفلاتر وتزامن فهرس R-tree."""
+    import app as app_module
+
+    def nearby(query):
+        return json.loads(client.get(f'/api/hotels/nearby?{query}').data)
+
+    # من وسط دبي: أقرب فندق هو Grand Hotel Dubai، والبحث يتوسع حتى يجد العدد المطلوب
+    data = nearby('lat=25.2048&lng=55.2708&limit=3')
+    assert [h['name'] for h in data] == ['Grand Hotel Dubai', 'Palm Resort', 'Dubai Marina View']
+    distances = [h['distance_km'] for h in data]
+    assert distances == sorted(distances) and distances[0] == 0
+
+    # نصف قطر محدد مع فلتر السعر
+    assert [h['name'] for h in nearby('lat=25.2048&lng=55.2708&radius_km=5')] == ['Grand Hotel Dubai']
+    assert [h['name'] for h in nearby('lat=25.2048&lng=55.2708&radius_km=50&max_price=300')] == \
+        ['Grand Hotel Dubai', 'Dubai Marina View']
+
+    # مربع يغطي لندن فقط
+    names = {h['name'] for h in nearby('min_lat=51&max_lat=52&min_lng=-1&max_lng=1')}
+    assert names == {'London Bridge Inn', 'Hyde Park Suites'}
+
+    # تعديل الإحداثيات يحدّث الفهرس
+    with app_module.db_manager.get_connection() as conn:
+        conn.execute("UPDATE hotels SET latitude = 51.5, longitude = -0.1 WHERE name = 'Palm Resort'")
+        conn.commit()
+    assert 'Palm Resort' in {h['name'] for h in nearby('min_lat=51&max_lat=52&min_lng=-1&max_lng=1')}
+
+    # خريطة بعيدة تغطي العالم: عدد الصفوف محدود في SQL والنتيجة أقرب الفنادق من المركز
+    manager = app_module.db_manager
+    assert len(manager.get_hotels_in_box(-90, 90, -180, 180, limit=2)) == 2
+    world = nearby('min_lat=-90&max_lat=90&min_lng=-180&max_lng=180&limit=3')
+    with manager.get_connection() as conn:
+        everything = conn.execute("SELECT latitude, longitude FROM hotels WHERE latitude IS NOT NULL").fetchall()
+    closest = sorted(round(app_module.haversine_km(0, 0, *row), 3) for row in everything)[:3]
+    assert [h['distance_km'] for h in world] == closest
+
+    assert client.get('/api/hotels/nearby').status_code == 400
+    assert client.get('/api/hotels/nearby?lat=200&lng=0').status_code == 400
+
+
+# 📥 اختبار استيراد كتالوج الفنادق
+# ------------------------------------------------
+
+def test_import_hotels_cli_and_api(client, monkeypatch, tmp_path):
+    """اختبار الاستيراد من CSV عبر سطر الأوامر (مع تأجيل الفهارس) ومن JSONL عبر الـ API."""
+    import app as app_module
+    manager = app_module.db_manager
+
+    path = tmp_path / "hotels.csv"
+    path.write_text(
+        "name,city,price,rating,image_url,latitude,longitude\n"
+        "Nile Ritz,Cairo,310,4.9,,30.0459,31.2313\n"
+        "Broken Row,Cairo,abc,4.0,,,\n"
+        "Palm Resort,Dubai,500,4.9,,25.1124,55.1390\n",
+        encoding="utf-8"
+    )
+    runner = app_module.app.test_cli_runner()
+    result = runner.invoke(args=["import-hotels", str(path), "--defer-indexes", "--chunk-size", "1"])
+    assert result.exit_code == 0, result.output
+    assert "imported 2 rows" in result.output and "skipped 1" in result.output
+    assert "line 3" in result.output
+
+    # الفندق الموجود يُحدّث بدلاً من تكراره، والفهارس المؤجلة أعيد بناؤها
+    search = json.loads(client.get('/api/search?city=Dubai').data)
+    assert [h['price'] for h in search if h['name'] == 'Palm Resort'] == [500]
+    assert [h['name'] for h in json.loads(client.get('/api/autocomplete?q=nile r').data)['hotels']] == ['Nile Ritz']
+    nearby = json.loads(client.get('/api/hotels/nearby?lat=30.0459&lng=31.2313&limit=1').data)
+    assert nearby[0]['name'] == 'Nile Ritz'
+    with manager.get_connection() as conn:
+        triggers = conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'trigger'").fetchone()[0]
+    assert triggers >= 8
+
+    body = '{"name": "Zamalek Suites", "city": "Cairo", "price": 140, "rating": 4.4}\nnot json\n'
+    assert client.post('/api/hotels/import', data=body).status_code == 403
+    monkeypatch.setattr(app_module, 'CATALOG_IMPORT_TOKEN', 'secret')
+    # الاستيراد من الـ API لا يحجز قفل الكتابة: الدفعات تمر عبر خيط الكتابة حتى للملفات الكبيرة
+    monkeypatch.setattr(app_module, 'IMPORT_DEFER_INDEXES_BYTES', 0)
+    ops_before = manager.writer.stats()['ops']
+    response = client.post('/api/hotels/import?format=jsonl', data=body, headers={'X-Import-Token': 'secret'})
+    stats = json.loads(response.data)
+    # دفعة واحدة + حفظ أسعار المدن المتغيرة بعدها
+    assert manager.writer.stats()['ops'] - ops_before == stats['chunks'] + 1 == 2
+    assert response.status_code == 200
+    assert stats['rows'] == 1 and stats['skipped'] == 1 and stats['errors'][0]['line'] == 2
+    assert 'Zamalek Suites' in [h['name'] for h in json.loads(client.get('/api/search?city=Cairo').data)]
+
+
+# 🧱 اختبار ترحيلات قاعدة البيانات
+# ------------------------------------------------
+
+def test_migrations_tracked_with_user_version(client, monkeypatch):
+    """اختبار أن الترحيلات تُسجل في user_version وأن قاعدة البيانات المحدثة لا تعيد تنفيذها."""
+    import app as app_module
+    manager = app_module.db_manager
+    with manager.get_connection() as conn:
+        assert conn.execute("PRAGMA user_version").fetchone()[0] == len(DBManager.MIGRATIONS)
+        hotels = conn.execute("SELECT COUNT(*) FROM hotels").fetchone()[0]
+
+    def fail(self, cursor):
+        raise AssertionError("migration should not run on an up-to-date database")
+
+    monkeypatch.setattr(DBManager, 'MIGRATIONS', [fail] * len(DBManager.MIGRATIONS))
+    reopened = DBManager(TEST_DATABASE_FILE)
+    try:
+        assert reopened.fts_enabled
+        with reopened.get_connection() as conn:
+            assert conn.execute("SELECT COUNT(*) FROM hotels").fetchone()[0] == hotels
+    finally:
+        reopened.close()
+
+    # ترحيل جديد يُطبق وحده على قاعدة البيانات الموجودة
+    applied = []
+    monkeypatch.setattr(DBManager, 'MIGRATIONS', DBManager.MIGRATIONS + [lambda self, cursor: applied.append(1)])
+    reopened = DBManager(TEST_DATABASE_FILE)
+    reopened.close()
+    assert applied == [1]
+
+
+# 📈 اختبار مقاييس الأداء
+# ------------------------------------------------
+
+def metric_value(client, sample):
+    """قيمة مقياس واحد من /metrics (صفر إذا لم يظهر بعد)."""
+    for line in client.get('/metrics').data.decode('utf-8').splitlines():
+        if line.startswith(sample + ' '):
+            return float(line.rsplit(' ', 1)[1])
+    return 0.0
+
+
+def test_metrics_endpoint_reports_routes_db_gemini_and_caches(client, fake_gemini):
+    """اختبار أن /metrics يعرض زمن المسارات ودوال قاعدة البيانات واستدعاءات Gemini والكاش."""
+    samples = [
+        'http_requests_total{method="GET",route="/api/search",status="200"}',
+        'http_request_duration_seconds_bucket{method="GET",route="/api/search",le="+Inf"}',
+        'http_request_duration_seconds_count{method="GET",route="/api/hotels/nearby"}',
+        'db_method_duration_seconds_count{method="get_nearby_hotels"}',
+        'gemini_request_duration_seconds_count{operation="chat"}',
+    ]
+    before = {sample: metric_value(client, sample) for sample in samples}
+
+    client.get('/api/search?city=Dubai')
+    client.get('/api/search?city=Dubai')
+    client.get('/api/hotels/nearby?lat=25.2&lng=55.27')
+    client.post('/api/gemini/chat', json={'prompt': 'Hotels in Cairo?'})
+
+    deltas = [metric_value(client, sample) - before[sample] for sample in samples]
+    assert deltas == [2, 2, 1, 1, 1]
+
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.content_type.startswith('text/plain')
+    text = response.data.decode('utf-8')
+    assert '# TYPE http_request_duration_seconds histogram' in text
+    assert 'cache_hit_ratio{cache="search"}' in text
+    assert metric_value(client, 'cache_hits_total{cache="search"}') >= 1
+    assert metric_value(client, 'db_pool_connections_opened_total') >= 1
+
+
+# 🐢 اختبار سجل الاستعلامات البطيئة
+# ------------------------------------------------
+
+def test_slow_query_log_captures_plans_and_full_scans(client, monkeypatch):
+    """اختبار تسجيل الاستعلامات فوق الحد مع خطة التنفيذ وتمييز مسح الجدول الكامل."""
+    import app as app_module
+    assert client.get('/api/debug/slow-queries').status_code == 404
+
+    manager = DBManager(TEST_DATABASE_FILE, slow_query_ms=0)
+    monkeypatch.setattr(app_module, 'db_manager', manager)
+    try:
+        client.get('/api/search?city=Dubai&sort=price_asc')
+        with manager.get_connection() as conn:
+            for _ in range(3):
+                conn.execute("SELECT * FROM hotels WHERE image_url = ?", ('x',)).fetchall()
+
+        data = json.loads(client.get('/api/debug/slow-queries?sort=count&limit=200').data)
+        queries = {q['sql']: q for q in data['queries']}
+        scan = queries["SELECT * FROM hotels WHERE image_url = ?"]
+        assert scan['count'] == 3 and scan['full_scan']
+        assert any(line.startswith('SCAN hotels') for line in scan['plan'])
+
+        search = [q for q in data['queries'] if 'FROM hotels WHERE city = ?' in q['sql']]
+        assert search and not search[0]['full_scan']
+        assert any('idx_hotels_city_price' in line for line in search[0]['plan'])
+        assert client.get('/api/debug/slow-queries?sort=bad').status_code == 400
+    finally:
+        manager.close()
+
+
+# ✍️ اختبار طابور الكتابة (group commit)
+# ------------------------------------------------
+
+def test_write_queue_group_commit_results_and_backpressure(client):
+    """اختبار أن الكتابات المتزامنة تُجمع في transactions مشتركة مع نتيجة أو خطأ لكل عملية وضغط عكسي."""
+    import sqlite3
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    import app as app_module
+    from app import WriteQueue, WriteQueueFull
+    manager = app_module.db_manager
+
+    # 12 حجزاً متزامناً على فندق فيه 10 غرف: 10 تنجح و 2 ممتلئة، ولا أخطاء قفل
+    data = {'hotel_name': 'Palm Resort', 'city': 'Dubai', 'price': 450,
+            'check_in': '2027-03-01', 'check_out': '2027-03-02'}
+    before = manager.writer.stats()
+    with ThreadPoolExecutor(max_workers=12) as executor:
+        results = list(executor.map(lambda i: manager.add_booking(1, 'u', data), range(12)))
+    assert sorted(error or 'ok' for _, error in results) == ['ok'] * 10 + ['sold_out'] * 2
+    after = manager.writer.stats()
+    assert after['ops'] - before['ops'] == 12
+
+    # خطأ عملية واحدة لا يلغي باقي عمليات نفس الـ transaction
+    release = threading.Event()
+    blocker = manager.writer.submit(lambda cursor: release.wait(5))
+    ok = manager.writer.submit(lambda cursor: cursor.execute(
+        "INSERT INTO favorites (user_id, item_name, city, added_at) VALUES (1, 'A', 'Dubai', 'now')"))
+    bad = manager.writer.submit(lambda cursor: cursor.execute("INSERT INTO missing_table VALUES (1)"))
+    release.set()
+    blocker.result(5), ok.result(5)
+    with pytest.raises(sqlite3.OperationalError):
+        bad.result(5)
+    assert manager.get_user_favorites(1) == [{'item_name': 'A', 'city': 'Dubai'}]
+
+    # الطابور الممتلئ يرفض العمليات الجديدة بدلاً من تراكمها
+    queue = WriteQueue(manager.pool.open_dedicated, max_pending=1, timeout=0.05)
+    release = threading.Event()
+    started = threading.Event()
+    try:
+        queue.submit(lambda cursor: (started.set(), release.wait(5)))
+        started.wait(5)
+        queue.submit(lambda cursor: None)
+        with pytest.raises(WriteQueueFull):
+            queue.submit(lambda cursor: None)
+        assert queue.stats()['rejected'] == 1
+    finally:
+        release.set()
+        queue.close()
+
+
+def test_write_queue_fails_fast_when_writer_stops(client):
+    """اختبار أن توقف خيط الكتابة أو بطأه يرجع خطأ للمستدعي بدلاً من الانتظار للأبد."""
+    import threading
+    from app import WriteQueue, WriterUnavailable, WriteQueueFull
+    import app as app_module
+
+    def broken_connect():
+        raise RuntimeError("cannot open database")
+
+    dead = WriteQueue(broken_connect)
+    dead._thread.join(5)
+    start = time.monotonic()
+    with pytest.raises(WriterUnavailable):
+        dead.execute(lambda cursor: None)
+    assert time.monotonic() - start < 1
+    assert issubclass(WriterUnavailable, WriteQueueFull)
+
+    # انتظار النتيجة محدود بمهلة، والعملية التي انتهت مهلتها قبل أن تبدأ تُلغى ولا تُكتب لاحقاً
+    slow = WriteQueue(app_module.db_manager.pool.open_dedicated, result_timeout=0.05)
+    release = threading.Event()
+    ran = []
+    try:
+        blocker = slow.submit(lambda cursor: release.wait(5))
+        with pytest.raises(WriterUnavailable):
+            slow.execute(lambda cursor: ran.append(True))
+        release.set()
+        assert blocker.result(5) is True
+        assert slow.execute(lambda cursor: 'ok') == 'ok'
+    finally:
+        release.set()
+        slow.close()
+    assert ran == []
+    with pytest.raises(WriterUnavailable):
+        slow.execute(lambda cursor: None)
+
+
+def test_writer_starts_after_migrations(monkeypatch, tmp_path):
+    """اختبار أن خيط الكتابة يبدأ بعد انتهاء الترحيلات على قاعدة بيانات جديدة وأن الفنادق الافتراضية تُضاف عبره."""
+    import sqlite3
+    import app as app_module
+    path = str(tmp_path / "fresh.db")
+    versions = []
+
+    class RecordingQueue(app_module.WriteQueue):
+        def __init__(self, connect, *args, **kwargs):
+            with sqlite3.connect(path) as conn:
+                versions.append(conn.execute("PRAGMA user_version").fetchone()[0])
+            super().__init__(connect, *args, **kwargs)
+
+    monkeypatch.setattr(app_module, 'WriteQueue', RecordingQueue)
+    manager = DBManager(path)
+    try:
+        assert versions == [len(DBManager.MIGRATIONS)]
+        assert manager.writer.stats()['ops'] >= 1
+        with manager.get_connection() as conn:
+            assert conn.execute("SELECT COUNT(*) FROM hotels").fetchone()[0] > 0
+    finally:
+        manager.close()
+
+
+# 🚦 اختبار تحديد معدل الطلبات
+# ------------------------------------------------
+
+def test_chat_rate_limits_and_concurrency_cap(client, fake_gemini, monkeypatch):
+    """اختبار رد 429 مع Retry-After عند تجاوز الحد، ورد 503 عند امتلاء أماكن Gemini المتزامنة."""
+    import app as app_module
+    monkeypatch.setattr(app_module, 'chat_limiter', app_module.RateLimiter(60, 2))
+
+    statuses = [client.post('/api/gemini/chat', json={'prompt': f'q{i}'}).status_code for i in range(3)]
+    assert statuses == [200, 200, 429]
+    limited = client.post('/api/gemini/chat/stream', json={'prompt': 'again'})
+    assert limited.status_code == 429
+    assert int(limited.headers['Retry-After']) >= 1
+    assert json.loads(limited.data)['response']
+    assert len(fake_gemini.calls) == 2
+
+    # عميل آخر (جلسة جديدة) لا يتأثر بحد العميل الأول
+    with app.test_client() as other:
+        assert other.post('/api/gemini/chat', json={'prompt': 'hello'}).status_code == 200
+
+    # كل أماكن Gemini محجوزة: الانتظار ينتهي بالمهلة ثم 503
+    monkeypatch.setattr(app_module, 'chat_limiter', app_module.RateLimiter(600, 100))
+    slots = app_module.ConcurrencyLimiter(1, timeout=0.05)
+    monkeypatch.setattr(app_module, 'gemini_slots', slots)
+    slots.acquire()
+    try:
+        busy = client.post('/api/gemini/chat/stream', json={'prompt': 'busy?'})
+        assert busy.status_code == 503 and 'Retry-After' in busy.headers
+    finally:
+        slots.release()
+
+    # البث يحرر المكان بعد انتهائه
+    response = client.post('/api/gemini/chat/stream', json={'prompt': 'stream me'})
+    assert b'event: done' in response.data
+    response.close()
+    slots.acquire()
+    slots.release()
+
+
+# 🔀 اختبار دمج الطلبات المتطابقة (single-flight)
+# ------------------------------------------------
+
+def test_single_flight_shares_results_errors_and_times_out():
+    """اختبار أن الطلبات المتزامنة بنفس المفتاح تنفذ العمل مرة واحدة وتتشارك النتيجة أو الخطأ."""
+    import threading
+    from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+    from app import SingleFlight
+
+    flight = SingleFlight(timeout=5)
+    calls = []
+    gate = threading.Event()
+
+    def work():
+        calls.append(1)
+        gate.wait(5)
+        return ['Dubai']
+
+    with ThreadPoolExecutor(max_workers=5) as executor:
+        futures = [executor.submit(flight.do, 'search:dubai', work) for _ in range(5)]
+        while flight.stats()['shared'] < 4:
+            time.sleep(0.01)
+        gate.set()
+        assert [f.result() for f in futures] == [['Dubai']] * 5
+    assert len(calls) == 1 and flight.stats()['in_flight'] == 0
+
+    # الخطأ يصل لكل المنتظرين، والمفتاح يُحرر للمحاولة التالية
+    gate.clear()
+
+    def fail():
+        gate.wait(5)
+        raise ValueError("boom")
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [executor.submit(flight.do, 'k', fail) for _ in range(2)]
+        while flight.stats()['shared'] < 5:
+            time.sleep(0.01)
+        gate.set()
+        for f in futures:
+            with pytest.raises(ValueError):
+                f.result()
+    assert flight.do('k', lambda: 'ok') == 'ok'
+
+    # المنتظر لا ينتظر أكثر من المهلة
+    slow = SingleFlight(timeout=0.05)
+    future, leader = slow.claim('x')
+    assert leader
+    with pytest.raises(FuturesTimeoutError):
+        slow.do('x', lambda: 'never')
+    slow.finish('x', future, 'done')
+
+
+def test_identical_concurrent_chat_prompts_call_gemini_once(client, fake_gemini, monkeypatch):
+    """اختبار أن نفس السؤال الأول من عدة مستخدمين في نفس اللحظة يستدعي Gemini مرة واحدة."""
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    import app as app_module
+    gate = threading.Event()
+    send_message = FakeChat.send_message
+
+    def slow_send(self, prompt, stream=False):
+        gate.wait(5)
+        return send_message(self, prompt, stream)
+
+    monkeypatch.setattr(FakeChat, 'send_message', slow_send)
+
+    def ask(path):
+        with app.test_client() as user:
+            return user.post(path, json={'prompt': 'Best hotel in Cairo?'}).get_data(as_text=True)
+
+    paths = ['/api/gemini/chat'] * 4 + ['/api/gemini/chat/stream']
+    with ThreadPoolExecutor(max_workers=5) as executor:
+        futures = [executor.submit(ask, path) for path in paths]
+        while app_module.chat_flight.stats()['in_flight'] == 0:
+            time.sleep(0.01)
+        time.sleep(0.2)
+        gate.set()
+        responses = [f.result() for f in futures]
+
+    assert len(fake_gemini.calls) == 1
+    answers = {json.loads(r)['response'] for r in responses[:4]}
+    assert answers == {'إجابة رقم 1'}
+    assert 'رقم' in responses[4] and 'event: done' in responses[4]
+
+
+# 💰 اختبار تحليل الأسعار المحلي
+# ------------------------------------------------
+
+def test_city_price_stats_maintained_and_analysis_without_llm(client, fake_gemini, monkeypatch):
+    """اختبار أن إحصائيات أسعار المدن تتحدث مع الجداول وأن التحليل يعمل بدون Gemini."""
+    import app as app_module
+    manager = app_module.db_manager
+
+    stats = manager.get_city_price_stats('Dubai')
+    assert stats['hotels_count'] == 3
+    assert (stats['min'], stats['p50'], stats['max']) == (250, 300, 450)
+    assert stats['mean'] == round((250 + 300 + 450) / 3, 2)
+    assert manager.get_city_price_stats('Paris') is None
+
+    # الإضافة والتعديل والحذف تنعكس على الإحصائيات فوراً
+    with manager.get_connection() as conn:
+        conn.execute("INSERT INTO hotels (name, city, price, rating) VALUES ('Budget Stay', 'Dubai', 50, 3.0)")
+        conn.execute("UPDATE hotels SET price = 500 WHERE name = 'Palm Resort'")
+        conn.execute("DELETE FROM hotels WHERE name = 'Dubai Marina View'")
+        conn.commit()
+    stats = manager.get_city_price_stats('Dubai')
+    assert (stats['hotels_count'], stats['min'], stats['max']) == (3, 50, 500)
+    assert stats['mean'] == round((50 + 250 + 500) / 3, 2)
+
+    comparison = manager.get_price_comparison('Grand Hotel Dubai', 'Dubai', 250)
+    assert comparison['band'] == 'below_median' and comparison['diff_pct'] < 0
+    assert comparison['value_score'] > 1
+
+    # Gemini معطل: التحليل يرجع مقارنة السعر المحلية ولا يُحفظ
+    register_test_user(client, username='prices@app.com', password='pass12345')
+    client.post('/api/login', json={'username': 'prices@app.com', 'password': 'pass12345'})
+    booking_id = json.loads(client.post('/api/booking', json={
+        "booking_name": "Trip", "hotel_name": "Grand Hotel Dubai", "city": "Dubai",
+        "check_in": "2025-12-01", "check_out": "2025-12-03", "price": 250
+    }).data)['id']
+    assert manager.get_city_price_stats('Dubai')['bookings_count'] == 1
+
+    def unavailable(prompt, **kwargs):
+        raise RuntimeError("gemini down")
+
+    monkeypatch.setattr(fake_gemini, 'generate_content', unavailable)
+    job_id = json.loads(client.post('/api/gemini/analyze', json={'booking_id': booking_id}).data)['job_id']
+    for _ in range(50):
+        status = json.loads(client.get(f'/api/gemini/analyze/{job_id}').data)
+        if status['status'] not in ('pending', 'running'):
+            break
+        time.sleep(0.05)
+    assert status['status'] == 'done'
+    result = status['result']
+    assert result['source'] == 'local'
+    assert result['price_stats']['band'] == 'below_median'
+    assert 'أقل من متوسط فنادق Dubai' in result['price_analysis']
+    assert manager.get_booking_analysis(booking_id) is None
+
+
+def test_city_price_stats_case_insensitive_and_readable_without_writer(client, monkeypatch):
+    """اختبار أن إحصائيات المدينة لا تتأثر بحالة الأحرف وتُحسب من اتصال القراءة عند تعذر الكتابة."""
+    import app as app_module
+    from app import WriteQueueFull
+    manager = app_module.db_manager
+
+    with manager.get_connection() as conn:
+        conn.execute("INSERT INTO hotels (name, city, price, rating) VALUES ('Upper Case Inn', 'DUBAI', 100, 4.0)")
+        conn.commit()
+        count = conn.execute("SELECT COUNT(*) FROM city_price_stats WHERE city = 'dubai'").fetchone()[0]
+    assert count == 1
+
+    # upsert لفندق موجود (تحديث عبر trigger) لا يصطدم بصف المدينة الموجود
+    stats = manager.import_hotels([('Upper Case Inn', 'DUBAI', 100, 4.0, None, None, None)])
+    assert stats['rows'] == 1
+
+    # الاستيراد عبر خيط الكتابة يحفظ أسعار المدينة، والتعديل المباشر يتركها للحساب عند القراءة
+    with manager.get_connection() as conn:
+        assert conn.execute("SELECT stale FROM city_price_stats WHERE city = 'dubai'").fetchone()[0] == 0
+        conn.execute("UPDATE hotels SET price = 90 WHERE name = 'Upper Case Inn'")
+        conn.commit()
+
+    def unavailable(fn):
+        raise WriteQueueFull()
+
+    # القراءة لا تمر بخيط الكتابة إطلاقاً
+    monkeypatch.setattr(manager.writer, 'execute', unavailable)
+    monkeypatch.setattr(manager.writer, 'submit', unavailable)
+    stats = manager.get_city_price_stats('dubai')
+    assert (stats['hotels_count'], stats['min'], stats['max']) == (4, 90, 450)
+    assert manager.get_price_comparison('Palm Resort', 'Dubai', 450)['band'] == 'highest_quarter'